@@ -136,7 +136,7 @@ class Launcher(object):
                     region='us-east-1', log=None, scratch=None,
                     ipython_profile=None, ipcontroller_json=None, common=None,
                     direct_write=False, json=False, sort=None,
-                    profile=None):
+                    profile=None, profile_steps=False):
         self.force = force
         self.num_processes = num_processes
         self.keep_intermediates = keep_intermediates
@@ -154,6 +154,7 @@ class Launcher(object):
         self.json = json
         self.sort = sort
         self.profile = profile
+        self.profile_steps = profile_steps
 
     def run(self, mode, payload):
         """ Replaces current process, using PyPy if it's available.
@@ -200,6 +201,8 @@ class Launcher(object):
                                             str(self.gzip_level)])
                 if self.log:
                     runner_args.extend(['-l', os.path.abspath(self.log)])
+                if self.profile_steps:
+                    runner_args.append('--profile')
                 if self.scratch:
                     runner_args.extend(
                         ['--direct-write', '--scratch', self.scratch]
@@ -235,6 +238,8 @@ class Launcher(object):
                                             str(self.gzip_level)])
                 if self.log:
                     runner_args.extend(['-l', os.path.abspath(self.log)])
+                if self.profile_steps:
+                    runner_args.append('--profile')
                 if self.common:
                     runner_args.extend(['--common',
                         os.path.abspath(self.common)])
@@ -1200,5 +1205,10 @@ if __name__ == '__main__':
                                         if mode == 'elastic'
                                         else None
                                     ),
+                                    profile_steps=(
+                                        args.profile_steps
+                                        if mode in ['local', 'parallel']
+                                        else False
+                                    ),
                                 )
     launcher.run(mode, json.dumps(json_creator.json_serial))
\ No newline at end of file
@@ -30,46 +30,189 @@ THE SOFTWARE.
 """
 
 import sys
+import os
+import json
+import glob
 from collections import defaultdict
+from itertools import count
+
+# Environment variable naming prefix of files to which metrics are written
+_metrics_prefix_variable = 'dooplicity_metrics_prefix'
+# Distinguishes files written by Counters in the same process
+_serial_numbers = count()
 
 
 class Counter(object):
     """
     Keeps track of counters and flushes them.
+
+    Counters come in three types: sums, updated with add(); maxima, updated
+    with maximum(); and histograms of nonnegative integers, updated with
+    observe(), whose buckets are [0, 1), [1, 2), [2, 4), [4, 8), .... Each
+    update is a single dictionary operation; nothing is written until
+    flush(), which may be called as often as is convenient.
+
+    If metrics_prefix is set, either explicitly or through the environment
+    variable dooplicity_metrics_prefix, flush() writes every counter as JSON
+    to a file beginning with metrics_prefix that collect_metrics() merges
+    with those of other Counters. Otherwise, flush() writes sums accumulated
+    since the last flush to output_fh in Hadoop Streaming's format.
     """
 
-    def __init__(self, group, output_fh=sys.stderr, report_style='hadoop'):
-        self.counts_flushable = defaultdict(int)
+    def __init__(self, group, output_fh=sys.stderr, report_style='hadoop',
+                    metrics_prefix=None):
         self.counts = defaultdict(int)
+        # Sums as of last flush
+        self.flushed = {}
+        self.maxima = {}
+        # Maps histogram name to dictionary mapping bucket to count
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.histogram_sums = defaultdict(int)
         self.group = group
         self.report_style = report_style
         self.output_fh = output_fh
+        if metrics_prefix is None:
+            metrics_prefix = os.environ.get(_metrics_prefix_variable)
+        if metrics_prefix:
+            self.metrics_file = '%s.metrics.%d.%d' % (
+                    metrics_prefix, os.getpid(), next(_serial_numbers)
+                )
+        else:
+            self.metrics_file = None
 
     def add(self, counter, amt=1):
         """ Add given amount to given group """
         self.counts[counter] += amt
-        self.counts_flushable[counter] += amt
+
+    def maximum(self, counter, value):
+        """ Raise given maximum to value if it's smaller """
+        if value > self.maxima.get(counter, value - 1):
+            self.maxima[counter] = value
+
+    def observe(self, histogram, value):
+        """ Add nonnegative integer value to given histogram """
+        self.histograms[histogram][value.bit_length()] += 1
+        self.histogram_sums[histogram] += value
 
     def get(self, counter):
         """ Return total count associated with group """
-        return self.counts[counter]
+        return self.counts.get(counter, 0)
 
     def get_since_last_flush(self, counter):
         """ Return count since last call to flush associated with group """
-        return self.counts_flushable[counter]
+        return self.counts.get(counter, 0) - self.flushed.get(counter, 0)
+
+    def metrics(self):
+        """ Return dictionary of every counter, serializable as JSON """
+        return {
+                'group' : self.group,
+                'counters' : dict(self.counts),
+                'maxima' : dict(self.maxima),
+                'histograms' : dict(
+                        (histogram, {
+                            'buckets' : sorted(
+                                    [bucket and 1 << (bucket - 1), amount]
+                                    for bucket, amount in buckets.items()
+                                ),
+                            'sum' : self.histogram_sums[histogram]
+                        }) for histogram, buckets
+                        in self.histograms.items()
+                    )
+            }
 
     def flush(self):
         """
         Probably called by atexit or in a keep-alive loop.
         Hadoop streaming counter format: reporter:counter:<group>,<counter>,<amount>
         """
-        for k, v in sorted(self.counts_flushable.items()):
-            if v == 0:
-                continue
-            if self.report_style == 'hadoop':
-                self.output_fh.write('reporter:counter:')
-            self.output_fh.write('%s,%s,%d\n' % (self.group, k, v))
-        self.counts_flushable = defaultdict(int)
+        if self.metrics_file is not None:
+            # Replace file atomically so a reader never sees part of it
+            temp_file = self.metrics_file + '.temp'
+            with open(temp_file, 'w') as metrics_stream:
+                json.dump(self.metrics(), metrics_stream)
+            os.rename(temp_file, self.metrics_file)
+        else:
+            for k, v in sorted(self.counts.items()):
+                v -= self.flushed.get(k, 0)
+                if v == 0:
+                    continue
+                if self.report_style == 'hadoop':
+                    self.output_fh.write('reporter:counter:')
+                self.output_fh.write('%s,%s,%d\n' % (self.group, k, v))
+        self.flushed = dict(self.counts)
+
+
+def merged_metrics(metrics):
+    """ Merges metrics of many Counters by group.
+
+        metrics: iterable of dictionaries returned by Counter.metrics()
+
+        Return value: dictionary mapping each group to a dictionary like
+            those returned by Counter.metrics() but without the key "group"
+    """
+    merged = {}
+    for counter_metrics in metrics:
+        group = merged.setdefault(counter_metrics['group'], {
+                'counters' : defaultdict(int),
+                'maxima' : {},
+                'histograms' : {}
+            })
+        for counter, amount in counter_metrics['counters'].items():
+            group['counters'][counter] += amount
+        for counter, value in counter_metrics['maxima'].items():
+            if value > group['maxima'].get(counter, value - 1):
+                group['maxima'][counter] = value
+        for histogram, histogram_metrics \
+                in counter_metrics['histograms'].items():
+            merged_histogram = group['histograms'].setdefault(
+                    histogram, {'buckets' : defaultdict(int), 'sum' : 0}
+                )
+            for bucket, amount in histogram_metrics['buckets']:
+                merged_histogram['buckets'][bucket] += amount
+            merged_histogram['sum'] += histogram_metrics['sum']
+    for group in merged.values():
+        group['counters'] = dict(group['counters'])
+        for histogram in group['histograms'].values():
+            histogram['buckets'] = sorted(
+                    [bucket, amount]
+                    for bucket, amount in histogram['buckets'].items()
+                )
+    return merged
+
+
+def collect_metrics(metrics_prefix):
+    """ Merges metrics files written by Counters with the same prefix.
+
+        Writes metrics_prefix + '.metrics', JSON from merged_metrics(), and
+        metrics_prefix + '.counts', with a line "<group> <counter> <amount>"
+        for each nonzero sum, then deletes the files that were merged along
+        with any temporary files left by Counters that didn't finish writing.
+
+        metrics_prefix: prefix of metrics files to merge
+
+        No return value.
+    """
+    metrics_files = glob.glob(metrics_prefix + '.metrics.*')
+    metrics = []
+    for metrics_file in metrics_files:
+        if metrics_file.endswith('.temp'):
+            # Left by a Counter that didn't finish writing; may be partial
+            os.remove(metrics_file)
+            continue
+        with open(metrics_file) as metrics_stream:
+            metrics.append(json.load(metrics_stream))
+    merged = merged_metrics(metrics)
+    with open(metrics_prefix + '.metrics', 'w') as metrics_stream:
+        json.dump(merged, metrics_stream, indent=4, sort_keys=True)
+    with open(metrics_prefix + '.counts', 'w') as count_stream:
+        for group in sorted(merged):
+            for counter, amount in sorted(merged[group]['counters'].items()):
+                if not amount:
+                    continue
+                print >>count_stream, '%s %s %d' % (group, counter, amount)
+    for metrics_file in metrics_files:
+        if not metrics_file.endswith('.temp'):
+            os.remove(metrics_file)
 
 
 if __name__ == '__main__':
@@ -112,5 +255,86 @@ if __name__ == '__main__':
                 c.flush()
                 self.assertEqual(0, len(outp.getvalue()))
 
+            def test_flush_reports_increments(self):
+                outp = StringIO()
+                c = Counter('test_inc', outp)
+                c.add('ABC', 2)
+                c.flush()
+                c.add('ABC', 3)
+                c.add('XYZ', 1)
+                c.flush()
+                c.flush()
+                self.assertEqual(outp.getvalue().rstrip().split('\n'),
+                                 ['reporter:counter:test_inc,ABC,2',
+                                  'reporter:counter:test_inc,ABC,3',
+                                  'reporter:counter:test_inc,XYZ,1'])
+                self.assertEqual(c.get('ABC'), 5)
+
+            def test_typed_counters(self):
+                c = Counter('test_typed', StringIO())
+                c.maximum('longest', 5)
+                c.maximum('longest', 3)
+                c.maximum('longest', 8)
+                for value in [0, 1, 2, 3, 4, 7, 8, 100]:
+                    c.observe('lengths', value)
+                metrics = c.metrics()
+                self.assertEqual(metrics['maxima'], {'longest' : 8})
+                self.assertEqual(metrics['histograms']['lengths'],
+                                 {'buckets' : [[0, 1], [1, 1], [2, 2],
+                                               [4, 2], [8, 1], [64, 1]],
+                                  'sum' : 125})
+
+            def test_collect_metrics(self):
+                import tempfile
+                import shutil
+                temp_dir = tempfile.mkdtemp()
+                try:
+                    prefix = os.path.join(temp_dir, '0')
+                    outp = StringIO()
+                    c1 = Counter('group_a', outp, metrics_prefix=prefix)
+                    c2 = Counter('group_a', outp, metrics_prefix=prefix)
+                    c3 = Counter('group_b', outp, metrics_prefix=prefix)
+                    other = Counter('group_a', outp,
+                                    metrics_prefix=prefix + '.1')
+                    c1.add('reads', 4)
+                    c1.flush()
+                    c1.add('reads', 1)
+                    c1.maximum('longest', 10)
+                    c1.observe('lengths', 3)
+                    c1.flush()
+                    c2.add('reads', 2)
+                    c2.maximum('longest', 20)
+                    c2.observe('lengths', 2)
+                    c2.observe('lengths', 9)
+                    c2.flush()
+                    c3.add('junctions', 7)
+                    c3.flush()
+                    other.add('reads', 100)
+                    other.flush()
+                    # A Counter that crashed while writing leaves this
+                    with open(c3.metrics_file + '.temp', 'w') as temp_stream:
+                        temp_stream.write('{"group" : ')
+                    self.assertEqual(0, len(outp.getvalue()))
+                    collect_metrics(prefix)
+                    with open(prefix + '.counts') as count_stream:
+                        self.assertEqual(count_stream.read(),
+                                         'group_a reads 7\n'
+                                         'group_b junctions 7\n')
+                    with open(prefix + '.metrics') as metrics_stream:
+                        merged = json.load(metrics_stream)
+                    self.assertEqual(merged['group_a']['maxima'],
+                                     {'longest' : 20})
+                    self.assertEqual(
+                            merged['group_a']['histograms']['lengths'],
+                            {'buckets' : [[2, 2], [8, 1]], 'sum' : 14}
+                        )
+                    self.assertEqual(
+                            sorted(os.listdir(temp_dir)),
+                            sorted(['0.counts', '0.metrics',
+                                    os.path.basename(other.metrics_file)])
+                        )
+                finally:
+                    shutil.rmtree(temp_dir)
+
         unittest.main(argv=[sys.argv[0]])
         sys.exit(0)
@@ -49,15 +49,25 @@ import signal
 import socket
 import subprocess
 import glob
-import hashlib
+import zlib
 import tempfile
 import shutil
 import os
 import contextlib
-from tools import make_temp_dir, make_temp_dir_and_register_cleanup
+from tools import make_temp_dir, make_temp_dir_and_register_cleanup, which, \
+    ParallelGzipWriter, ParallelGzipReader, gzip_threads, \
+    _gzip_threads_variable, _gzip_block_size
+from records import MAGIC, RecordReader, body as record_body, decoded_key, \
+    is_record_stream
+from counters import collect_metrics, merged_metrics
+from profiler import merge_profiles
 from ansibles import Url
 import site
 import string
+import heapq
+import threading
+import re
+import Queue
 
 def add_args(parser):
     """ Adds args relevant to EMR simulator.
@@ -103,6 +113,14 @@ def add_args(parser):
             default=3,
             help='Level of gzip compression to use, if applicable.'
         )
+    parser.add_argument('--gzip-threads', type=int, required=False,
+            default=None,
+            help=('Number of threads compressing or decompressing each gzip '
+                  'stream in a task, including in streaming commands that '
+                  'open gzips with dooplicity.tools.xopen. By default, a '
+                  'machine\'s CPUs are divided among the processes running '
+                  'tasks on it.')
+        )
     parser.add_argument('--ipy', action='store_const', const=True,
             default=False,
             help=('Uses IPython Parallel controller and engines to execute '
@@ -148,6 +166,38 @@ def add_args(parser):
             help=('Path to sort executable. Add arguments as necessary, '
                   'e.g. for specifying a directory for storing sort\'s '
                   'temporary files.'))
+    parser.add_argument('--builtin-sort', action='store_const',
+            const=True, default=False,
+            help=('Sorts intermediates without UNIX sort: sorted runs are '
+                  'spilled while partitioning, and a k-way merge of the runs '
+                  'for a task is streamed directly to its reducer. '
+                  '--memcap caps memory used per partitioning process.'))
+    parser.add_argument('--dag', action='store_const',
+            const=True, default=False,
+            help=('Starts each step as soon as the steps whose outputs it '
+                  'reads have finished rather than after all previous steps, '
+                  'running independent steps at the same time; applies only '
+                  'when not in --ipy mode.'))
+    parser.add_argument('--warm-workers', action='store_const',
+            const=True, default=False,
+            help=('Keeps workers alive across tasks and runs a streaming '
+                  'command that\'s just a Python script in the worker '
+                  'itself, so modules and caches like loaded Bowtie indexes '
+                  'and manifests stay warm from task to task; the script '
+                  'must be run by the Python executing the simulator.'))
+    parser.add_argument('--speculative', action='store_const',
+            const=True, default=False,
+            help=('Once most of a step\'s tasks are done, starts a backup '
+                  'attempt of each straggling task on a free engine and '
+                  'keeps the output of whichever attempt finishes first; '
+                  'applies only in --ipy mode.'))
+    parser.add_argument('--profile', action='store_const',
+            const=True, default=False,
+            help=('Samples the stacks of streaming commands that are Python '
+                  'scripts on a CPU timer and writes each step\'s hotspots '
+                  'to profile.txt and its stacks in flamegraph.pl\'s folded '
+                  'format to profile.folded in the step\'s dp.map.log and '
+                  'dp.reduce.log directories.'))
 
 def init_worker():
     """ Prevents KeyboardInterrupt from reaching a pool's workers.
@@ -160,21 +210,21 @@ def init_worker():
     """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def yopen(gzipped, *args):
+def yopen(gzipped, *args, **kwargs):
     """ Passes args on to the appropriate opener, gzip or regular.
 
-        A dooplicity.tools.xopen that uses the gzip module, which is
-        unsafe for writing. See xopen's docstring in dooplicity.tools for
-        more information.
+        A dooplicity.tools.xopen for reading that isn't a context manager.
+        See xopen's docstring in dooplicity.tools for more information.
 
         gzipped: True iff gzip.open() should be used to open rather than
             open(); False iff open() should be used; None if input should be
             read and guessed
         *args: unnamed arguments to pass
+        **kwargs: threads, the number of threads decompressing a gzip;
+            gzip_threads() by default
 
         Return value: file object
     """
-    import gzip
     if gzipped is None:
         with open(args[0], 'rb') as binary_input_stream:
             # Check for magic number
@@ -183,10 +233,22 @@ def yopen(gzipped, *args):
             else:
                 gzipped = False
     if gzipped:
-        return gzip.open(*args)
+        return ParallelGzipReader(args[0],
+                                  threads=(kwargs.get('threads')
+                                            or gzip_threads()))
     return open(*args)
 
-def parsed_keys(partition_options, key_fields):
+def record_file(filename):
+    """ Checks whether a file, perhaps gzip'd, holds binary records.
+
+        filename: path to file
+
+        Return value: True iff file starts with dooplicity.records.MAGIC
+    """
+    with yopen(None, filename) as input_stream:
+        return is_record_stream(input_stream.read(len(MAGIC)))
+
+def parsed_keys(partition_options, key_fields, binary=False):
     """ Parses UNIX sort options to figure out what to partition on.
 
         Returned is a function that takes a line as input and returns a tuple
@@ -195,6 +257,8 @@ def parsed_keys(partition_options, key_fields):
 
         partition_options: UNIX sort options like -k1,1 -k3 -k3,4r -k 4 -k 5,3
         key_fields: number of fields from line to consider key
+        binary: True iff lines are binary records from dooplicity.records,
+            whose key fields are decoded to strings to partition on
 
         Return value: see above
     """
@@ -212,9 +276,11 @@ def parsed_keys(partition_options, key_fields):
     else:
         exec (
 """def partitioned_key(line, separator):
-    key = line.strip().split(separator)[:{key_fields}]
+    key = {fields}[:{key_fields}]
     return {return_value}
-""".format(key_fields=key_fields,
+""".format(fields=('decoded_key(line)' if binary
+                    else 'line.strip().split(separator)'),
+            key_fields=key_fields,
             return_value='+'.join(['key[{}:{}]'.format(
                                 arg[0], arg[1] + 1 if len(arg) == 2 else ''
                             ) for arg in parsed_args]))
@@ -222,27 +288,357 @@ def parsed_keys(partition_options, key_fields):
         return partitioned_key
 
 
-def gzip_into(gzip_level, outfn):
-    return subprocess.Popen('gzip -%d >%s' % (gzip_level, outfn),
-        shell=True, bufsize=-1,
-        executable='/bin/bash',
-        stdin=subprocess.PIPE)
+# Approximate number of bytes of input read at once when partitioning
+_partition_block_size = 16 * 1024 * 1024
+# Bytes of partitioned lines held in memory before writing to task files
+_partition_buffer_size = 64 * 1024 * 1024
+# Rough number of bytes of memory taken up by a buffered line beyond its length
+_line_overhead = 100
+'''Uncompressed bytes per gzip member of files kept open one per task or key,
+which are compressed on the writing thread to bound threads and memory.'''
+_task_gzip_block_size = 64 * 1024
+# Maximum number of sorted runs merged at once by the builtin sort
+_merge_fan_in = 256
+# Smallest byte range into which an oversized map input is split
+_min_split_size = 64 * 1024 * 1024
+# Fraction of a phase's tasks that must be done before stragglers are copied
+_speculation_start = 0.75
+# Multiple of the median task runtime after which a task is a straggler
+_speculation_slowdown = 1.5
+# Seconds a task must run before it can be a straggler
+_speculation_min_runtime = 60
+# Streaming commands with any of these characters can't run in warm workers
+_shell_syntax = re.compile(r'[|&;<>()$`\\\'"*?\[\]{}~#!\n]')
+# Step parameters naming files distributed to tasks from anywhere
+_cache_keys = ['files', 'archives', 'cacheFile', 'cacheArchive']
+# Matches an interpreter and a Python script at the start of a command
+_python_script = re.compile(r'\s*\S+\s+(?=\S+\.py(?:\s|$))')
+_profiler_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'profiler.py')
+_leading_number = re.compile(r'\s*(-?(?:\d+\.?\d*|\.\d+))')
+
+def numeric_key(field):
+    """ Mimics how UNIX sort -n interprets a field.
+
+        field: string
+
+        Return value: float given by any leading number in the field, or 0
+            if there is none
+    """
+    number = _leading_number.match(field)
+    if number is None:
+        return 0.
+    return float(number.group(1))
+
+def reversed_key(field):
+    """ Gives key that orders strings in reverse of C-locale order.
+
+        field: string
+
+        Return value: tuple of negated character codes terminated by a value
+            larger than any of them, so a string comes before its prefixes
+    """
+    return tuple([-ord(char) for char in field]) + (1,)
+
+def parsed_comparator(sort_options, separator):
+    """ Parses UNIX sort options to figure out how to order lines.
+
+        Returned is a function that takes a line as input and returns a tuple
+        whose order is the order in which LC_ALL=C sort -t<separator>
+        <sort_options> places the line, OR False if the args are invalid.
+        Only the -k pos1[,pos2] options with optional n and r modifiers that
+        Hadoop's KeyFieldBasedComparator recognizes are permitted. Like UNIX
+        sort, the whole line is compared as a last resort.
+
+        sort_options: UNIX sort options like -k1,1 -k2,2n -k3,4r
+        separator: separator between successive fields in a line
+
+        Return value: see above
+    """
+    try:
+        parsed_args = []
+        for arg in sort_options.split('-k'):
+            arg = arg.strip()
+            if not arg:
+                continue
+            modifiers = set([char for char in arg if char.isalpha()])
+            if not modifiers <= set('nr'):
+                raise ValueError
+            positions = [int(el.strip('nr')) - 1 for el in arg.split(',')]
+            if len(positions) > 2 or min(positions) < 0:
+                raise ValueError
+            parsed_args.append((positions[0],
+                                positions[1] + 1 if len(positions) == 2
+                                else '', 'n' in modifiers, 'r' in modifiers))
+        if sort_options.replace('-k', '').strip() and not parsed_args:
+            raise ValueError
+    except Exception:
+        # args are invalid
+        return False
+    key_exprs = []
+    for start, end, numeric, reverse in parsed_args:
+        field = 'separator.join(fields[{}:{}])'.format(start, end)
+        if numeric:
+            key_exprs.append(('-' if reverse else '')
+                                + 'numeric_key({})'.format(field))
+        elif reverse:
+            key_exprs.append('reversed_key({})'.format(field))
+        else:
+            key_exprs.append(field)
+    namespace = {'separator' : separator, 'numeric_key' : numeric_key,
+                 'reversed_key' : reversed_key}
+    exec (
+"""def sort_key(line):
+    if line[-1:] == '\\n':
+        line = line[:-1]
+    fields = line.split(separator)
+    return ({key_exprs}line,)
+""".format(key_exprs=''.join([key_expr + ', ' for key_expr in key_exprs]))
+    ) in namespace
+    return namespace['sort_key']
+
+def write_run(lines, outfn, gzip=False, gzip_level=3, combiner=None,
+                dir_to_path=None, binary=False):
+    """ Writes lines to a file, making sure each ends with a newline.
+
+        lines: list of lines, or of binary records if binary is True
+        outfn: output filename
+        gzip: True iff output should be gzipped
+        gzip_level: level of gzip compression to use, if applicable
+        combiner: command through which lines are piped before they're
+            written, or None if there is no combiner
+        dir_to_path: directory from which to run combiner, or None
+        binary: True iff lines are binary records from dooplicity.records;
+            the file then starts with MAGIC
+
+        No return value.
+    """
+    if binary:
+        lines = [MAGIC] + lines
+    elif lines and lines[-1][-1:] != '\n':
+        lines[-1] += '\n'
+    if combiner is not None:
+        combine_command = ' '.join([('set -eo pipefail; cd %s;' % dir_to_path)
+                                        if dir_to_path is not None
+                                        else 'set -eo pipefail;',
+                                    combiner,
+                                    ('| gzip -%d >%s' % (gzip_level, outfn))
+                                        if gzip else ('>%s' % outfn)])
+        with tempfile.TemporaryFile() as combiner_err_stream:
+            combine_process = subprocess.Popen(combine_command,
+                                                shell=True, bufsize=-1,
+                                                executable='/bin/bash',
+                                                stdin=subprocess.PIPE,
+                                                stderr=combiner_err_stream)
+            try:
+                combine_process.stdin.write(''.join(lines))
+            except IOError:
+                # Combiner died; its exit code is reported below
+                pass
+            finally:
+                combine_process.stdin.close()
+            combine_process_return = combine_process.wait()
+            if combine_process_return != 0:
+                combiner_err_stream.seek(0)
+                raise RuntimeError(('Error "%s" encountered combining run %s; '
+                                    'exit code was %d; command invoked was '
+                                    '"%s".') % (
+                                        combiner_err_stream.read().strip(),
+                                        outfn, combine_process_return,
+                                        combine_command
+                                    ))
+    elif gzip:
+        with gzip_into(gzip_level, outfn) as run_stream:
+            run_stream.writelines(lines)
+    else:
+        with open(outfn, 'w') as run_stream:
+            run_stream.write(''.join(lines))
+
+def merged_lines(input_files, sort_key, binary=False):
+    """ Performs k-way merge of sorted files.
+
+        input_files: list of files, each sorted according to sort_key; any
+            may be gzipped
+        sort_key: function like that returned by parsed_comparator()
+        binary: True iff files hold binary records from dooplicity.records;
+            MAGIC is then yielded first
+
+        Yield value: next line in merged order, always ending in a newline,
+            or next binary record
+    """
+    input_streams = [yopen(None, input_file) for input_file in input_files]
+    try:
+        if binary:
+            readlines = [RecordReader(input_stream).readrecord
+                            for input_stream in input_streams]
+            yield MAGIC
+        else:
+            readlines = [input_stream.readline
+                            for input_stream in input_streams]
+        heap = []
+        for i, readline in enumerate(readlines):
+            line = readline()
+            if line:
+                heap.append((sort_key(line), i, line))
+        heapq.heapify(heap)
+        while heap:
+            _, i, line = heap[0]
+            yield line if binary or line[-1:] == '\n' else line + '\n'
+            line = readlines[i]()
+            if line:
+                heapq.heapreplace(heap, (sort_key(line), i, line))
+            else:
+                heapq.heappop(heap)
+    finally:
+        for input_stream in input_streams:
+            input_stream.close()
+
+def premerged_runs(input_files, sort_key, temp_dir, gzip=False, gzip_level=3,
+                    fan_in=_merge_fan_in, binary=False):
+    """ Merges sorted runs in batches until at most fan_in of them are left.
+
+        Keeps the number of files open at once by merged_lines() bounded.
+
+        input_files: list of sorted files
+        sort_key: function like that returned by parsed_comparator()
+        temp_dir: where to write merged runs
+        gzip: True iff merged runs should be gzipped
+        gzip_level: level of gzip compression to use, if applicable
+        fan_in: maximum number of runs to merge at once
+        binary: True iff runs hold binary records from dooplicity.records
+
+        Return value: list of at most fan_in sorted files
+    """
+    input_files = list(input_files)
+    merge_count = 0
+    while len(input_files) > fan_in:
+        merged_file = os.path.join(temp_dir, '%d%s' % (merge_count,
+                                                       '.gz' if gzip else ''))
+        if gzip:
+            merge_stream = gzip_into(gzip_level, merged_file)
+        else:
+            merge_stream = open(merged_file, 'w')
+        try:
+            merge_stream.writelines(
+                    merged_lines(input_files[:fan_in], sort_key, binary)
+                )
+        finally:
+            merge_stream.close()
+        input_files = input_files[fan_in:] + [merged_file]
+        merge_count += 1
+    return input_files
+
+def feed_lines(lines, output_stream, errors):
+    """ Writes lines to a stream, then closes it; meant to run in a thread.
+
+        lines: iterable of lines
+        output_stream: where to write lines; typically a process's stdin
+        errors: list to which any error message is appended
+
+        No return value.
+    """
+    try:
+        output_stream.writelines(lines)
+    except IOError as e:
+        import errno
+        if e.errno != errno.EPIPE:
+            # Broken pipe means the process is done reading; else report
+            from traceback import format_exc
+            errors.append(format_exc())
+    except Exception:
+        from traceback import format_exc
+        errors.append(format_exc())
+    finally:
+        try:
+            output_stream.close()
+        except IOError:
+            pass
+
+def gzip_into(gzip_level, outfn, threads=None, block_size=_gzip_block_size):
+    """ Opens a gzip for writing that's compressed on background threads.
+
+        gzip_level: level of gzip compression to use
+        outfn: path to file
+        threads: number of threads compressing, or None for gzip_threads();
+            0 compresses on the writing thread
+        block_size: number of uncompressed bytes per gzip member
+
+        Return value: file object
+    """
+    return ParallelGzipWriter(outfn, 'w', gzip_level,
+                              threads=(gzip_threads() if threads is None
+                                        else threads),
+                              block_size=block_size)
+
+def set_gzip_threads(threads=None, process_count=1):
+    """ Sets threads (de)compressing each gzip stream in tasks.
+
+        The number is stored in the environment, so it applies both to this
+        process and to streaming commands it starts, which read it with
+        dooplicity.tools.xopen.
+
+        threads: number of threads, or None to divide this machine's CPUs
+            among process_count processes
+        process_count: number of processes running tasks on this machine
+
+        Return value: number of threads
+    """
+    import os
+    import multiprocessing
+    if threads is None:
+        threads = multiprocessing.cpu_count() // max(process_count, 1)
+    threads = max(threads, 1)
+    os.environ[_gzip_threads_variable] = str(threads)
+    return threads
+
+def partition_hash(key, seed=0):
+    """ Hashes a key for assigning it to a task.
+
+        CRC32 is used because it's computed in C, is stable across runs,
+        platforms, and Python versions (unlike hash()), and is much faster
+        than the MD5 digest that used to be used here. The result is masked
+        so it's nonnegative everywhere.
+
+        key: string to hash
+        seed: starting value of CRC; a different seed gives a different
+            but equally reproducible task assignment
+
+        Return value: nonnegative integer hash of key
+    """
+    return zlib.crc32(key, seed) & 0xffffffff
 
 
 def presorted_tasks(input_files, process_id, sort_options, output_dir,
                     key_fields, separator, partition_options, task_count,
                     memcap, gzip=False, gzip_level=3, scratch=None,
                     direct_write=False, sort='sort', mod_partition=False,
-                    max_attempts=4):
+                    builtin_sort=False, seed=0, combiner=None,
+                    dir_to_path=None, max_attempts=4):
     """ Partitions input data into tasks and presorts them.
 
         Files in output directory are in the format x.y, where x is a task
         number on the interval [0, number of tasks - 1], and y is a process
         ID that identifies which process created the file. y is unimportant;
-        the glob x.* should be catted to the reducer.
+        the glob x.* should be catted to the reducer. If builtin_sort is True,
+        files are in the format x.y.z, where z numbers the sorted runs spilled
+        for task x by process y; these are merged by the reducer. If there's
+        a combiner, it's run on every sorted task file (or run) before it's
+        written, as Hadoop runs a combiner on sorted map output. Input files
+        of binary records from dooplicity.records are always partitioned as
+        if builtin_sort were True, and their records are sorted by body,
+        which orders them by key as sort_options do; sort_options that
+        reverse (r) a field, a combiner, and inputs that mix binary records
+        with text lines are errors.
 
         Formula for computing task assignment: 
-            int(hashlib.md5(key).hexdigest(), 16) % (task_count)
+            partition_hash(key, seed) % (task_count)
+
+        Input is read in blocks of about _partition_block_size bytes, and
+        lines destined for each task are held in buffers managed here that
+        are written out all at once whenever their total size exceeds
+        _partition_buffer_size, or memcap KB if builtin_sort is True. In the
+        latter case, each buffer is sorted before it's written, so no
+        separate presort pass is needed.
 
         input_files: list of files on which to operate.
         process_id: unique identifier for current process.
@@ -252,7 +648,9 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         separator: separator between successive fields from line.
         partition_options: sort-like options to use when partitioning.
         task_count: number of tasks in which to partition input.
-        memcap: maximum percent of memory to use per UNIX sort instance.
+        memcap: maximum amount of memory (in KB, as for UNIX sort's -S) to
+            use per UNIX sort instance, or per partitioning process if
+            builtin_sort is True.
         gzip: True iff all files written should be gzipped; else False.
         gzip_level: Level of gzip compression to use, if applicable.
         scratch: where to write output before copying to output_dir. If "-"
@@ -263,6 +661,12 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         sort: path to sort executable
         mod_partition: if True, task is assigned according to formula
             (product of fields) % task_count
+        builtin_sort: if True, spills sorted runs rather than invoking UNIX
+            sort on each task file
+        seed: seed of hash function used to assign keys to tasks
+        combiner: streaming command that combines sorted lines for each task
+            before they're written, or None if there is no combiner
+        dir_to_path: directory from which to run combiner, or None
         max_attempts: maximum number of times to attempt partitioning input.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
@@ -274,8 +678,6 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         task_streams = {}
         if scratch is not None:
             scratch = os.path.expanduser(os.path.expandvars(scratch))
-        if gzip:
-            task_stream_processes = {}
         if direct_write:
             final_output_dir = output_dir
         elif scratch == '-':
@@ -306,62 +708,146 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
             final_output_dir = output_dir
         output_dir = os.path.expandvars(output_dir)
         final_output_dir = os.path.expandvars(final_output_dir)
-        partitioned_key = parsed_keys(partition_options, separator)
+        binary_inputs = [record_file(input_file)
+                            for input_file in input_files]
+        binary = any(binary_inputs)
+        if binary and not all(binary_inputs):
+            return ('Input files %s mix binary records with text lines; '
+                    'all of a step\'s input must be one or the other.'
+                        % ', '.join(input_files))
+        if binary:
+            '''Records are sorted by body, which orders them as plain and
+            numeric (n) -k options do, but not in reverse (r).'''
+            if (not parsed_comparator(sort_options, separator)
+                    or 'r' in sort_options.replace('-k', '')):
+                return ('Sort options "%s" are unsupported for binary '
+                        'records, which can only be sorted by key in '
+                        'ascending order.' % sort_options)
+            if combiner is not None:
+                return ('Combiner "%s" can\'t be run on binary records, '
+                        'which it would read as text.' % combiner)
+            # UNIX sort can't sort binary records
+            builtin_sort = True
+        partitioned_key = parsed_keys(partition_options, key_fields, binary)
         if not partitioned_key:
             # Invalid partition options
             return ('Partition options "%s" are invalid.' % partition_options)
+        if binary:
+            sort_key = record_body
+            buffer_size = memcap * 1024
+        elif builtin_sort:
+            sort_key = parsed_comparator(sort_options, separator)
+            if not sort_key:
+                return ('Sort options "%s" are invalid.' % sort_options)
+            buffer_size = memcap * 1024
+        else:
+            buffer_size = _partition_buffer_size
+        block_size = min(_partition_block_size, buffer_size)
+        task_buffers = {}
+        buffered_bytes = 0
+        run_counts = defaultdict(int)
+        def flush_task_buffers():
+            """ Writes all buffered lines to task files and clears buffers.
+
+                No return value.
+            """
+            if builtin_sort:
+                for task in task_buffers:
+                    task_buffers[task].sort(key=sort_key)
+                    write_run(task_buffers[task], os.path.abspath(
+                                    os.path.join(
+                                        output_dir, '%d.%s.%d%s' % (
+                                                task, process_id,
+                                                run_counts[task],
+                                                '.gz' if gzip else ''
+                                            )
+                                    )
+                                ), gzip=gzip, gzip_level=gzip_level,
+                                combiner=combiner, dir_to_path=dir_to_path,
+                                binary=binary)
+                    run_counts[task] += 1
+                task_buffers.clear()
+                return
+            for task in task_buffers:
+                try:
+                    task_stream = task_streams[task]
+                except KeyError:
+                    # Task file doesn't exist yet; create it
+                    if gzip:
+                        task_file = os.path.join(output_dir, str(task) +
+                                                    '.' + str(process_id)
+                                                    + '.unsorted.gz')
+                        task_stream = task_streams[task] = gzip_into(
+                                gzip_level, task_file, threads=0,
+                                block_size=_task_gzip_block_size
+                            )
+                    else:
+                        task_file = os.path.join(output_dir, str(task) +
+                                                    '.' + str(process_id)
+                                                    + '.unsorted')
+                        task_stream = task_streams[task] = open(task_file, 'w')
+                task_stream.write(''.join(task_buffers[task]))
+            task_buffers.clear()
         for input_file in input_files:
             with yopen(None, input_file) as input_stream:
-                for line in input_stream:
-                    key = partitioned_key(line, separator)
-                    if mod_partition and len(key) <= 1:
-                        try:
-                            task = abs(int(key[0])) % task_count
-                        except (IndexError, ValueError):
-                            # Null key or some field doesn't work with this
-                            task = int(
-                                hashlib.md5(separator.join(key)).hexdigest(),
-                                16
-                            ) % task_count
-                    else:
-                        task = int(
-                            hashlib.md5(separator.join(key)).hexdigest(), 16
-                        ) % task_count
-                    try:
-                        task_streams[task].write(line)
-                    except KeyError:
-                        # Task file doesn't exist yet; create it
-                        if gzip:
-                            task_file = os.path.join(output_dir, str(task) +
-                                                        '.' + str(process_id)
-                                                        + '.unsorted.gz')
-                            task_stream_processes[task] = gzip_into(gzip_level, task_file)
-                            task_streams[task] \
-                                = task_stream_processes[task].stdin
+                if binary:
+                    readlines = RecordReader(input_stream).readrecords
+                else:
+                    readlines = input_stream.readlines
+                while True:
+                    lines = readlines(block_size)
+                    if not lines:
+                        break
+                    for line in lines:
+                        key = partitioned_key(line, separator)
+                        if mod_partition and len(key) <= 1:
+                            try:
+                                task = abs(int(key[0])) % task_count
+                            except (IndexError, ValueError):
+                                # Null key or some field doesn't work with this
+                                task = partition_hash(
+                                        separator.join(key), seed
+                                    ) % task_count
                         else:
-                            task_file = os.path.join(output_dir, str(task) +
-                                                        '.' + str(process_id)
-                                                        + '.unsorted')
-                            task_streams[task] = open(task_file, 'w')
-                        task_streams[task].write(line)
+                            task = partition_hash(
+                                    separator.join(key), seed
+                                ) % task_count
+                        try:
+                            task_buffers[task].append(line)
+                        except KeyError:
+                            task_buffers[task] = [line]
+                        buffered_bytes += len(line) + _line_overhead
+                    if buffered_bytes >= buffer_size:
+                        flush_task_buffers()
+                        buffered_bytes = 0
+        flush_task_buffers()
         for task in task_streams:
             task_streams[task].close()
-        if gzip:
-            for task in task_stream_processes:
-                task_stream_processes[task].wait()
+        if builtin_sort:
+            # Runs were sorted as they were spilled
+            return None
         # Presort task files
+        if combiner is not None:
+            combine_command = ' | %s' % combiner
+            cd_command = (('cd %s; ' % dir_to_path)
+                            if dir_to_path is not None else '')
+        else:
+            combine_command = cd_command = ''
         if gzip:
             for unsorted_file in glob.glob(os.path.join(
-                                                    output_dir,
+                                                    os.path.abspath(
+                                                        output_dir
+                                                    ),
                                                     '*.%s.unsorted.gz'
                                                     % process_id
                                                 )):
-                sort_command = (('set -eo pipefail; gzip -cd %s | '
-                                 'LC_ALL=C %s -S %d %s -t$\'%s\' | '
+                sort_command = (('set -eo pipefail; %sgzip -cd %s | '
+                                 'LC_ALL=C %s -S %d %s -t$\'%s\'%s | '
                                  'gzip -c -%d >%s')
-                                    % (unsorted_file, sort, memcap,
+                                    % (cd_command, unsorted_file, sort, memcap,
                                         sort_options,
                                         separator.encode('string_escape'),
+                                        combine_command,
                                         gzip_level,
                                         unsorted_file[:-12] + '.gz'))
                 try:
@@ -380,17 +866,22 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
                     os.remove(unsorted_file)
         else:
             for unsorted_file in glob.glob(os.path.join(
-                                                    output_dir,
+                                                    os.path.abspath(
+                                                        output_dir
+                                                    ),
                                                     '*.%s.unsorted'
                                                     % process_id
                                                 )):
-                sort_command = 'LC_ALL=C %s -S %d %s -t$\'%s\' %s >%s' % (
+                sort_command = ('set -eo pipefail; %sLC_ALL=C %s -S %d %s '
+                                '-t$\'%s\' %s%s >%s') % (
+                                                            cd_command,
                                                             sort, memcap,
                                                             sort_options,
                                                             separator.encode(
                                                                 'string_escape'
                                                             ),
                                                             unsorted_file,
+                                                            combine_command,
                                                             unsorted_file[:-9]
                                                         )
                 try:
@@ -438,20 +929,388 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
             shutil.rmtree(output_dir)
 
 
-def counter_cmd(outfn):
-    return ("grep '^reporter:counter:' | "
-            "sed 's/.*://' | "
-            "awk -v FS=',' "
-            "'{tot[$1,\" \",$2] += $3} END "
-            "{for(d in tot) {print d,tot[d]}}' > %s") % outfn
+def commit_task_output(attempt_dir, output_dir, claim_file):
+    """ Moves a task attempt's output into place if no other attempt has.
+
+        An attempt claims a task by exclusively creating claim_file, which is
+        atomic even when attempts run on different nodes. The winner renames
+        its files into output_dir; every other attempt deletes its output.
+
+        attempt_dir: directory with the attempt's output; it's deleted
+        output_dir: final destination of output
+        claim_file: path to file whose existence marks the task committed
+
+        Return value: None iff output is committed or discarded successfully;
+            otherwise error message.
+    """
+    import errno
+    try:
+        try:
+            os.close(os.open(claim_file,
+                                os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return ('Problem encountered claiming output of task with '
+                        '%s: %s' % (claim_file, e))
+            # Another attempt already committed
+            return None
+        try:
+            for root, dirnames, filenames in os.walk(attempt_dir):
+                destination = os.path.join(
+                                    output_dir,
+                                    os.path.relpath(root, attempt_dir)
+                                )
+                try:
+                    os.makedirs(destination)
+                except OSError:
+                    # Directory already exists
+                    pass
+                for filename in filenames:
+                    os.rename(
+                            os.path.join(root, filename),
+                            os.path.join(destination, filename)
+                        )
+        except OSError as e:
+            # Let a retry commit instead
+            try:
+                os.remove(claim_file)
+            except OSError:
+                pass
+            return ('Problem encountered committing output of task to '
+                    '%s: %s' % (output_dir, e))
+        return None
+    finally:
+        shutil.rmtree(attempt_dir, ignore_errors=True)
+
+def write_multiple_outputs(lines, output_dir, task_id, separator, gzip=False,
+                            gzip_level=3):
+    """ Writes each line to a file in the subdirectory named by its key.
+
+        lines: iterable of lines; each line's key is what precedes its first
+            separator, and the key and separator aren't written
+        output_dir: directory in which to create key subdirectories
+        task_id: name of file written in each key subdirectory
+        separator: separator between key and the rest of a line
+        gzip: True iff files written should be gzipped; else False.
+        gzip_level: level of gzip compression to use, if applicable.
+
+        Return value: None iff all lines were written; otherwise, key
+            subdirectory that couldn't be created
+    """
+    task_file_streams = {}
+    try:
+        for line in lines:
+            key, _, line_to_write = line.partition(separator)
+            try:
+                task_file_streams[key].write(line_to_write)
+            except KeyError:
+                '''Must create new file, but another process could have
+                created the output directory.'''
+                key_dir = os.path.join(output_dir, key)
+                try:
+                    os.makedirs(key_dir)
+                except OSError:
+                    if not os.path.exists(key_dir):
+                        return key_dir
+                if gzip:
+                    task_file_streams[key] = gzip_into(gzip_level,
+                        os.path.join(key_dir, str(task_id) + '.gz'),
+                        threads=0, block_size=_task_gzip_block_size)
+                else:
+                    task_file_streams[key] = open(
+                            os.path.join(key_dir, str(task_id)), 'w'
+                        )
+                task_file_streams[key].write(line_to_write)
+        return None
+    finally:
+        for key in task_file_streams:
+            task_file_streams[key].close()
+
+def warm_script_args(streaming_command, dir_to_path=None):
+    """ Checks whether a streaming command can run in a warm worker.
+
+        It can if it's nothing more than the Python interpreter running this
+        process executing a script with some arguments: no pipes, redirects,
+        quoting, or substitutions.
+
+        streaming_command: streaming command
+        dir_to_path: directory from which streaming command is run, or None
+            if it's run from the current working directory
+
+        Return value: list [script, arg 1, arg 2, ...] if streaming command
+            can run in process; otherwise None
+    """
+    if _shell_syntax.search(streaming_command):
+        return None
+    tokens = streaming_command.split()
+    if len(tokens) < 2 or not tokens[1].endswith('.py'):
+        return None
+    if os.sep in tokens[0] and dir_to_path is not None:
+        interpreter = which(os.path.join(dir_to_path, tokens[0]))
+    else:
+        interpreter = which(tokens[0])
+    if interpreter is None or (os.path.realpath(interpreter)
+                                != os.path.realpath(sys.executable)):
+        return None
+    return tokens[1:]
+
+def profiled_command(streaming_command):
+    """ Has a streaming command that runs a Python script run it through
+        profiler.py.
+
+        streaming_command: streaming command
+
+        Return value: streaming command with profiler.py inserted between
+            interpreter and script, or streaming command unchanged if it
+            doesn't start with an interpreter and a script
+    """
+    interpreter = _python_script.match(streaming_command)
+    if interpreter is None:
+        return streaming_command
+    return ''.join([interpreter.group(0), _profiler_script, ' ',
+                    streaming_command[interpreter.end():]])
+
+def set_cloexec(fd):
+    """ Keeps a file descriptor from being inherited by subprocesses.
+
+        fd: file descriptor
+
+        No return value.
+    """
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def run_script_in_process(script_args, input_fd, output_fd, error_fd,
+                            env=None, cwd=None):
+    """ Runs a Python script in this process as though it were the main
+        program.
 
+        Modules the script imports stay imported afterward, so a process
+        running the same script over and over imports them once, and caches
+        they keep, like bowtie_index.cached_reference()'s, stay warm. The
+        script's argv, environment, working directory, standard streams, and
+        signal handlers are swapped in for the run and back out after it,
+        and exit functions it registers run when it's done.
+
+        script_args: list [script, arg 1, arg 2, ...]
+        input_fd: file descriptor script reads as stdin
+        output_fd: file descriptor script writes as stdout
+        error_fd: file descriptor script writes as stderr
+        env: script's environment, or None if it's this process's
+        cwd: script's working directory, or None if it's this process's
+
+        Return value: script's exit level
+    """
+    import atexit
+    import imp
+    from traceback import print_exc
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(fd) for fd in [0, 1, 2]]
+    saved_streams = sys.stdin, sys.stdout, sys.stderr
+    saved_argv, saved_path = sys.argv, sys.path[:]
+    saved_main = sys.modules['__main__']
+    saved_environ, saved_cwd = os.environ.copy(), os.getcwd()
+    saved_handlers = [(signum, signal.getsignal(signum))
+                        for signum in [signal.SIGTERM, signal.SIGHUP]]
+    exit_function_count = len(atexit._exithandlers)
+    exit_level = 0
+    try:
+        for fd, new_fd in enumerate([input_fd, output_fd, error_fd]):
+            os.dup2(new_fd, fd)
+        sys.stdin = os.fdopen(os.dup(0), 'r')
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        if cwd is not None:
+            os.chdir(cwd)
+        script_path = os.path.abspath(script_args[0])
+        sys.argv = [script_path] + script_args[1:]
+        sys.path.insert(0, os.path.dirname(script_path))
+        # Script's globals must outlive it for its exit functions
+        script = imp.new_module('__main__')
+        script.__file__ = script_path
+        sys.modules['__main__'] = script
+        try:
+            execfile(script_path, script.__dict__)
+        except SystemExit as e:
+            if e.code is None:
+                exit_level = 0
+            elif isinstance(e.code, int):
+                exit_level = e.code
+            else:
+                print >>sys.stderr, e.code
+                exit_level = 1
+        except Exception:
+            print_exc()
+            exit_level = 1
+        exit_functions = atexit._exithandlers[exit_function_count:]
+        del atexit._exithandlers[exit_function_count:]
+        while exit_functions:
+            exit_function, args, kwargs = exit_functions.pop()
+            try:
+                exit_function(*args, **kwargs)
+            except SystemExit:
+                pass
+            except Exception:
+                print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except IOError:
+            pass
+        if sys.stdin is not saved_streams[0]:
+            sys.stdin.close()
+        sys.stdin, sys.stdout, sys.stderr = saved_streams
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        sys.modules['__main__'] = saved_main
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+        for signum, handler in saved_handlers:
+            if handler is not None:
+                signal.signal(signum, handler)
+        for fd, saved_fd in enumerate(saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+    return exit_level
+
+def run_warm_task(streaming_command, script_args, prefix, prefix_input,
+                    merged_input, output_dir, err_file, task_id,
+                    multiple_outputs, separator, gzip=False, gzip_level=3,
+                    env=None, dir_to_path=None):
+    """ Runs a task with its streaming command executing in this process.
+
+        Everything else a task does, like reading its input and compressing
+        its output, still happens in subprocesses and threads wired to the
+        streaming command with pipes.
+
+        streaming_command: streaming command, for error messages
+        script_args: streaming command's script and arguments from
+            warm_script_args()
+        prefix: command whose output is streaming command's input, or None
+            if merged_input is streaming command's input
+        prefix_input: file object prefix reads as stdin, or None if prefix
+            reads nothing from stdin
+        merged_input: iterable of input lines if prefix is None
+        output_dir: directory in which to write output.
+        err_file: file to which streaming command's stderr is written
+        task_id: unique numerical identifer for task; determines output
+            filename
+        multiple_outputs: True if output should be divided by key before
+            first instance of separator
+        separator: character separating successive fields in a line
+        gzip: True iff all files written should be gzipped; else False.
+        gzip_level: Level of gzip compression to use, if applicable.
+        env: streaming command's environment
+        dir_to_path: directory from which to run streaming command, or None
+
+        Return value: None iff task runs successfully; otherwise error message.
+    """
+    shell_prefix = (('set -eo pipefail; cd %s;' % dir_to_path)
+                        if dir_to_path is not None else 'set -eo pipefail;')
+    threads, thread_errors, uncreated_dirs = [], [], []
+    input_process = output_process = None
+    with open(os.devnull, 'w') as devnull_stream:
+        if prefix is None:
+            input_fd, feed_fd = os.pipe()
+            set_cloexec(feed_fd)
+            threads.append(threading.Thread(target=feed_lines,
+                                            args=(merged_input,
+                                                    os.fdopen(feed_fd, 'w'),
+                                                    thread_errors)))
+        else:
+            input_process = subprocess.Popen(
+                    ' '.join([shell_prefix, prefix]), shell=True,
+                    stdin=prefix_input, stdout=subprocess.PIPE,
+                    stderr=devnull_stream, env=env, bufsize=-1,
+                    close_fds=True, executable='/bin/bash'
+                )
+            input_fd = os.dup(input_process.stdout.fileno())
+            input_process.stdout.close()
+        set_cloexec(input_fd)
+        error_stream = open(err_file, 'w')
+        set_cloexec(error_stream.fileno())
+        if multiple_outputs:
+            split_fd, output_fd = os.pipe()
+            set_cloexec(split_fd)
+            def split_output():
+                """ Writes streaming command's output by key. """
+                try:
+                    with os.fdopen(split_fd) as split_stream:
+                        uncreated_dirs.append(write_multiple_outputs(
+                                split_stream, output_dir, task_id, separator,
+                                gzip, gzip_level
+                            ))
+                except Exception:
+                    from traceback import format_exc
+                    thread_errors.append(format_exc())
+            threads.append(threading.Thread(target=split_output))
+        else:
+            if gzip:
+                output_command = 'gzip -%d >%s' % (
+                        gzip_level, os.path.abspath(
+                                os.path.join(output_dir, str(task_id) + '.gz')
+                            )
+                    )
+            else:
+                output_command = 'cat >%s' % os.path.abspath(
+                        os.path.join(output_dir, str(task_id))
+                    )
+            output_process = subprocess.Popen(
+                    output_command, shell=True, stdin=subprocess.PIPE,
+                    close_fds=True, executable='/bin/bash'
+                )
+            output_fd = os.dup(output_process.stdin.fileno())
+            output_process.stdin.close()
+        set_cloexec(output_fd)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        exit_level = 1
+        try:
+            exit_level = run_script_in_process(
+                    script_args, input_fd, output_fd,
+                    error_stream.fileno(), env, dir_to_path
+                )
+        finally:
+            # Closing these ends lets the other stages finish
+            os.close(input_fd)
+            os.close(output_fd)
+            error_stream.close()
+            for thread in threads:
+                thread.join()
+            exit_levels = [exit_level] + [
+                    process.wait() for process
+                    in [input_process, output_process]
+                    if process is not None
+                ]
+    if thread_errors:
+        return (('Error\n\n%s\nencountered streaming input to or output '
+                 'from streaming command "%s".')
+                 % (thread_errors[0], streaming_command))
+    if uncreated_dirs and uncreated_dirs[0] is not None:
+        return (('Streaming command "%s" failed: problem encountered '
+                 'creating output directory %s.') % (streaming_command,
+                                                     uncreated_dirs[0]))
+    for stage_exit_level in exit_levels:
+        if stage_exit_level != 0:
+            return (('Streaming command "%s" failed; exit level was %d.')
+                     % (streaming_command, stage_exit_level))
+    return None
 
 def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                   err_dir, counter_dir, task_id, multiple_outputs,
                                   separator, sort_options, memcap,
                                   gzip=False, gzip_level=3, scratch=None,
                                   direct_write=False, sort='sort',
-                                  dir_to_path=None, attempt_number=None):
+                                  dir_to_path=None, builtin_sort=False,
+                                  input_range=None, commit=False,
+                                  warm=False, profile=False,
+                                  attempt_number=None):
     """ Runs a streaming command on a task, segregating multiple outputs. 
 
         streaming_command: streaming command to run.
@@ -483,13 +1342,51 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
             no matter what scratch is.
         sort: path to sort executable.
         dir_to_path: path to add to PATH.
+        builtin_sort: if True and sort_options is not None, input files are
+            sorted runs spilled by presorted_tasks(); they are merged here
+            and streamed to the streaming command's stdin rather than
+            merged with unix sort -m. Runs of binary records from
+            dooplicity.records are always merged this way.
+        input_range: None if all of input_glob should be read; otherwise,
+            tuple (start, end) of byte offsets into a single uncompressed
+            input file delimiting the lines a mapper should read
+        commit: True iff output should be written to a private directory and
+            committed atomically by commit_task_output(), so concurrent
+            attempts at the same task don't clobber each other
+        warm: True iff streaming command should run in this process if
+            warm_script_args() says it can
+        profile: True iff streaming command should be run through
+            profiler.py if it's a Python script, writing stacks to err_dir
         attempt_number: attempt number of current task or None if no retries.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
 
         Return value: None iff step runs successfully; otherwise error message.
     """
+    if commit:
+        '''Attempt's directory is beside the log so output can be renamed
+        into place.'''
+        try:
+            attempt_dir = tempfile.mkdtemp(dir=err_dir, prefix='dp.attempt.')
+        except OSError as e:
+            return ('Problem encountered creating directory for task '
+                    'attempt in %s: %s' % (err_dir, e))
+        return_value = step_runner_with_error_return(
+                streaming_command, input_glob, attempt_dir, err_dir,
+                counter_dir, task_id, multiple_outputs, separator,
+                sort_options, memcap, gzip, gzip_level, scratch, direct_write,
+                sort, dir_to_path, builtin_sort, input_range, False, warm,
+                profile, attempt_number
+            )
+        if return_value is not None:
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+            return return_value
+        return commit_task_output(
+                attempt_dir, output_dir,
+                os.path.join(err_dir, '%d.commit' % task_id)
+            )
     command_to_run = None
+    range_stream = None
     try:
         if direct_write:
             final_output_dir = output_dir
@@ -527,7 +1424,17 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         if not input_files:
             # No input!
             return None
-        if sort_options is None:
+        # Binary records are sorted and merged only by the builtin sort
+        binary = sort_options is not None and any(
+                record_file(input_file) for input_file in input_files
+            )
+        if sort_options is None and input_range is not None:
+            '''Mapper on a split of an input file. head reads the split from
+            stdin, which starts at the split.'''
+            range_stream = open(input_glob, 'rb')
+            range_stream.seek(input_range[0])
+            prefix = 'head -c %d' % (input_range[1] - input_range[0])
+        elif sort_options is None:
             # Mapper. Check if first input file is gzip'd
             with open(input_files[0], 'rb') as binary_input_stream:
                 if binary_input_stream.read(2) == '\x1f\x8b':
@@ -535,6 +1442,24 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                     prefix = 'gzip -cd %s' % input_glob
                 else:
                     prefix = 'cat %s' % input_glob
+        elif builtin_sort or binary:
+            # Reducer. Merge sorted runs here, feeding them to stdin.
+            if binary:
+                sort_key = record_body
+            else:
+                sort_key = parsed_comparator(sort_options, separator)
+            if not sort_key:
+                return ('Sort options "%s" are invalid.' % sort_options)
+            merge_dir = make_temp_dir(
+                                None if scratch in [None, '-'] else scratch
+                            )
+            merged_input = merged_lines(
+                    premerged_runs(sorted(input_files), sort_key, merge_dir,
+                                    gzip=gzip, gzip_level=gzip_level,
+                                    binary=binary),
+                    sort_key, binary
+                )
+            prefix = None
         else:
             # Reducer. Merge sort the input glob.
             if gzip:
@@ -560,102 +1485,127 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                                 )
                                             )
                                         ))
-        counter_file = os.path.abspath(os.path.join(counter_dir, (
-                                            ('%d.counts' % task_id)
+        metrics_prefix = os.path.abspath(os.path.join(counter_dir, (
+                                            str(task_id)
                                                 if attempt_number is None
-                                                else ('%d.%d.counts'
+                                                else ('%d.%d'
                                                     % (task_id, attempt_number)
                                                 )
                                             )
                                         ))
         new_env = os.environ.copy()
+        # Counters write metrics files collected when the task is done
+        new_env['dooplicity_metrics_prefix'] = metrics_prefix
+        if profile:
+            new_env['dooplicity_profile_prefix'] = err_file[:-len('.log')]
+            streaming_command = profiled_command(streaming_command)
         new_env['mapreduce_task_partition'] \
             = new_env['mapred_task_partition'] = str(task_id)
+        script_args = (warm_script_args(streaming_command, dir_to_path)
+                        if warm else None)
+        if script_args is not None:
+            return run_warm_task(
+                    streaming_command, script_args, prefix, range_stream,
+                    merged_input if prefix is None else None, output_dir,
+                    err_file, task_id, multiple_outputs,
+                    separator, gzip, gzip_level, new_env, dir_to_path
+                )
+        if prefix is not None:
+            streaming_command = prefix + ' | ' + streaming_command
+        feeder_errors = []
         if multiple_outputs:
             # Must grab each line of output and separate by directory
             command_to_run \
-                = prefix + ' | ' + streaming_command + (
-                        ' 2> >(tee %s | %s)'
-                    ) % (err_file, counter_cmd(counter_file))
-            # Need bash or zsh for process substitution
+                = streaming_command + ' 2>%s' % err_file
             multiple_output_process = subprocess.Popen(
                     ' '.join([('set -eo pipefail; cd %s;' % dir_to_path)
                                 if dir_to_path is not None
                                 else 'set -eo pipefail;',
                               command_to_run]),
                     shell=True,
+                    stdin=(subprocess.PIPE if prefix is None
+                            else range_stream),
                     stdout=subprocess.PIPE,
                     stderr=open(os.devnull, 'w'),
                     env=new_env,
                     bufsize=-1,
                     executable='/bin/bash'
                 )
-            task_file_streams = {}
-            if gzip:
-                task_file_stream_processes = {}
-            for line in multiple_output_process.stdout:
-                key, _, line_to_write = line.partition(separator)
-                try:
-                    task_file_streams[key].write(line_to_write)
-                except KeyError:
-                    '''Must create new file, but another process could have
-                    created the output directory.'''
-                    key_dir = os.path.join(output_dir, key)
-                    try:
-                        os.makedirs(key_dir)
-                    except OSError:
-                        if not os.path.exists(key_dir):
-                            return (('Streaming command "%s" failed: problem '
-                                     'encountered creating output '
-                                     'directory %s.') % (command_to_run,
-                                                          key_dir))
-                    if gzip:
-                        task_file_stream_processes[key] = gzip_into(gzip_level,
-                            os.path.join(key_dir, str(task_id) + '.gz'))
-                        task_file_streams[key] \
-                            = task_file_stream_processes[key].stdin
-                    else:
-                        task_file_streams[key] = open(
-                                os.path.join(key_dir, str(task_id)), 'w'
-                            )
-                    task_file_streams[key].write(line_to_write)
+            if prefix is None:
+                feeder = threading.Thread(target=feed_lines,
+                                          args=(merged_input,
+                                                multiple_output_process.stdin,
+                                                feeder_errors))
+                feeder.daemon = True
+                feeder.start()
+            uncreated_dir = write_multiple_outputs(
+                    multiple_output_process.stdout, output_dir, task_id,
+                    separator, gzip, gzip_level
+                )
+            if uncreated_dir is not None:
+                return (('Streaming command "%s" failed: problem '
+                         'encountered creating output '
+                         'directory %s.') % (command_to_run, uncreated_dir))
             multiple_output_process_return = multiple_output_process.wait()
+            if prefix is None:
+                feeder.join()
+                if feeder_errors:
+                    return (('Error\n\n%s\nencountered merging input to '
+                             'streaming command "%s".')
+                             % (feeder_errors[0], command_to_run))
             if multiple_output_process_return != 0:
                 return (('Streaming command "%s" failed; exit level was %d.')
                          % (command_to_run, multiple_output_process_return))
-            for key in task_file_streams:
-                task_file_streams[key].close()
         else:
             if gzip:
                 out_file = os.path.abspath(
                                 os.path.join(output_dir, str(task_id) + '.gz')
                             )
                 command_to_run \
-                    = prefix + ' | ' + streaming_command + (
-                            ' 2> >(tee %s | %s) | gzip -%d >%s'
-                                % (err_file,
-                                    counter_cmd(counter_file),
-                                    gzip_level,
-                                    out_file)
+                    = streaming_command + (
+                            ' 2>%s | gzip -%d >%s'
+                                % (err_file, gzip_level, out_file)
                         )
             else:
                 out_file = os.path.abspath(
                                 os.path.join(output_dir, str(task_id))
                             )
                 command_to_run \
-                    = prefix + ' | ' + streaming_command + (
-                        ' >%s 2> >(tee %s | %s)'
-                                            % (out_file,
-                                            err_file,
-                                            counter_cmd(counter_file)))
+                    = streaming_command + (
+                        ' >%s 2>%s' % (out_file, err_file))
+            full_command = ' '.join([('set -eo pipefail; cd %s;'
+                                        % dir_to_path)
+                                        if dir_to_path is not None
+                                        else 'set -eo pipefail;',
+                                      command_to_run])
+            if prefix is None:
+                # Need bash or zsh for process substitution
+                with open(os.devnull, 'w') as devnull_stream:
+                    streaming_process = subprocess.Popen(full_command,
+                                                shell=True,
+                                                stdin=subprocess.PIPE,
+                                                stdout=devnull_stream,
+                                                stderr=subprocess.STDOUT,
+                                                env=new_env,
+                                                bufsize=-1,
+                                                executable='/bin/bash')
+                    feed_lines(merged_input, streaming_process.stdin,
+                                feeder_errors)
+                    streaming_process_return = streaming_process.wait()
+                if feeder_errors:
+                    return (('Error\n\n%s\nencountered merging input to '
+                             'streaming command "%s".')
+                             % (feeder_errors[0], command_to_run))
+                if streaming_process_return != 0:
+                    return (('Streaming command "%s" failed; exit level was '
+                             '%d.') % (command_to_run,
+                                        streaming_process_return))
+                return None
             try:
                 # Need bash or zsh for process substitution
-                subprocess.check_output(' '.join([('set -eo pipefail; cd %s;'
-                                                    % dir_to_path)
-                                                    if dir_to_path is not None
-                                                    else 'set -eo pipefail;',
-                                                  command_to_run]),
+                subprocess.check_output(full_command,
                                             shell=True,
+                                            stdin=range_stream,
                                             env=new_env,
                                             bufsize=-1,
                                             stderr=subprocess.STDOUT,
@@ -670,11 +1620,18 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         return ('Error\n\n%s\nencountered executing task on input %s.'
                 % (format_exc(), input_glob))
     finally:
-        if 'task_file_stream_processes' in locals():
-            for key in task_file_streams:
-                task_file_streams[key].close()
-            for key in task_file_stream_processes:
-                task_file_stream_processes[key].wait()
+        if 'merged_input' in locals():
+            merged_input.close()
+        if range_stream is not None:
+            range_stream.close()
+        if 'merge_dir' in locals():
+            shutil.rmtree(merge_dir, ignore_errors=True)
+        if 'metrics_prefix' in locals():
+            try:
+                collect_metrics(metrics_prefix)
+            except (IOError, OSError, ValueError):
+                # Counters are diagnostic; don't fail the task over them
+                pass
         if 'final_output_dir' in locals() and final_output_dir != output_dir:
             # Copy all output files to final destination and kill temp dir
             for root, dirnames, filenames in os.walk(output_dir):
@@ -695,12 +1652,185 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                         )
             shutil.rmtree(output_dir)
 
+def step_dependencies(steps):
+    """ Finds the steps each step must wait for before it can start.
+
+        A step depends on an earlier step if one of its inputs is that step's
+        output, lies inside it, or contains it. A step that distributes a
+        file or archive to its tasks with -files, -archives, -cacheFile, or
+        -cacheArchive depends on every earlier step, since any of them may
+        write that file through an argument of its streaming command rather
+        than through -output; Rail's junction index is written this way.
+
+        steps: OrderedDict mapping step names to dictionaries with a
+            comma-separated 'input' and an 'output', in job flow order
+
+        Return value: list whose ith item is the set of indexes of steps that
+            must finish before step i starts
+    """
+    outputs = [os.path.abspath(step_data['output'])
+                for step_data in steps.values()]
+    dependencies = []
+    for i, step_data in enumerate(steps.values()):
+        if any(cache_key in step_data for cache_key in _cache_keys):
+            dependencies.append(set(xrange(i)))
+            continue
+        step_inputs = [os.path.abspath(step_input) for step_input
+                        in step_data['input'].split(',')]
+        dependencies.append(set(
+                j for j in xrange(i) for step_input in step_inputs
+                if step_input == outputs[j]
+                or step_input.startswith(outputs[j] + os.sep)
+                or outputs[j].startswith(step_input + os.sep)
+            ))
+    return dependencies
+
+def input_size(input_glob):
+    """ Computes total size of files matching a glob.
+
+        input_glob: input files specified with wildcard
+
+        Return value: total size in bytes
+    """
+    return sum(os.path.getsize(input_file)
+                for input_file in glob.glob(input_glob)
+                if os.path.isfile(input_file))
+
+def split_map_inputs(input_files, num_processes,
+                        min_split_size=_min_split_size):
+    """ Splits oversized map inputs into byte ranges at line boundaries.
+
+        Hadoop splits map input into blocks at line boundaries, so mappers
+        shouldn't care whether a file arrives whole. An uncompressed file is
+        split into ranges about as large as the bigger of min_split_size and
+        the share of all input each of num_processes processes would get if
+        work were spread evenly. This keeps one huge file from making a
+        straggler. Gzip'd files and files of binary records are never split.
+
+        input_files: list of input files
+        num_processes: number of processes among which tasks are spread
+        min_split_size: smallest size of a range into which a file is split
+
+        Return value: list of tuples (input file, byte range), where byte
+            range is a tuple (start, end) or None if the whole file is to be
+            read, in the order of input_files
+    """
+    sizes = [os.path.getsize(input_file) for input_file in input_files]
+    split_size = max(min_split_size,
+                     sum(sizes) / max(num_processes, 1))
+    splits = []
+    for input_file, size in zip(input_files, sizes):
+        if size <= split_size:
+            splits.append((input_file, None))
+            continue
+        with open(input_file, 'rb') as input_stream:
+            magic_number = input_stream.read(len(MAGIC))
+            if magic_number[:2] == '\x1f\x8b' \
+                    or is_record_stream(magic_number):
+                splits.append((input_file, None))
+                continue
+            start = 0
+            while start < size:
+                input_stream.seek(start + split_size)
+                input_stream.readline()
+                end = min(input_stream.tell(), size)
+                splits.append((input_file, (start, end)))
+                start = end
+    return splits
+
+def size_balanced_groups(input_files, group_count):
+    """ Distributes files among groups so the groups are of similar size.
+
+        Files are placed largest first, each in the group that's smallest
+        so far.
+
+        input_files: list of input files
+        group_count: maximum number of groups
+
+        Return value: list of nonempty lists of files, largest group first
+    """
+    groups = [(0, i, []) for i in xrange(min(group_count, len(input_files)))]
+    for size, input_file in sorted(
+                ((os.path.getsize(input_file), input_file)
+                    for input_file in input_files),
+                reverse=True
+            ):
+        group_size, i, group = heapq.heappop(groups)
+        group.append(input_file)
+        heapq.heappush(groups, (group_size + size, i, group))
+    return [group for _, _, group in sorted(groups, reverse=True)]
+
+def timed_task(task_function, *args):
+    """ Runs a task, recording when it starts and ends.
+
+        An uncaught exception is returned as an error message so the
+        scheduler always hears back about an attempt.
+
+        task_function: function to run; returns None iff it succeeds and an
+            error message otherwise
+        args: task_function's arguments
+
+        Return value: tuple (task_function's return value, start time, end
+            time, pid of process that ran task)
+    """
+    start_time = time.time()
+    try:
+        return_value = task_function(*args)
+    except Exception:
+        from traceback import format_exc
+        return_value = ('Error\n\n%s\nencountered executing task.'
+                            % format_exc())
+    return return_value, start_time, time.time(), os.getpid()
+
+def log_task_timing(timing_stream, task, attempt, worker, start_time,
+                        end_time, status):
+    """ Writes a line about a task attempt to a timing log.
+
+        Fields are tab-separated: task index, attempt number, worker, start
+        time, end time, duration in seconds, and status.
+
+        timing_stream: file object to write to, or None if there's no log
+        task: index of task among those of a phase
+        attempt: attempt number
+        worker: pid of process or ID of engine that ran attempt
+        start_time: when attempt started, in seconds since the epoch
+        end_time: when attempt ended, in seconds since the epoch
+        status: "succeeded" or "failed"
+
+        No return value.
+    """
+    if timing_stream is None:
+        return
+    print >>timing_stream, '\t'.join([str(task), str(attempt), str(worker),
+                                      '%.3f' % start_time, '%.3f' % end_time,
+                                      '%.3f' % (end_time - start_time),
+                                      status])
+
+def runtime_skew(runtimes):
+    """ Summarizes how unevenly long a step's tasks took.
+
+        runtimes: list of wall times in seconds taken by tasks
+
+        Return value: message for step summary, or None if there are fewer
+            than two tasks
+    """
+    if len(runtimes) < 2:
+        return None
+    runtimes = sorted(runtimes)
+    median = runtimes[len(runtimes) // 2]
+    return ('    Task runtimes: median %.1f s, max %.1f s%s.'
+                % (median, runtimes[-1],
+                    (' (%.1fx median)' % (runtimes[-1] / median))
+                    if median else ''))
+
 def run_simulation(branding, json_config, force, memcap, num_processes,
                     separator, keep_intermediates, keep_last_output,
                     log, gzip=False, gzip_level=3, ipy=False,
                     ipcontroller_json=None, ipy_profile=None, scratch=None,
                     common=None, sort='sort', max_attempts=4,
-                    direct_write=False):
+                    direct_write=False, builtin_sort=False, dag=False,
+                    speculative=False, warm_workers=False, profile=False,
+                    gzip_threads=None):
     """ Runs Hadoop Streaming simulation.
 
         FUNCTIONALITY IS IDIOSYNCRATIC; it is currently confined to those
@@ -740,6 +1870,23 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         max_attempts: maximum number of times to attempt a task in ipy mode.
         direct_write: always writes intermediate files directly to final
             destination, even when scratch is specified
+        builtin_sort: sorts intermediates in Python, spilling sorted runs
+            while partitioning and merging them straight into reducers,
+            rather than with UNIX sort
+        dag: runs each step as soon as the steps producing its inputs have
+            finished, so independent steps run concurrently; ignored in ipy
+            mode
+        speculative: starts backup attempts of straggling map and reduce
+            tasks, committing output of whichever attempt finishes first;
+            ignored when not in ipy mode
+        warm_workers: keeps local workers alive for the whole job flow and
+            runs streaming commands that are Python scripts in workers
+            rather than in fresh interpreters
+        profile: profiles streaming commands that are Python scripts,
+            writing each step's hotspots and stacks to its log directories
+        gzip_threads: number of threads (de)compressing each gzip stream in
+            a task, or None to divide each machine's CPUs among the
+            processes running tasks on it
 
         No return value.
     """
@@ -748,6 +1895,10 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
     import os
     import tempfile
     import glob
+    import threading
+    import sys
+    import signal
+    import json
     if log is not None:
         try:
             os.makedirs(os.path.dirname(log))
@@ -839,17 +1990,64 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             with direct_view.sync_imports(quiet=True):
                 import subprocess
                 import glob
-                import hashlib
+                import zlib
+                import heapq
+                import threading
+                import re
                 import tempfile
                 import shutil
                 import os
+                import sys
+                import signal
+                import json
             direct_view.push(dict(
                     yopen=yopen,
                     step_runner_with_error_return=\
                         step_runner_with_error_return,
                     presorted_tasks=presorted_tasks,
                     parsed_keys=parsed_keys,
-                    counter_cmd=counter_cmd
+                    partition_hash=partition_hash,
+                    gzip_into=gzip_into,
+                    gzip_threads=gzip_threads,
+                    set_gzip_threads=set_gzip_threads,
+                    _gzip_threads_variable=_gzip_threads_variable,
+                    _gzip_block_size=_gzip_block_size,
+                    _task_gzip_block_size=_task_gzip_block_size,
+                    ParallelGzipWriter=ParallelGzipWriter,
+                    ParallelGzipReader=ParallelGzipReader,
+                    MAGIC=MAGIC,
+                    RecordReader=RecordReader,
+                    record_body=record_body,
+                    decoded_key=decoded_key,
+                    is_record_stream=is_record_stream,
+                    record_file=record_file,
+                    parsed_comparator=parsed_comparator,
+                    numeric_key=numeric_key,
+                    reversed_key=reversed_key,
+                    write_run=write_run,
+                    merged_lines=merged_lines,
+                    premerged_runs=premerged_runs,
+                    feed_lines=feed_lines,
+                    write_multiple_outputs=write_multiple_outputs,
+                    warm_script_args=warm_script_args,
+                    set_cloexec=set_cloexec,
+                    run_script_in_process=run_script_in_process,
+                    run_warm_task=run_warm_task,
+                    which=which,
+                    _shell_syntax=_shell_syntax,
+                    commit_task_output=commit_task_output,
+                    timed_task=timed_task,
+                    make_temp_dir=make_temp_dir,
+                    _partition_block_size=_partition_block_size,
+                    _partition_buffer_size=_partition_buffer_size,
+                    _line_overhead=_line_overhead,
+                    _merge_fan_in=_merge_fan_in,
+                    _leading_number=_leading_number,
+                    collect_metrics=collect_metrics,
+                    merged_metrics=merged_metrics,
+                    profiled_command=profiled_command,
+                    _python_script=_python_script,
+                    _profiler_script=_profiler_script
                 ))
             iface.step('Loaded dependencies on IPython Parallel engines.')
             # Get host-to-engine and engine pids relations
@@ -865,6 +2063,12 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                     pool, all_engines, os.getpid,
                                     dict_format=True
                                 )
+            # Engines on a host share its CPUs
+            apply_async_with_errors(
+                    pool, all_engines, set_gzip_threads, gzip_threads,
+                    dict([(engine, len(engine_map[host_map[engine]]))
+                            for engine in all_engines])
+                )
             def interrupt_engines(pool, iface):
                 """ Interrupts IPython Parallel engines spanned by view
 
@@ -900,16 +2104,33 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         #)
                         pass
             import random
+            from ipyparallel import AsyncResult
+            # AsyncResults take callbacks from IPython Parallel 6 on
+            completion_callbacks = hasattr(AsyncResult, 'add_done_callback')
+            '''Maps engines still running attempts that lost to backup
+            attempts to their AsyncResults; engines stay busy across steps
+            until they finish.'''
+            straggling_attempts = {}
             def execute_balanced_job_with_retries(pool, iface,
                 task_function, task_function_args,
                 status_message='Tasks completed',
-                finish_message='Completed tasks.', max_attempts=4):
+                finish_message='Completed tasks.', max_attempts=4,
+                speculative=False, timing_log=None):
                 """ Executes parallel job over IPython Parallel engines.
 
                     Tasks are assigned to free engines as they become
                     available. If a task fails on one engine, it is retried on
                     another engine. If a task has been tried on all engines but
                     fails before max_attempts is exceeded, the step is failed.
+                    Finished attempts wake the scheduler through a completion
+                    queue, so the next task is dispatched right away.
+
+                    With speculative execution, once most tasks are done, a
+                    backup attempt of each straggling task is started on a
+                    free engine, preferably on another node, and the task is
+                    done when either attempt succeeds. The losing attempt
+                    runs to completion, but task_function must discard its
+                    output, and its engine is freed only when it's done.
 
                     pool: IPython Parallel Client object; all engines it spans
                         are used
@@ -927,74 +2148,169 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         completed
                     max_attempts: max number of times to attempt any given
                         task
+                    speculative: True iff backup attempts of straggling tasks
+                        should be started
+                    timing_log: file to which a line is appended for each
+                        task attempt as described in log_task_timing(), or
+                        None if attempts shouldn't be logged
 
                     No return value.
                 """
                 global failed
                 random.seed(pool.ids[-1])
-                used_engines, free_engines = set(), set(pool.ids)
+                used_engines = set()
+                # Engines still running losing attempts aren't free yet
+                free_engines = set(pool.ids) - set(straggling_attempts)
                 completed_tasks = 0
                 tasks_to_assign = deque([
                         [task_function_arg, i, []] for i, task_function_arg
                         in enumerate(task_function_args)
                     ])
                 task_count = len(tasks_to_assign)
-                assigned_tasks, asyncresults = {}, {}
+                assigned_tasks, asyncresults, start_times = {}, {}, {}
+                task_runtimes = []
+                backups, speculated_tasks, promoted_tasks = {}, set(), []
                 max_task_fails = 0
+                completions = Queue.Queue()
+                def dispatch(engine, task_function_arg, attempt):
+                    """ Starts task attempt on engine.
+
+                        Return value: AsyncResult of attempt
+                    """
+                    asyncresult = pool[engine].apply_async(
+                            timed_task, task_function,
+                            *(task_function_arg + [attempt])
+                        )
+                    if completion_callbacks:
+                        asyncresult.add_done_callback(completions.put)
+                    return asyncresult
                 iface.status(('    %s: '
                               '%d/%d | \\max_i (task_i fails): %d/%d')
                                 % (status_message, completed_tasks,
                                     task_count, max_task_fails,
                                     max_attempts - 1))
-                while completed_tasks < task_count:
-                    if tasks_to_assign:
-                        task_to_assign = tasks_to_assign.popleft()
-                        forbidden_engines = set(task_to_assign[2])
-                        if len(forbidden_engines) >= 2:
-                            # After two fails, do not allow reused nodes
-                            for forbidden_engine in task_to_assign[2]:
-                                forbidden_engines.update(
-                                    engine_map[host_map[forbidden_engine]]
+                timing_stream = (open(timing_log, 'a')
+                                    if timing_log is not None else None)
+                try:
+                    while completed_tasks < task_count:
+                        for _ in xrange(len(tasks_to_assign)):
+                            if not free_engines:
+                                break
+                            task_to_assign = tasks_to_assign.popleft()
+                            forbidden_engines = set(task_to_assign[2])
+                            if len(forbidden_engines) >= 2:
+                                # After two fails, do not allow reused nodes
+                                for forbidden_engine in task_to_assign[2]:
+                                    forbidden_engines.update(
+                                        engine_map[host_map[forbidden_engine]]
+                                    )
+                            if all_engines <= forbidden_engines:
+                                iface.fail(('No more running IPython Parallel '
+                                            'engines and/or nodes on which '
+                                            'function-arg combo (%s, %s) has '
+                                            'not failed attempt to execute. '
+                                            'Check the IPython Parallel '
+                                            'cluster\'s integrity and '
+                                            'resource availability.')
+                                             % (task_function,
+                                                task_to_assign[0]),
+                                             steps=(job_flow[step_number:]
+                                                if step_number != 0 else None))
+                                failed = True
+                                raise RuntimeError
+                            try:
+                                assigned_engine = random.choice(
+                                        list(free_engines - forbidden_engines)
+                                    )
+                            except IndexError:
+                                # No engine to assign yet; add back to queue
+                                tasks_to_assign.append(task_to_assign)
+                            else:
+                                asyncresults[task_to_assign[1]] = dispatch(
+                                        assigned_engine, task_to_assign[0],
+                                        len(task_to_assign[2])
+                                    )
+                                assigned_tasks[task_to_assign[1]] = [
+                                        task_to_assign[0], task_to_assign[1],
+                                        task_to_assign[2] + [assigned_engine]
+                                    ]
+                                used_engines.add(assigned_engine)
+                                free_engines.remove(assigned_engine)
+                                # Engine was free, so task starts right away
+                                start_times[task_to_assign[1]] = time.time()
+                        if (speculative and not tasks_to_assign
+                                and task_runtimes and completed_tasks
+                                >= _speculation_start * task_count):
+                            straggler_runtime = max(
+                                    _speculation_min_runtime,
+                                    _speculation_slowdown
+                                    * sorted(task_runtimes)[
+                                            len(task_runtimes) // 2
+                                        ]
                                 )
-                        if all_engines <= forbidden_engines:
-                            iface.fail(('No more running IPython Parallel '
-                                        'engines and/or nodes on which '
-                                        'function-arg combo (%s, %s) has not '
-                                        'failed attempt to execute. Check the '
-                                        'IPython Parallel cluster\'s '
-                                        'integrity and resource availability.')
-                                         % (task_function, task_to_assign[0]),
-                                         steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
-                            failed = True
-                            raise RuntimeError
+                            for task in asyncresults:
+                                if not free_engines:
+                                    break
+                                if (task in speculated_tasks
+                                        or time.time() - start_times[task]
+                                        < straggler_runtime):
+                                    continue
+                                # Prefer engines on other nodes
+                                backup_engine = random.choice(list(
+                                        free_engines - set(engine_map[host_map[
+                                                assigned_tasks[task][2][-1]
+                                            ]]) or free_engines
+                                    ))
+                                '''Attempt number is past any retry's so log
+                                files don't collide.'''
+                                backup_attempt = (
+                                        max_attempts
+                                        + len(assigned_tasks[task][2])
+                                    )
+                                backups[task] = [
+                                        dispatch(backup_engine,
+                                                 assigned_tasks[task][0],
+                                                 backup_attempt),
+                                        backup_engine, time.time(),
+                                        backup_attempt
+                                    ]
+                                speculated_tasks.add(task)
+                                used_engines.add(backup_engine)
+                                free_engines.remove(backup_engine)
                         try:
-                            assigned_engine = random.choice(
-                                    list(free_engines - forbidden_engines)
-                                )
-                        except IndexError:
-                            # No engine to assign yet; add back to queue
-                            tasks_to_assign.append(task_to_assign)
-                        else:
-                            asyncresults[task_to_assign[1]] = (
-                                pool[assigned_engine].apply_async(
-                                    task_function,
-                                    *(task_to_assign[0] +
-                                      [len(task_to_assign[2])])
-                                )
-                            )
-                            assigned_tasks[task_to_assign[1]] = [
-                                    task_to_assign[0], task_to_assign[1],
-                                    task_to_assign[2] + [assigned_engine]
-                                ]
-                            used_engines.add(assigned_engine)
-                            free_engines.remove(assigned_engine)
-                    asyncresults_to_remove = []
-                    for task in asyncresults:
-                        if asyncresults[task].ready():
-                            return_value = asyncresults[task].get()
+                            '''Wait for an attempt to finish. The timeout is
+                            for checking on stragglers, or for finding
+                            finished attempts if AsyncResults don't take
+                            callbacks.'''
+                            completions.get(True, 1 if completion_callbacks
+                                                    else 0.1)
+                            while True:
+                                completions.get_nowait()
+                        except Queue.Empty:
+                            pass
+                        asyncresults_to_remove = []
+                        for task in asyncresults:
+                            if not asyncresults[task].ready():
+                                continue
+                            (return_value, start_time, end_time,
+                                _) = asyncresults[task].get()
+                            log_task_timing(timing_stream, task,
+                                            len(assigned_tasks[task][2]) - 1,
+                                            assigned_tasks[task][2][-1],
+                                            start_time, end_time,
+                                            'failed' if return_value
+                                            is not None else 'succeeded')
                             if return_value is not None:
-                                if max_attempts > len(assigned_tasks[task][2]):
+                                if task in backups:
+                                    # Backup attempt takes over
+                                    promoted_tasks.append(task)
+                                    max_task_fails = max(
+                                            len(assigned_tasks[task][2]),
+                                            max_task_fails
+                                        )
+                                elif max_attempts > len(
+                                        assigned_tasks[task][2]
+                                    ):
                                     # Add to queue for reattempt
                                     tasks_to_assign.append(
                                             assigned_tasks[task]
@@ -1014,7 +2330,17 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             else:
                                 # Success
                                 completed_tasks += 1
+                                task_runtimes.append(end_time - start_time)
                                 asyncresults_to_remove.append(task)
+                                if task in backups:
+                                    # Backup attempt lost
+                                    backup_result, backup_engine, _, _ = (
+                                            backups.pop(task)
+                                        )
+                                    straggling_attempts[backup_engine] = (
+                                            backup_result
+                                        )
+                                    used_engines.remove(backup_engine)
                             iface.status(('    %s: '
                                           '%d/%d | '
                                           '\\max_i (task_i fails): '
@@ -1029,12 +2355,63 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                     assigned_tasks[task][-1][-1]
                                 )
                             free_engines.add(assigned_tasks[task][-1][-1])
-                    for task in asyncresults_to_remove:
-                        del asyncresults[task]
-                        del assigned_tasks[task]
-                    time.sleep(0.1)
+                        for task in asyncresults_to_remove:
+                            del asyncresults[task]
+                            del assigned_tasks[task]
+                            del start_times[task]
+                        for task in promoted_tasks:
+                            (asyncresults[task], backup_engine,
+                                start_times[task], _) = backups.pop(task)
+                            assigned_tasks[task][2].append(backup_engine)
+                        promoted_tasks = []
+                        for task in backups.keys():
+                            (backup_result, backup_engine, _,
+                                backup_attempt) = backups[task]
+                            if not backup_result.ready():
+                                continue
+                            del backups[task]
+                            used_engines.remove(backup_engine)
+                            free_engines.add(backup_engine)
+                            (return_value, start_time, end_time,
+                                _) = backup_result.get()
+                            log_task_timing(timing_stream, task,
+                                            backup_attempt, backup_engine,
+                                            start_time, end_time,
+                                            'failed' if return_value
+                                            is not None else 'succeeded')
+                            if return_value is not None:
+                                # Backup failed; original attempt carries on
+                                continue
+                            completed_tasks += 1
+                            task_runtimes.append(end_time - start_time)
+                            # Original attempt lost
+                            original_engine = assigned_tasks[task][2][-1]
+                            straggling_attempts[original_engine] = (
+                                    asyncresults[task]
+                                )
+                            used_engines.remove(original_engine)
+                            del asyncresults[task]
+                            del assigned_tasks[task]
+                            del start_times[task]
+                            iface.status(('    %s: '
+                                          '%d/%d | '
+                                          '\\max_i (task_i fails): '
+                                          '%d/%d')
+                                % (status_message, completed_tasks,
+                                    task_count, max_task_fails,
+                                    max_attempts - 1))
+                        for engine in straggling_attempts.keys():
+                            if straggling_attempts[engine].ready():
+                                del straggling_attempts[engine]
+                                free_engines.add(engine)
+                finally:
+                    if timing_stream is not None:
+                        timing_stream.close()
                 assert not used_engines
                 iface.step(finish_message)
+                skew_message = runtime_skew(task_runtimes)
+                if skew_message:
+                    iface.step(skew_message)
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
                 """ Places X.[tar.gz/tgz]#Y in dir Y, unpacked if archive
@@ -1300,14 +2677,19 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         )
         else:
             import multiprocessing
+            # Backup attempts would compete with originals for the same cores
+            speculative = False
             def execute_balanced_job_with_retries(pool, iface,
                 task_function, task_function_args,
                 status_message='Tasks completed',
-                finish_message='Completed tasks.', max_attempts=4):
+                finish_message='Completed tasks.', max_attempts=4,
+                speculative=False, timing_log=None):
                 """ Executes parallel job locally with multiprocessing module.
 
-                    Tasks are added to queue if they fail, and max_attempts-1
-                    failures are permitted per task. 
+                    All tasks are queued at once, so a process picks up the
+                    next task as soon as it's free. Each attempt reports back
+                    through a completion queue; failed tasks are queued
+                    again, and max_attempts-1 failures are permitted per task.
 
                     pool: multiprocessing.Pool object
                     iface: DooplicityInterface object for spewing log messages
@@ -1324,76 +2706,82 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         completed
                     max_attempts: max number of times to attempt any given
                         task
+                    speculative: ignored; all tasks share one machine, so
+                        there's no faster engine to run a backup attempt on
+                    timing_log: file to which a line is appended for each
+                        task attempt as described in log_task_timing(), or
+                        None if attempts shouldn't be logged
 
                     No return value.
                 """
                 global failed
                 completed_tasks = 0
-                tasks_to_assign = deque([
-                        [task_function_arg, i, 0] for i, task_function_arg
-                        in enumerate(task_function_args)
-                    ])
-                task_count = len(tasks_to_assign)
-                assigned_tasks, asyncresults = {}, {}
+                task_count = len(task_function_args)
+                task_runtimes = []
                 max_task_fails = 0
+                completions = Queue.Queue()
+                def submit(task, task_function_arg, attempt):
+                    """ Queues task attempt, reporting back to completions """
+                    pool.apply_async(
+                            timed_task,
+                            args=([task_function] + task_function_arg
+                                    + [attempt]),
+                            callback=(lambda result: completions.put(
+                                    (task, task_function_arg, attempt, result)
+                                ))
+                        )
+                for i, task_function_arg in enumerate(task_function_args):
+                    submit(i, task_function_arg, 0)
                 iface.status(('    %s: %d/%d%s')
                                 % (status_message, completed_tasks, task_count,
                                      (' | \\max_i (task_i fails): %d/%d'
                                        % (max_task_fails,
                                             max_attempts - 1)
                                        if max_attempts > 1 else '')))
-                while completed_tasks < task_count:
-                    if tasks_to_assign:
-                        task_to_assign = tasks_to_assign.popleft()
-                        asyncresults[task_to_assign[1]] = (
-                                pool.apply_async(
-                                    task_function,
-                                    args=(task_to_assign[0] +
-                                            [task_to_assign[2]])
-                                )
+                timing_stream = (open(timing_log, 'a')
+                                    if timing_log is not None else None)
+                try:
+                    while completed_tasks < task_count:
+                        # Timeout keeps wait interruptible by KeyboardInterrupt
+                        (task, task_function_arg, attempt,
+                            (return_value, start_time, end_time, worker)) = (
+                                completions.get(True, 31536000)
                             )
-                        assigned_tasks[task_to_assign[1]] = [
-                                task_to_assign[0], task_to_assign[1],
-                                task_to_assign[2] + 1
-                            ]
-                    asyncresults_to_remove = []
-                    for task in asyncresults:
-                        if asyncresults[task].ready():
-                            return_value = asyncresults[task].get()
-                            if return_value is not None:
-                                if max_attempts > assigned_tasks[task][2]:
-                                    # Add to queue for reattempt
-                                    tasks_to_assign.append(
-                                            assigned_tasks[task]
-                                        )
-                                    max_task_fails = max(
-                                            assigned_tasks[task][2],
-                                            max_task_fails
-                                        )
-                                    asyncresults_to_remove.append(task)
-                                else:
-                                    # Bail if max_attempts is saturated
-                                    iface.fail(return_value,
-                                    steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
-                                    failed = True
-                                    raise RuntimeError
+                        log_task_timing(timing_stream, task, attempt, worker,
+                                        start_time, end_time,
+                                        'failed' if return_value is not None
+                                        else 'succeeded')
+                        if return_value is not None:
+                            if max_attempts > attempt + 1:
+                                # Queue reattempt
+                                submit(task, task_function_arg, attempt + 1)
+                                max_task_fails = max(attempt + 1,
+                                                     max_task_fails)
                             else:
-                                # Success
-                                completed_tasks += 1
-                                asyncresults_to_remove.append(task)
-                            iface.status(('    %s: %d/%d%s')
-                                    % (status_message, completed_tasks,
-                                        task_count,
-                                        (' | \\max_i (task_i fails): %d/%d'
-                                            % (max_task_fails,
-                                                max_attempts - 1)
-                                            if max_attempts > 1 else '')))
-                    for task in asyncresults_to_remove:
-                        del asyncresults[task]
-                        del assigned_tasks[task]
-                    time.sleep(0.1)
+                                # Bail if max_attempts is saturated
+                                iface.fail(return_value,
+                                steps=(job_flow[step_number:]
+                                        if step_number != 0 else None))
+                                failed = True
+                                raise RuntimeError
+                        else:
+                            # Success
+                            completed_tasks += 1
+                            task_runtimes.append(end_time - start_time)
+                        iface.status(('    %s: %d/%d%s')
+                                % (status_message, completed_tasks,
+                                    task_count,
+                                    (' | \\max_i (task_i fails): %d/%d'
+                                        % (max_task_fails,
+                                            max_attempts - 1)
+                                        if max_attempts > 1 else '')))
+                finally:
+                    if timing_stream is not None:
+                        timing_stream.close()
                 iface.step(finish_message)
+                skew_message = runtime_skew(task_runtimes)
+                if skew_message:
+                    iface.step(skew_message)
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
                 """ Places X.[tar.gz/tgz]#Y in dir Y, unpacked if archive
@@ -1623,23 +3011,14 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             raise RuntimeError
         if not keep_intermediates:
             # Create schedule for deleting intermediates
-            marked_intermediates = set()
             all_outputs = set()
-            post_step_cleanups = defaultdict(list)
-            '''Traverse steps in reverse order to obtain when an intermediate
-            directory is last used.'''
-            for i, step in enumerate(
-                                OrderedDict(reversed(steps.items()[1:]))
-                            ):
-                step_inputs = [os.path.abspath(step_input) for step_input in
-                                steps[step]['input'].split(',')]
+            '''Track which steps have yet to read each intermediate; it's
+            deleted once they've all finished.'''
+            pending_consumers = defaultdict(set)
+            for i, step in enumerate(steps.keys()[1:], 1):
                 all_outputs.add(os.path.abspath(steps[step]['output']))
-                for step_input in step_inputs:
-                    if step_input not in marked_intermediates:
-                        post_step_cleanups[step_count - i - 1].append(
-                                step_input
-                            )
-                        marked_intermediates.add(step_input)
+                for step_input in steps[step]['input'].split(','):
+                    pending_consumers[os.path.abspath(step_input)].add(i)
         # Create intermediate directories
         for step in steps:
             try:
@@ -1673,14 +3052,27 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         step_number = 0
         total_steps = len(steps)
         if not ipy:
-            # Pool's only for if we're in local mode
+            # Pool's only for if we're in local mode; workers inherit env
+            set_gzip_threads(gzip_threads, num_processes)
             try:
                 pool = multiprocessing.Pool(num_processes, init_worker,
-                                                maxtasksperchild=5)
+                                                maxtasksperchild=(
+                                                    None if warm_workers
+                                                    else 5
+                                                ))
             except Exception:
                 # maxtasksperchild doesn't work, somehow? Supported only in 2.7
                 pool = multiprocessing.Pool(num_processes, init_worker)
-        for step in steps:
+        split_input_dirs = {}
+        def run_step(step_number, step):
+            """ Runs the map, partition, and reduce phases of a step.
+
+                step_number: index of step in job flow
+                step: name of step
+
+                No return value.
+            """
+            global failed
             step_data = steps[step]
             step_inputs = []
             # Handle multiple input files/directories
@@ -1764,6 +3156,7 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     if nline_input:
                         # Create temporary input files
                         split_input_dir = make_temp_dir(common)
+                        split_input_dirs[step_number] = split_input_dir
                         input_files = []
                         try:
                             with open(step_inputs[0]) as nline_stream:
@@ -1793,6 +3186,22 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     iface.step('Step %d/%d: %s' %
                                 (step_number + 1, total_steps, step))
                     iface.status('    Starting step runner...')
+                    if nline_input:
+                        map_tasks = [(input_file, None)
+                                        for input_file in input_files]
+                    else:
+                        map_tasks = split_map_inputs(input_files,
+                                                        num_processes)
+                    '''Start biggest tasks first so they don't straggle;
+                    task IDs still follow input order.'''
+                    map_tasks = sorted(
+                            enumerate(map_tasks),
+                            key=lambda (i, (input_file, input_range)): (
+                                    -(input_range[1] - input_range[0]
+                                        if input_range is not None
+                                        else os.path.getsize(input_file)), i
+                                )
+                        )
                     execute_balanced_job_with_retries(
                             pool, iface, step_runner_with_error_return,
                                        [[step_data['mapper'], input_file,
@@ -1801,20 +3210,27 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                          i, multiple_outputs,
                                          separator, None, None, gzip,
                                          gzip_level, scratch, direct_write,
-                                         sort, dir_to_path]
-                                         for i, input_file
-                                         in enumerate(input_files)
-                                         if os.path.isfile(input_file)],
+                                         sort, dir_to_path, False,
+                                         input_range, speculative,
+                                         warm_workers, profile]
+                                         for i, (input_file, input_range)
+                                         in map_tasks],
                             status_message='Tasks completed',
                             finish_message=(
                                 '    Completed %s.'
-                                % dp_iface.inflected(input_file_count, 'task')
+                                % dp_iface.inflected(len(map_tasks), 'task')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            speculative=speculative,
+                            timing_log=os.path.join(err_dir, 'timings.tsv')
                         )
+                    if profile:
+                        merge_profiles(err_dir)
                     # Adjust step inputs in case a reducer follows
                     step_inputs = [input_file for input_file 
-                                    in glob.glob(output_dir)
+                                    in glob.glob(
+                                            os.path.join(output_dir, '*')
+                                        )
                                     if os.path.isfile(input_file)]
                 if step_data['reducer'] not in identity_reducers:
                     '''Determine whether to use "mod" partitioner that uses
@@ -1828,6 +3244,9 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     except KeyError:
                         # Default to no mod partition
                         mod_partition = False
+                    combiner = step_data.get('combiner', None)
+                    if combiner in identity_reducers:
+                        combiner = None
                     # Partition inputs into tasks, presorting
                     output_dir = os.path.join(step_data['output'], 'dp.tasks')
                     try:
@@ -1844,18 +3263,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             raise
                     input_files = [input_file for input_file in step_inputs
                                     if os.path.isfile(input_file)]
-                    input_file_count = len(input_files)
-                    if input_file_count > num_processes:
-                        file_count_per_group = input_file_count / num_processes
-                        input_file_groups = [
-                                input_files[k:k+file_count_per_group]
-                                for k in
-                                xrange(0, input_file_count,
-                                        file_count_per_group)
-                            ]
-                    else:
-                        input_file_groups = [[input_file]
-                                                for input_file in input_files]
+                    input_file_groups = size_balanced_groups(input_files,
+                                                                num_processes)
                     input_file_group_count = len(input_file_groups)
                     iface.step('Step %d/%d: %s'
                                  % (step_number + 1, total_steps, step))
@@ -1867,7 +3276,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 step_data['partition_options'],
                                 step_data['task_count'], memcap, gzip,
                                 gzip_level, scratch, direct_write,
-                                sort, mod_partition]
+                                sort, mod_partition, builtin_sort, 0,
+                                combiner, dir_to_path]
                                     for i, input_file_group
                                     in enumerate(input_file_groups)],
                             status_message='Inputs partitioned',
@@ -1876,7 +3286,11 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 % dp_iface.inflected(input_file_group_count,
                                                      'input')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            timing_log=os.path.join(
+                                    steps[step]['output'], 'dp.reduce.log',
+                                    'partition_timings.tsv'
+                                )
                         )
                     iface.status('    Starting step runner...')
                     input_files = [os.path.join(output_dir, '%d.*' % i) 
@@ -1885,6 +3299,13 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     input_files = [input_file for input_file in input_files
                                     if glob.glob(input_file)]
                     input_file_count = len(input_files)
+                    # Start biggest tasks first so they don't straggle
+                    reduce_tasks = sorted(
+                            enumerate(input_files),
+                            key=lambda (i, input_file): (
+                                    -input_size(input_file), i
+                                )
+                        )
                     try:
                         multiple_outputs = (
                                 ('multiple_outputs' in step_data) or
@@ -1911,24 +3332,40 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 err_dir, counter_dir, i, multiple_outputs, separator,
                                 step_data['sort_options'], memcap, gzip,
                                 gzip_level, scratch, direct_write,
-                                sort, dir_to_path]
-                                    for i, input_file
-                                    in enumerate(input_files)],
+                                sort, dir_to_path, builtin_sort, None,
+                                speculative, warm_workers, profile]
+                                    for i, input_file in reduce_tasks],
                             status_message='Tasks completed',
                             finish_message=(
                                 '    Completed %s.'
                                 % dp_iface.inflected(input_file_count, 'task')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            speculative=speculative,
+                            timing_log=os.path.join(err_dir, 'timings.tsv')
                         )
+                    if profile:
+                        merge_profiles(err_dir)
             # Really close open file handles in PyPy
             gc.collect()
+        def clean_up_step(step_number, step):
+            """ Deletes a finished step's temporary files.
+
+                Inputs of the step that no unfinished step still reads are
+                deleted too if they're outputs of other steps.
+
+                step_number: index of step in job flow
+                step: name of step
+
+                No return value.
+            """
+            step_data = steps[step]
             if not keep_intermediates:
                 iface.status('    Deleting temporary files...')
                 # Kill NLineInput files if they're there
                 try:
-                    shutil.rmtree(split_input_dir)
-                except (NameError, OSError):
+                    shutil.rmtree(split_input_dirs.pop(step_number))
+                except (KeyError, OSError):
                     pass
                 try:
                     # Intermediate map output should be deleted if it exists
@@ -1946,7 +3383,15 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         )
                 except OSError:
                     pass
-                for to_remove in post_step_cleanups[step_number]:
+                to_remove_list = []
+                for step_input in steps[step]['input'].split(','):
+                    step_input = os.path.abspath(step_input)
+                    consumers = pending_consumers[step_input]
+                    if step_number in consumers:
+                        consumers.remove(step_number)
+                        if not consumers:
+                            to_remove_list.append(step_input)
+                for to_remove in to_remove_list:
                     if to_remove not in all_outputs:
                         '''Remove directory only if it's an -output of some
                         step and an -input of another step.'''
@@ -1974,9 +3419,51 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             except OSError:
                                 pass
                 iface.step('    Deleted temporary files.')
-            step_number += 1
+        if dag and not ipy:
+            '''Start each step as soon as the steps whose outputs it reads
+            have finished, so independent branches of the job flow overlap.
+            Steps share the pool, which balances their tasks.'''
+            dependencies = step_dependencies(steps)
+            step_names = steps.keys()
+            finished_steps = Queue.Queue()
+            def run_step_and_report(step_number, step):
+                """ Runs step in its own thread; queues any exception. """
+                try:
+                    run_step(step_number, step)
+                except Exception:
+                    finished_steps.put((step_number, sys.exc_info()))
+                else:
+                    finished_steps.put((step_number, None))
+            unfinished_steps = set(xrange(total_steps))
+            started_steps = set()
+            while unfinished_steps:
+                for i in xrange(total_steps):
+                    if i not in started_steps and not (
+                            dependencies[i] & unfinished_steps
+                        ):
+                        step_thread = threading.Thread(
+                                target=run_step_and_report,
+                                args=(i, step_names[i])
+                            )
+                        step_thread.daemon = True
+                        step_thread.start()
+                        started_steps.add(i)
+                # Timeout keeps the wait interruptible by KeyboardInterrupt
+                finished_step, exc_info = finished_steps.get(True, 31536000)
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                unfinished_steps.remove(finished_step)
+                # Earliest step a resumed job flow must start from
+                step_number = min(unfinished_steps | set([total_steps]))
+                clean_up_step(finished_step, step_names[finished_step])
+        else:
+            for step in steps:
+                run_step(step_number, step)
+                clean_up_step(step_number, step)
+                step_number += 1
         if not ipy:
             pool.close()
+        step_data = steps.values()[-1]
         if not keep_last_output and not keep_intermediates:
             try:
                 os.remove(step_data['output'])
@@ -2027,11 +3514,12 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             if step_number != 0 else None))
             else:
                 iface.fail()
-        if 'split_input_dir' in locals():
+        if 'split_input_dirs' in locals():
             '''raise below refers to last exception, so can't try-except
             OSError here'''
-            if os.path.isdir(split_input_dir):
-                shutil.rmtree(split_input_dir)
+            for split_input_dir in split_input_dirs.values():
+                if os.path.isdir(split_input_dir):
+                    shutil.rmtree(split_input_dir)
         raise
     except (KeyboardInterrupt, SystemExit):
         if 'interrupt_engines' in locals():
@@ -2045,13 +3533,173 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         if 'pool' in locals() and 'interrupt_engines' not in locals():
             pool.terminate()
             pool.join()
-        if 'split_input_dir' in locals():
-            try:
-                shutil.rmtree(split_input_dir)
-            except OSError:
-                pass
+        if 'split_input_dirs' in locals():
+            for split_input_dir in split_input_dirs.values():
+                try:
+                    shutil.rmtree(split_input_dir)
+                except OSError:
+                    pass
+
+if __name__ == '__main__' and '--test' in sys.argv:
+    import unittest
+
+    class TestStepDependencies(unittest.TestCase):
+
+        def test_rail_job_flow(self):
+            """ Mirrors how Rail's align job flow passes data around. """
+            steps = OrderedDict([
+                    ('Align reads', {
+                        'input' : 'preprocess',
+                        'output' : 'align_reads'
+                    }),
+                    ('Build isofrag index', {
+                        # Writes the transcript archive through --out
+                        'input' : 'junction_fasta,align_reads/dummy',
+                        'output' : 'junction_index'
+                    }),
+                    ('Finalize junction cooccurrences on reads', {
+                        'input' : 'align_reads/unique',
+                        'output' : 'cojunction_enum',
+                        'archives' : '/tmp/transcript_index.tar.gz#tr'
+                    }),
+                    ('Collapse', {
+                        'input' : 'cojunction_enum',
+                        'output' : 'collapse'
+                    }),
+                    ('Write mapped read counts', {
+                        # Writes the counts file through --out
+                        'input' : 'align_reads/counts',
+                        'output' : 'read_counts'
+                    }),
+                    ('Compile sample coverages', {
+                        'input' : 'collapse',
+                        'output' : 'precoverage',
+                        'files' : '/tmp/counts.tsv.gz#counts.tsv.gz'
+                    }),
+                    ('Write bigwigs', {
+                        'input' : 'precoverage/coverage',
+                        'output' : 'coverage'
+                    })
+                ])
+            self.assertEqual(step_dependencies(steps), [
+                    set(),
+                    set([0]),
+                    set([0, 1]),
+                    set([2]),
+                    set([0]),
+                    set([0, 1, 2, 3, 4]),
+                    set([5])
+                ])
+
+        def test_nested_paths(self):
+            steps = OrderedDict([
+                    ('a', {'input' : 'in', 'output' : 'out/a'}),
+                    ('b', {'input' : 'out', 'output' : 'out2'}),
+                    ('c', {'input' : 'out2/part', 'output' : 'out3'}),
+                    ('d', {'input' : 'in,out3', 'output' : 'out4'})
+                ])
+            self.assertEqual(step_dependencies(steps),
+                             [set(), set([0]), set([1]), set([2])])
+
+    class TestPresortedTasks(unittest.TestCase):
+
+        def setUp(self):
+            from records import RecordWriter
+            self.temp_dir = tempfile.mkdtemp()
+            self.output_dir = os.path.join(self.temp_dir, 'tasks')
+            os.makedirs(self.output_dir)
+            self.binary = os.path.join(self.temp_dir, 'binary')
+            with open(self.binary, 'wb') as binary_stream:
+                writer = RecordWriter(binary_stream, 'si', 's')
+                for fields in [('chr2', 5, 'a'), ('chr1', 10, 'b'),
+                               ('chr1', 2, 'c')]:
+                    writer.write(fields)
+            self.text = os.path.join(self.temp_dir, 'text')
+            with open(self.text, 'w') as text_stream:
+                text_stream.write('chr1\t3\td\n')
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir)
+
+        def presorted_tasks(self, input_files, sort_options='-k1,1 -k2,2n',
+                                combiner=None):
+            return presorted_tasks(input_files, 0, sort_options,
+                                   self.output_dir, 2, '\t', '-k1,1', 1,
+                                   1024, combiner=combiner)
+
+        def test_binary(self):
+            self.assertEqual(self.presorted_tasks([self.binary]), None)
+            with open(os.path.join(self.output_dir, '0.0.0')) as run_stream:
+                self.assertEqual(
+                        [decoded_key(record) for record
+                            in RecordReader(run_stream).readrecords()],
+                        [('chr1', '2'), ('chr1', '10'), ('chr2', '5')]
+                    )
+
+        def test_mixed_inputs(self):
+            self.assertTrue('mix binary records with text lines' in
+                            self.presorted_tasks([self.binary, self.text]))
+            self.assertEqual(os.listdir(self.output_dir), [])
+
+        def test_reverse_sort_on_binary(self):
+            self.assertTrue('are unsupported for binary records' in
+                            self.presorted_tasks([self.binary],
+                                                 '-k1,1 -k2,2nr'))
+            self.assertTrue('are unsupported for binary records' in
+                            self.presorted_tasks([self.binary], '-u'))
+            self.assertEqual(os.listdir(self.output_dir), [])
+
+        def test_gzipped_tasks(self):
+            self.assertEqual(
+                    presorted_tasks([self.text, self.text], 0, '-k1,1',
+                                    self.output_dir, 2, '\t', '-k1,1', 40,
+                                    1024, gzip=True),
+                    None
+                )
+            task_files = glob.glob(os.path.join(self.output_dir, '*.gz'))
+            self.assertEqual(len(task_files), 1)
+            task_stream = yopen(None, task_files[0])
+            self.assertEqual(task_stream.read(), 'chr1\t3\td\n' * 2)
+            task_stream.close()
+
+        def test_combiner_on_binary(self):
+            self.assertTrue('can\'t be run on binary records' in
+                            self.presorted_tasks([self.binary],
+                                                 combiner='cat'))
+            self.assertEqual(os.listdir(self.output_dir), [])
+
+    class TestGzipThreads(unittest.TestCase):
+
+        def setUp(self):
+            self.temp_dir = tempfile.mkdtemp()
+            self.old_environ = os.environ.copy()
+
+        def tearDown(self):
+            os.environ.clear()
+            os.environ.update(self.old_environ)
+            shutil.rmtree(self.temp_dir)
+
+        def test_set_gzip_threads(self):
+            import multiprocessing
+            self.assertEqual(set_gzip_threads(None, 1),
+                             multiprocessing.cpu_count())
+            # Every process gets at least one thread
+            self.assertEqual(set_gzip_threads(None, 10 ** 6), 1)
+            self.assertEqual(set_gzip_threads(3, 10 ** 6), 3)
+            self.assertEqual(os.environ[_gzip_threads_variable], '3')
+            gzip_file = os.path.join(self.temp_dir, 'test.gz')
+            gzip_stream = gzip_into(3, gzip_file)
+            self.assertEqual(gzip_stream.threads, 3)
+            gzip_stream.write('line\n')
+            gzip_stream.close()
+            gzip_stream = yopen(None, gzip_file)
+            self.assertEqual(gzip_stream.threads, 3)
+            self.assertEqual(gzip_stream.read(), 'line\n')
+            gzip_stream.close()
+            self.assertEqual(gzip_into(3, gzip_file, threads=2).threads, 2)
 
-if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0]])
+elif __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, 
                     formatter_class=argparse.RawDescriptionHelpFormatter)
     add_args(parser)
@@ -2063,4 +3711,6 @@ if __name__ == '__main__':
                     args.log, args.gzip_outputs, args.gzip_level,
                     args.ipy, args.ipcontroller_json, args.ipy_profile,
                     args.scratch, args.common, args.sort, args.max_attempts,
-                    args.direct_write)
+                    args.direct_write, args.builtin_sort, args.dag,
+                    args.speculative, args.warm_workers, args.profile,
+                    args.gzip_threads)
@@ -160,6 +160,8 @@ class DooplicityInterface(object):
         print '\n~.oOo.>\n'
         sys.stdout.flush()
         self._update_thread = UpdateThread(self._start_time)
+        # Serializes console updates from concurrently running steps
+        self._lock = threading.RLock()
 
     def step(self, message):
         """ Writes a step start/finish message to the console.
@@ -168,25 +170,26 @@ class DooplicityInterface(object):
 
             No return value.
         """
-        # Pause update_thread
-        self._update_thread.stop.set()
-        try:
-            self._update_thread.join()
-        except RuntimeError:
-            # Thread hasn't started
-            pass
-        # Clear a line
-        sys.stdout.write('\r\x1b[K')
-        sys.stdout.flush()
-        m, s = divmod(time.time() - self._start_time, 60)
-        h, m = divmod(m, 60)
-        for output_stream in self._write_streams:
-            print >>output_stream, '%02dh:%02dm:%02ds |___| %s' \
-                                    % (h, m, s, message)
-            output_stream.flush()
-        # Restart self._update_thread
-        self._update_thread = UpdateThread(self._start_time)
-        self._update_thread.start()
+        with self._lock:
+            # Pause update_thread
+            self._update_thread.stop.set()
+            try:
+                self._update_thread.join()
+            except RuntimeError:
+                # Thread hasn't started
+                pass
+            # Clear a line
+            sys.stdout.write('\r\x1b[K')
+            sys.stdout.flush()
+            m, s = divmod(time.time() - self._start_time, 60)
+            h, m = divmod(m, 60)
+            for output_stream in self._write_streams:
+                print >>output_stream, '%02dh:%02dm:%02ds |___| %s' \
+                                        % (h, m, s, message)
+                output_stream.flush()
+            # Restart self._update_thread
+            self._update_thread = UpdateThread(self._start_time)
+            self._update_thread.start()
 
     def status(self, message):
         """ Changes status message next to timer on console.
@@ -195,15 +198,16 @@ class DooplicityInterface(object):
 
             No return valuee.
         """
-        self._update_thread.stop.set()
-        try:
-            self._update_thread.join()
-        except RuntimeError:
-            # Thread hasn't started
-            pass
-        self._update_thread = UpdateThread(self._start_time)
-        self._update_thread.message = message
-        self._update_thread.start()
+        with self._lock:
+            self._update_thread.stop.set()
+            try:
+                self._update_thread.join()
+            except RuntimeError:
+                # Thread hasn't started
+                pass
+            self._update_thread = UpdateThread(self._start_time)
+            self._update_thread.message = message
+            self._update_thread.start()
 
     def fail(self, message='', steps=[],
              opener='*****Errors encountered*****',
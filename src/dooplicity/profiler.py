@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+profiler.py
+Part of Dooplicity framework
+
+A sampling CPU profiler for streaming commands that are Python scripts.
+
+Running
+
+python profiler.py <script> [arg 1] [arg 2] ...
+
+runs the script as though it were the main program while a timer
+interrupts it every _interval seconds of CPU time to record the stack it's
+executing. Since stacks are only recorded when the process is using CPU,
+time spent waiting on pipes and subprocesses isn't counted, and since
+there are only 1/_interval samples per CPU second, overhead is a fraction
+of a percent however hot the code is.
+
+When the script exits, its stacks are written to the file
+<prefix>.<pid>.profile, where the prefix is the value of the environment
+variable dooplicity_profile_prefix, in the "folded" format read by
+flamegraph.pl: a line "<root function>;...;<leaf function> <samples>" per
+stack. If the variable isn't set, nothing is written. merge_profiles()
+merges the files in a directory into a single folded file and a report of
+hotspots.
+
+Licensed under the MIT License:
+
+Copyright (c) 2014 Abhi Nellore and Ben Langmead.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import os
+import signal
+import glob
+from collections import defaultdict
+
+# Environment variable naming prefix of files to which stacks are written
+_profile_prefix_variable = 'dooplicity_profile_prefix'
+# Seconds of CPU time between samples
+_interval = 0.01
+# Number of functions listed in a report
+_report_length = 50
+
+def _label(code):
+    """ Names the function a code object belongs to.
+
+        code: code object
+
+        Return value: string "<function> (<file>:<first line>)"; it has no
+            semicolons, which separate functions in folded stacks
+    """
+    return ('%s (%s:%d)' % (code.co_name, code.co_filename,
+                            code.co_firstlineno)).replace(';', ':')
+
+class Sampler(object):
+    """ Records the stacks the main thread executes on a CPU timer.
+
+        Frames at or below the one that calls start() aren't recorded, so
+        stacks start where profiling started.
+    """
+
+    def __init__(self, interval=_interval):
+        """
+        interval: seconds of CPU time between samples
+        """
+        self.interval = interval
+        # Maps tuple of code objects, leaf first, to number of samples
+        self.stacks = defaultdict(int)
+        self.base = None
+        self.old_handler = None
+
+    def _sample(self, signum, frame):
+        """ Signal handler; records stack of interrupted frame. """
+        codes = []
+        base = self.base
+        while frame is not None and frame is not base:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        self.stacks[tuple(codes)] += 1
+
+    def start(self):
+        """ Starts sampling. Must be called from the main thread. """
+        self.base = sys._getframe(1)
+        self.old_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Restart system calls the timer interrupts rather than failing them
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """ Stops sampling. """
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.old_handler or signal.SIG_DFL)
+        self.base = None
+
+    def folded(self):
+        """ Returns dictionary mapping folded stacks to sample counts. """
+        labels, folded = {}, defaultdict(int)
+        for codes, samples in self.stacks.iteritems():
+            for code in codes:
+                if code not in labels:
+                    labels[code] = _label(code)
+            folded[';'.join(labels[code] for code in reversed(codes))] \
+                += samples
+        return folded
+
+def write_folded(folded, filename):
+    """ Writes stacks in folded format, replacing any file atomically.
+
+        folded: dictionary mapping folded stacks to sample counts
+        filename: file to write
+
+        No return value.
+    """
+    temp_file = filename + '.temp'
+    with open(temp_file, 'w') as folded_stream:
+        for stack, samples in sorted(folded.iteritems()):
+            print >>folded_stream, '%s %d' % (stack, samples)
+    os.rename(temp_file, filename)
+
+def read_folded(filename, folded=None):
+    """ Reads stacks in folded format.
+
+        filename: file to read
+        folded: dictionary mapping folded stacks to sample counts to which
+            those read are added, or None for a new one
+
+        Return value: folded
+    """
+    if folded is None:
+        folded = defaultdict(int)
+    with open(filename) as folded_stream:
+        for line in folded_stream:
+            stack, _, samples = line.rstrip('\n').rpartition(' ')
+            if stack:
+                folded[stack] += int(samples)
+    return folded
+
+def hotspots(folded):
+    """ Totals samples by function.
+
+        folded: dictionary mapping folded stacks to sample counts
+
+        Return value: list of tuples (self samples, total samples, function)
+            sorted by self samples and then total samples, both descending.
+            A function's self samples are those in which it's the leaf;
+            its total samples are those in which it appears anywhere.
+    """
+    self_samples, total_samples = defaultdict(int), defaultdict(int)
+    for stack, samples in folded.iteritems():
+        functions = stack.split(';')
+        self_samples[functions[-1]] += samples
+        for function in set(functions):
+            total_samples[function] += samples
+    return sorted(((self_samples[function], samples, function)
+                    for function, samples in total_samples.iteritems()),
+                  key=lambda hotspot: (-hotspot[0], -hotspot[1], hotspot[2]))
+
+def merge_profiles(profile_dir, interval=_interval,
+                    report_length=_report_length):
+    """ Merges profiles written in a directory and reports hotspots.
+
+        Writes profile.folded, the merged stacks, for flamegraph.pl, and
+        profile.txt, the report_length functions with the most self
+        samples, then deletes the files that were merged. Does nothing if
+        there are none.
+
+        profile_dir: directory with files <prefix>.<pid>.profile
+        interval: seconds of CPU time between samples
+        report_length: number of functions to report
+
+        Return value: number of samples merged
+    """
+    profile_files = glob.glob(os.path.join(profile_dir, '*.profile'))
+    if not profile_files:
+        return 0
+    folded = defaultdict(int)
+    for profile_file in profile_files:
+        read_folded(profile_file, folded)
+    write_folded(folded, os.path.join(profile_dir, 'profile.folded'))
+    sample_count = sum(folded.itervalues())
+    with open(os.path.join(profile_dir, 'profile.txt'), 'w') as report:
+        print >>report, ('%d samples, about %.2f CPU seconds, from %s'
+                            % (sample_count, sample_count * interval,
+                                profile_dir))
+        print >>report, '%8s %8s  %s' % ('self %', 'total %', 'function')
+        for self_samples, total_samples, function \
+                in hotspots(folded)[:report_length]:
+            print >>report, '%8.2f %8.2f  %s' % (
+                    100. * self_samples / sample_count,
+                    100. * total_samples / sample_count,
+                    function
+                )
+    for profile_file in profile_files:
+        os.remove(profile_file)
+    return sample_count
+
+def _finish(sampler, filename, profiler_module):
+    """ Stops sampler and writes its stacks; registered with atexit.
+
+        profiler_module is unused, but holding it keeps this module's
+        globals from being cleared after the script replaces __main__.
+    """
+    sampler.stop()
+    write_folded(sampler.folded(), filename)
+
+def run_script(script_args):
+    """ Runs a Python script as the main program, profiling it.
+
+        script_args: list [script, arg 1, arg 2, ...]
+
+        No return value.
+    """
+    import atexit
+    import imp
+    script_path = os.path.abspath(script_args[0])
+    sys.argv = [script_path] + script_args[1:]
+    # The script should import modules from its own directory, not this one
+    sys.path[0] = os.path.dirname(script_path)
+    script = imp.new_module('__main__')
+    script.__file__ = script_path
+    prefix = os.environ.get(_profile_prefix_variable)
+    if prefix:
+        sampler = Sampler()
+        '''Registered before the script registers anything, so it runs after
+        the script's exit functions.'''
+        atexit.register(_finish, sampler,
+                        '%s.%d.profile' % (prefix, os.getpid()),
+                        sys.modules['__main__'])
+        sys.modules['__main__'] = script
+        sampler.start()
+    else:
+        sys.modules['__main__'] = script
+    execfile(script_path, script.__dict__)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        import unittest
+        import tempfile
+        import shutil
+
+        class TestSampler(unittest.TestCase):
+
+            def test_samples_busy_function(self):
+                def spin():
+                    total = 0
+                    for i in xrange(3000000):
+                        total += i
+                    return total
+                sampler = Sampler(interval=0.001)
+                sampler.start()
+                try:
+                    spin()
+                finally:
+                    sampler.stop()
+                folded = sampler.folded()
+                self.assertTrue(folded)
+                hottest = hotspots(folded)[0]
+                self.assertTrue(hottest[2].startswith('spin ('))
+                # Stacks start at the frame that started the sampler
+                for stack in folded:
+                    self.assertFalse('test_samples_busy_function' in stack)
+
+        class TestMergeProfiles(unittest.TestCase):
+
+            def setUp(self):
+                self.temp_dir = tempfile.mkdtemp()
+
+            def tearDown(self):
+                shutil.rmtree(self.temp_dir)
+
+            def test_hotspots(self):
+                self.assertEqual(hotspots({'a;b;c' : 3, 'a;b' : 2,
+                                           'a;c;c' : 1}),
+                                 [(4, 4, 'c'), (2, 5, 'b'), (0, 6, 'a')])
+
+            def test_merge(self):
+                write_folded({'main;f' : 3, 'main;g' : 1},
+                             os.path.join(self.temp_dir, '0.10.profile'))
+                write_folded({'main;f' : 2},
+                             os.path.join(self.temp_dir, '1.11.profile'))
+                self.assertEqual(merge_profiles(self.temp_dir), 6)
+                self.assertEqual(
+                        sorted(os.listdir(self.temp_dir)),
+                        ['profile.folded', 'profile.txt']
+                    )
+                self.assertEqual(
+                        dict(read_folded(os.path.join(self.temp_dir,
+                                                      'profile.folded'))),
+                        {'main;f' : 5, 'main;g' : 1}
+                    )
+                with open(os.path.join(self.temp_dir, 'profile.txt')) \
+                        as report:
+                    lines = report.read().split('\n')
+                self.assertEqual(lines[2].split(), ['83.33', '83.33', 'f'])
+                self.assertEqual(merge_profiles(self.temp_dir), 0)
+
+        unittest.main(argv=[sys.argv[0]])
+    elif sys.argv[1:]:
+        run_script(sys.argv[1:])
+    else:
+        print >>sys.stderr, ('Usage: python profiler.py <script> '
+                             '[arg 1] [arg 2] ...')
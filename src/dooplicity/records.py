@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+"""
+records.py
+Part of Dooplicity framework
+
+A compact binary format for intermediate records, an optional alternative
+to tab-separated lines between steps.
+
+A record is a varint giving the length of its body followed by the body.
+The body is the record's key fields, a zero byte, and its value fields.
+Each field starts with a byte giving its type.
+
+Key fields are strings or integers encoded so that comparing the encoded
+bytes orders keys the way sort -k<field>,<field> (with n for integers)
+would. An encoded key never starts with the encoding of a different key, so
+a record's body is its own sort key: bodies sort first by key and then by
+value. Integers need no zero-padding.
+
+Value fields are strings, which are length-prefixed; integers, which are
+zigzag varints; and sequences, whose bases are packed into 2 bits each,
+with anything besides A, C, G, and T recorded separately as runs.
+
+A stream of records starts with MAGIC, which is a record of length zero
+followed by the bytes 'DPR'. Because MAGIC can be skipped wherever a record
+could start, concatenated record streams are still a record stream.
+
+Licensed under the MIT License:
+
+Copyright (c) 2014 Abhi Nellore and Ben Langmead.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import string
+
+MAGIC = '\x00DPR'
+# Number of bytes read from a stream at once
+_block_size = 1048576
+
+# Type bytes of fields
+_STRING = '\x01'
+_INTEGER = '\x02'
+_SEQUENCE = '\x03'
+# Ends a record's key fields
+_END_OF_KEY = '\x00'
+
+_bases = 'ACGT'
+# Maps each string of four bases to the byte that packs it and back
+_packed_quad, _unpacked_byte = {}, {}
+for _i in xrange(256):
+    _quad = ''.join([_bases[(_i >> _shift) & 3] for _shift in (6, 4, 2, 0)])
+    _packed_quad[_quad] = chr(_i)
+    _unpacked_byte[chr(_i)] = _quad
+# Replaces every character besides A, C, G, and T with A
+_acgt_translation_table = string.maketrans(
+        ''.join([chr(_i) for _i in xrange(256) if chr(_i) not in _bases]),
+        'A' * (256 - len(_bases))
+    )
+
+def _varint(n):
+    """ Encodes a nonnegative integer as a varint.
+
+        n: nonnegative integer
+
+        Return value: varint, 7 bits per byte, least significant first
+    """
+    if n < 0x80:
+        return chr(n)
+    encoded = []
+    while n >= 0x80:
+        encoded.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    encoded.append(chr(n))
+    return ''.join(encoded)
+
+def _read_varint(data, position):
+    """ Decodes a varint.
+
+        data: string containing varint
+        position: where varint starts in data
+
+        Return value: tuple (decoded integer, position after varint)
+    """
+    byte = ord(data[position])
+    if byte < 0x80:
+        return byte, position + 1
+    n, shift = 0, 0
+    while byte >= 0x80:
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        position += 1
+        byte = ord(data[position])
+    return n | (byte << shift), position + 1
+
+def _key_integer(n):
+    """ Encodes an integer so encodings of integers sort like integers.
+
+        A byte 0x80 + L for a nonnegative integer, or 0x7f - L for a
+        negative one, is followed by the integer in L big-endian bytes,
+        where L is the fewest bytes needed; a negative integer is offset by
+        256 ** L to make it nonnegative.
+
+        n: integer
+
+        Return value: encoded integer
+    """
+    if n >= 0:
+        magnitude, prefix = n, 0x80
+    else:
+        magnitude, prefix = ~n, 0x7f
+    payload = []
+    while magnitude:
+        payload.append(magnitude & 0xff)
+        magnitude >>= 8
+    if n >= 0:
+        prefix += len(payload)
+    else:
+        prefix -= len(payload)
+        n += 256 ** len(payload)
+        payload = []
+        for _ in xrange(0x7f - prefix):
+            payload.append(n & 0xff)
+            n >>= 8
+    return chr(prefix) + ''.join([chr(byte) for byte in reversed(payload)])
+
+def _key_field(field, field_type):
+    """ Encodes a key field.
+
+        field: string or integer
+        field_type: 's' for a string or 'i' for an integer
+
+        Return value: encoded key field
+    """
+    if field_type == 's':
+        return ''.join([_STRING, str(field).replace('\x00', '\x00\xff'),
+                        '\x00\x00'])
+    if field_type == 'i':
+        return _INTEGER + _key_integer(int(field))
+    raise ValueError('Key field type "%s" is invalid.' % field_type)
+
+def _packed_sequence(seq):
+    """ Packs a sequence into 2 bits per base.
+
+        seq: string, usually of A, C, G, T, and N
+
+        Return value: varint length of sequence, packed bases with anything
+            besides A, C, G, and T packed as A, varint number of runs of
+            other characters, then for each such run the varint number of
+            bases since the previous run ended, the varint length of the
+            run, and the character repeated in it
+    """
+    length = len(seq)
+    padded = seq.translate(_acgt_translation_table) + 'A' * (-length % 4)
+    encoded = [_SEQUENCE, _varint(length), ''.join([
+            _packed_quad[padded[i:i+4]] for i in xrange(0, length, 4)
+        ])]
+    if not seq.translate(None, _bases):
+        encoded.append('\x00')
+        return ''.join(encoded)
+    runs, last_end, i = [], 0, 0
+    while i < length:
+        if seq[i] in _bases:
+            i += 1
+            continue
+        start = i
+        while i < length and seq[i] == seq[start]:
+            i += 1
+        runs.append(''.join([_varint(start - last_end),
+                             _varint(i - start), seq[start]]))
+        last_end = i
+    encoded.append(_varint(len(runs)))
+    encoded.extend(runs)
+    return ''.join(encoded)
+
+def _value_field(field, field_type):
+    """ Encodes a value field.
+
+        field: string or integer
+        field_type: 's' for a string, 'i' for an integer, or 'q' for a
+            sequence
+
+        Return value: encoded value field
+    """
+    if field_type == 's':
+        field = str(field)
+        return ''.join([_STRING, _varint(len(field)), field])
+    if field_type == 'i':
+        n = int(field)
+        # Zigzag: 0, -1, 1, -2, ... become 0, 1, 2, 3, ...
+        return _INTEGER + _varint((n << 1) if n >= 0 else ((~n << 1) | 1))
+    if field_type == 'q':
+        return _packed_sequence(str(field))
+    raise ValueError('Value field type "%s" is invalid.' % field_type)
+
+def record(fields, key_types, value_types):
+    """ Encodes fields as a record.
+
+        fields: sequence of key fields followed by value fields, each a
+            string or integer
+        key_types: string with a character for each key field: 's' for a
+            string or 'i' for an integer
+        value_types: string with a character for each value field: 's' for
+            a string, 'i' for an integer, or 'q' for a sequence
+
+        Return value: record, including its length
+    """
+    if len(fields) != len(key_types) + len(value_types):
+        raise ValueError('%d fields were given, but %d types were.'
+                            % (len(fields),
+                                len(key_types) + len(value_types)))
+    if not key_types:
+        raise ValueError('A record must have at least one key field.')
+    key_count = len(key_types)
+    body = ''.join(
+            [_key_field(field, field_type)
+                for field, field_type in zip(fields, key_types)]
+            + [_END_OF_KEY]
+            + [_value_field(field, field_type)
+                for field, field_type in zip(fields[key_count:],
+                                                value_types)]
+        )
+    return _varint(len(body)) + body
+
+def _decoded_key_field(body, position):
+    """ Decodes a key field.
+
+        body: record body
+        position: where key field starts in body
+
+        Return value: tuple (field as a string, position after field)
+    """
+    field_type = body[position]
+    position += 1
+    if field_type == _STRING:
+        end = body.find('\x00', position)
+        while body[end + 1] == '\xff':
+            end = body.find('\x00', end + 2)
+        return (body[position:end].replace('\x00\xff', '\x00'), end + 2)
+    if field_type == _INTEGER:
+        prefix = ord(body[position])
+        if prefix >= 0x80:
+            size = prefix - 0x80
+        else:
+            size = 0x7f - prefix
+        n = 0
+        for byte in body[position + 1:position + 1 + size]:
+            n = (n << 8) | ord(byte)
+        if prefix < 0x80:
+            n -= 256 ** size
+        return str(n), position + 1 + size
+    raise ValueError('Key field type byte %r is invalid.' % field_type)
+
+def _decoded_value_field(body, position):
+    """ Decodes a value field.
+
+        body: record body
+        position: where value field starts in body
+
+        Return value: tuple (field as a string, position after field)
+    """
+    field_type = body[position]
+    if field_type == _STRING:
+        length, position = _read_varint(body, position + 1)
+        return body[position:position + length], position + length
+    if field_type == _INTEGER:
+        n, position = _read_varint(body, position + 1)
+        return str((n >> 1) if not n & 1 else ~(n >> 1)), position
+    if field_type == _SEQUENCE:
+        length, position = _read_varint(body, position + 1)
+        end = position + (length + 3) // 4
+        seq = ''.join([_unpacked_byte[byte]
+                        for byte in body[position:end]])[:length]
+        run_count, position = _read_varint(body, end)
+        if not run_count:
+            return seq, position
+        pieces, last_end = [], 0
+        for _ in xrange(run_count):
+            gap, position = _read_varint(body, position)
+            run_length, position = _read_varint(body, position)
+            start = last_end + gap
+            pieces.append(seq[last_end:start])
+            pieces.append(body[position] * run_length)
+            position += 1
+            last_end = start + run_length
+        pieces.append(seq[last_end:])
+        return ''.join(pieces), position
+    raise ValueError('Value field type byte %r is invalid.' % field_type)
+
+def body(record):
+    """ Strips the length from a record.
+
+        Records sort by key and then value when sorted by body.
+
+        record: record, including its length
+
+        Return value: record's body
+    """
+    position = 0
+    while ord(record[position]) >= 0x80:
+        position += 1
+    return record[position + 1:]
+
+def decoded_key(record):
+    """ Decodes a record's key fields.
+
+        record: record, including its length
+
+        Return value: tuple of key fields as strings
+    """
+    record_body = body(record)
+    fields, position = [], 0
+    while record_body[position] != _END_OF_KEY:
+        field, position = _decoded_key_field(record_body, position)
+        fields.append(field)
+    return tuple(fields)
+
+def decoded(record):
+    """ Decodes a record.
+
+        record: record, including its length
+
+        Return value: tuple of key fields followed by value fields, all
+            as strings
+    """
+    record_body = body(record)
+    fields, position = [], 0
+    while record_body[position] != _END_OF_KEY:
+        field, position = _decoded_key_field(record_body, position)
+        fields.append(field)
+    position += 1
+    end = len(record_body)
+    while position < end:
+        field, position = _decoded_value_field(record_body, position)
+        fields.append(field)
+    return tuple(fields)
+
+def is_record_stream(data):
+    """ Checks whether data starts a stream of records.
+
+        data: first bytes of a stream, at least len(MAGIC) of them if the
+            stream is that long
+
+        Return value: True iff data starts with MAGIC
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+class RecordReader(object):
+    """ Reads records from a stream.
+
+        Copies of MAGIC are skipped wherever they appear.
+    """
+    def __init__(self, input_stream, block_size=_block_size):
+        """
+        input_stream: where to read records; file object with read()
+        block_size: number of bytes to read at once
+        """
+        self.input_stream = input_stream
+        self.block_size = block_size
+        self.buffer = ''
+        # Position in buffer of first byte not yet read
+        self.position = 0
+
+    def _fill(self, size):
+        """ Reads until size bytes are buffered or stream is exhausted.
+
+            size: number of unread bytes to hold in buffer
+
+            Return value: True iff size bytes are buffered
+        """
+        pieces = [self.buffer[self.position:]]
+        buffered = len(pieces[0])
+        while buffered < size:
+            data = self.input_stream.read(max(self.block_size,
+                                                size - buffered))
+            if not data:
+                break
+            pieces.append(data)
+            buffered += len(data)
+        self.buffer, self.position = ''.join(pieces), 0
+        return buffered >= size
+
+    def readrecord(self):
+        """ Reads a record, including its length.
+
+            Return value: record or '' if the stream is exhausted
+        """
+        while True:
+            start = self.position
+            # A varint of 10 bytes holds a length of up to 2 ** 70 - 1
+            if len(self.buffer) - start < 10 and not self._fill(10):
+                if self.position == len(self.buffer):
+                    return ''
+            start = self.position
+            length, position = _read_varint(self.buffer, start)
+            if not length:
+                if not self._fill(len(MAGIC)):
+                    raise IOError('Record stream ends unexpectedly.')
+                if not is_record_stream(self.buffer):
+                    raise IOError('Record of length zero is invalid.')
+                self.position += len(MAGIC)
+                continue
+            end = position + length
+            if end > len(self.buffer):
+                if not self._fill(end - start):
+                    raise IOError('Record stream ends unexpectedly.')
+                start, end = 0, end - start
+            self.position = end
+            return self.buffer[start:end]
+
+    def readrecords(self, sizehint=-1):
+        """ Reads records totaling at least sizehint bytes or to end of
+            stream.
+
+            sizehint: number of bytes of records to read; negative for all
+
+            Return value: list of records
+        """
+        records, size = [], 0
+        while sizehint < 0 or size < sizehint:
+            next_record = self.readrecord()
+            if not next_record:
+                break
+            records.append(next_record)
+            size += len(next_record)
+        return records
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        next_record = self.readrecord()
+        if not next_record:
+            raise StopIteration
+        return next_record
+
+class RecordWriter(object):
+    """ Writes records to a stream, starting it with MAGIC. """
+    def __init__(self, output_stream, key_types, value_types):
+        """
+        output_stream: where to write records
+        key_types: string with a character for each key field: 's' for a
+            string or 'i' for an integer
+        value_types: string with a character for each value field: 's' for
+            a string, 'i' for an integer, or 'q' for a sequence
+        """
+        self.output_stream = output_stream
+        self.key_types = key_types
+        self.value_types = value_types
+        self.started = False
+
+    def write(self, fields):
+        """ Writes fields as a record.
+
+            fields: sequence of key fields followed by value fields, each a
+                string or integer
+
+            No return value.
+        """
+        if not self.started:
+            self.output_stream.write(MAGIC)
+            self.started = True
+        self.output_stream.write(
+                record(fields, self.key_types, self.value_types)
+            )
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    from StringIO import StringIO
+
+    if '--test' in sys.argv:
+
+        class TestRecords(unittest.TestCase):
+            """ Tests record encoding and decoding. """
+
+            def test_round_trip(self):
+                """ Fails if decoded fields differ from encoded fields. """
+                fields = ('chr1\x00+', '-70000', 'ACGTNNNAC', 'x' * 200, '0',
+                            'acgtRYNNA', '', '-1')
+                self.assertEqual(
+                        decoded(record(fields, 'si', 'qsiqsi')), fields
+                    )
+                self.assertEqual(
+                        decoded_key(record(fields, 'si', 'qsiqsi')),
+                        fields[:2]
+                    )
+
+            def test_key_order(self):
+                """ Fails if bodies don't sort like keys. """
+                keys = [(rname, pos) for rname in ['', 'a', 'a\x00', 'ab',
+                                                   'b', 'chr1', 'chr10']
+                            for pos in [-70000, -257, -256, -255, -2, -1, 0,
+                                        1, 255, 256, 70000, 2 ** 40]]
+                shuffled = sorted(keys, key=lambda key: hash(key))
+                self.assertEqual(
+                        [decoded_key(a_record) for a_record in sorted(
+                                [record(key, 'si', '') for key in shuffled],
+                                key=body
+                            )],
+                        [(rname, str(pos)) for rname, pos in sorted(keys)]
+                    )
+
+            def test_stream(self):
+                """ Fails if concatenated record streams don't read back. """
+                output_stream = StringIO()
+                for i in xrange(3):
+                    writer = RecordWriter(output_stream, 's', 'q')
+                    for j in xrange(1000):
+                        writer.write(['read%d.%d' % (i, j),
+                                      'ACGT' * (j % 50) + 'N'])
+                input_stream = StringIO(output_stream.getvalue())
+                records = list(RecordReader(input_stream, block_size=7))
+                self.assertEqual(len(records), 3000)
+                self.assertEqual(decoded(records[-1]),
+                                    ('read2.999', 'ACGT' * 49 + 'N'))
+
+        unittest.main(argv=[sys.argv[0]])
+        sys.exit(0)
@@ -32,13 +32,16 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from itertools import groupby
+from itertools import groupby, imap, islice, izip_longest
+from operator import itemgetter
 import threading
 import signal
 import subprocess
 import gzip
+import zlib
+import struct
 import contextlib
-from collections import defaultdict
+from collections import defaultdict, deque
 import time
 from traceback import format_exc
 import os
@@ -186,12 +189,420 @@ def path_join(unix, *args):
     else:
         return os.path.join(*args)
 
+# Number of uncompressed bytes in each gzip member written by xopen()
+_gzip_block_size = 1048576
+# Default number of threads compressing or decompressing each gzip stream
+_gzip_threads = 1
+'''Environment variable overriding _gzip_threads; the EMR simulator sets it so
+its tasks and the streaming commands they run share CPUs fairly.'''
+_gzip_threads_variable = 'dooplicity_gzip_threads'
+'''Header of a gzip member written by xopen(): magic number, compression
+method, FEXTRA flag, mtime, extra flags, OS, length of extra field, and an
+extra subfield 'DP' holding the size of the whole member in bytes, which lets
+a reader find the next member without decompressing this one.'''
+_member_header = struct.Struct('<BBBBIBBH2sHI')
+_member_trailer = struct.Struct('<II')
+
+def _deflated_member(data, compresslevel):
+    """ Compresses data into a single gzip member; runs in a thread.
+
+        data: string to compress
+        compresslevel: level of compression from 0 to 9
+
+        Return value: gzip member
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                    -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    member_size = (_member_header.size + len(deflated)
+                    + _member_trailer.size)
+    return ''.join([
+            _member_header.pack(31, 139, 8, 4, 0, 0, 255, 8, 'DP', 4,
+                                    member_size),
+            deflated,
+            _member_trailer.pack(zlib.crc32(data) & 0xffffffff,
+                                    len(data) & 0xffffffff)
+        ])
+
+def _inflated_member(body):
+    """ Decompresses the deflated data and trailer of a gzip member.
+
+        Runs in a thread.
+
+        body: everything in a member written by _deflated_member() after its
+            header
+
+        Return value: decompressed data
+    """
+    data = zlib.decompress(body[:-_member_trailer.size], -zlib.MAX_WBITS)
+    crc, size = _member_trailer.unpack(body[-_member_trailer.size:])
+    if crc != zlib.crc32(data) & 0xffffffff or size != len(data) & 0xffffffff:
+        raise IOError('CRC check failed')
+    return data
+
+class _Job(object):
+    """ Function call run by a _WorkerThreads; its result is got later. """
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception:
+            import sys
+            self.error = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def get(self):
+        """ Waits for call to finish.
+
+            Return value: function's return value; any exception it raised
+                is raised here
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+class _WorkerThreads(object):
+    """ Threads running jobs in the order they're submitted.
+
+        multiprocessing.pool.ThreadPool takes a tenth of a second to shut
+        down, which is too long for every file a task opens. Threads here
+        are started only as jobs arrive and are daemons that exit when
+        told to.
+    """
+    def __init__(self, thread_count):
+        """
+        thread_count: maximum number of threads; if 0, jobs are run as
+            they're submitted, on the submitting thread
+        """
+        import Queue
+        self.thread_count = thread_count
+        self.jobs = Queue.Queue()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.run()
+
+    def apply_async(self, function, args):
+        """ Submits a job.
+
+            function: function to call
+            args: tuple of function's arguments
+
+            Return value: _Job object whose get() gives function's return
+                value
+        """
+        job = _Job(function, args)
+        if not self.thread_count:
+            job.run()
+            return job
+        if len(self.threads) < self.thread_count:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.jobs.put(job)
+        return job
+
+    def terminate(self):
+        """ Tells threads to exit once they've finished pending jobs. """
+        for _ in self.threads:
+            self.jobs.put(None)
+
+class ParallelGzipWriter(object):
+    """ Writes a gzip as a series of members compressed on a thread pool.
+
+        Data is cut into blocks of block_size bytes, each of which is
+        compressed into its own gzip member, so blocks can be compressed at
+        once on different threads; zlib releases the GIL while it works.
+        Members are written in order, and since a gzip may be any number of
+        members one after another, gzip -cd and the gzip module read the
+        output as usual.
+    """
+    def __init__(self, filename, mode='wb', compresslevel=9,
+                    threads=_gzip_threads, block_size=_gzip_block_size):
+        """
+        filename: path to file
+        mode: 'w' or 'a', possibly with 'b'
+        compresslevel: level of compression from 0 to 9
+        threads: number of threads compressing blocks; if 0, blocks are
+            compressed by the thread writing them, which costs no threads or
+            memory for blocks waiting to be written when many files are
+            open at once
+        block_size: number of uncompressed bytes per gzip member
+        """
+        self.name = filename
+        self.output_stream = open(filename, 'ab' if 'a' in mode else 'wb')
+        self.compresslevel = compresslevel
+        self.threads = max(threads, 0)
+        self.block_size = block_size
+        self.pool = _WorkerThreads(self.threads)
+        # Members being compressed, in the order they're written
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.members_written = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _write_pending(self, limit):
+        """ Writes compressed members until at most limit are pending. """
+        while len(self.pending) > limit:
+            self.output_stream.write(self.pending.popleft().get())
+            self.members_written += 1
+
+    def _submit(self, final=False):
+        """ Sends buffered data to be compressed in blocks.
+
+            final: True iff a block smaller than block_size may be sent
+
+            No return value.
+        """
+        data = ''.join(self.buffer)
+        start, end = 0, len(data)
+        while end - start >= self.block_size or (final and start < end):
+            self.pending.append(self.pool.apply_async(
+                    _deflated_member,
+                    (data[start:start + self.block_size],
+                        self.compresslevel)
+                ))
+            start += self.block_size
+            # Bound memory: keep a couple of blocks queued per thread
+            self._write_pending(2 * self.threads)
+        self.buffer = [data[start:]] if start < end else []
+        self.buffered = end - start if start < end else 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.buffered >= self.block_size:
+                self._submit()
+
+    def flush(self):
+        """ Compresses and writes everything written so far. """
+        self._submit(final=True)
+        self._write_pending(0)
+        self.output_stream.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(final=True)
+            if not self.members_written and not self.pending:
+                # An empty gzip is still a gzip
+                self.pending.append(self.pool.apply_async(
+                        _deflated_member, ('', self.compresslevel)
+                    ))
+            self._write_pending(0)
+        finally:
+            self.pool.terminate()
+            self.output_stream.close()
+
+class ParallelGzipReader(object):
+    """ Reads a gzip, decompressing members on a thread pool.
+
+        Members written by ParallelGzipWriter record their sizes, so they're
+        read whole and decompressed ahead on threads. Any other member is
+        decompressed in this thread as it's read. Like xopen() always has
+        been, the reader is forgiving of gzips that end unexpectedly.
+    """
+    def __init__(self, filename, threads=_gzip_threads,
+                    block_size=_gzip_block_size):
+        """
+        filename: path to file
+        threads: number of threads decompressing members
+        block_size: number of compressed bytes to read at once from a
+            member not written by ParallelGzipWriter
+        """
+        self.name = filename
+        self.raw = open(filename, 'rb')
+        self.threads = max(threads, 1)
+        self.block_size = block_size
+        self.pool = _WorkerThreads(self.threads)
+        self.pieces = self._pieces()
+        self.buffer = ''
+        # Position in buffer of first byte not yet read
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.terminate()
+        self.raw.close()
+
+    def _streamed_member(self, offset):
+        """ Decompresses a member of unknown size in this thread.
+
+            offset: offset of member in file
+
+            Yield value: decompressed data
+        """
+        self.raw.seek(offset)
+        decompressor = zlib.decompressobj(31)
+        while True:
+            compressed = self.raw.read(self.block_size)
+            if not compressed:
+                data = decompressor.flush()
+                if data:
+                    yield data
+                return
+            try:
+                data = decompressor.decompress(compressed)
+            except zlib.error:
+                if offset != self.raw.tell() - len(compressed) \
+                        or compressed.strip('\x00'):
+                    raise
+                # Be forgiving of padding after the last member
+                self.raw.seek(0, os.SEEK_END)
+                return
+            if data:
+                yield data
+            if decompressor.unused_data:
+                # Rewind to the start of the next member
+                self.raw.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+                return
+
+    def _pieces(self):
+        """ Yields decompressed data from successive members, in order. """
+        pending = deque()
+        while True:
+            offset = self.raw.tell()
+            header = self.raw.read(_member_header.size)
+            if not header:
+                break
+            body = None
+            if len(header) == _member_header.size:
+                fields = _member_header.unpack(header)
+                if fields[:4] == (31, 139, 8, 4) \
+                        and fields[7:10] == (8, 'DP', 4):
+                    body_size = fields[10] - _member_header.size
+                    body = self.raw.read(body_size)
+                    if len(body) != body_size:
+                        # Truncated
+                        body = None
+            if body is not None:
+                pending.append(self.pool.apply_async(
+                        _inflated_member, (body,)
+                    ))
+                while len(pending) > 2 * self.threads:
+                    yield pending.popleft().get()
+                continue
+            while pending:
+                yield pending.popleft().get()
+            for data in self._streamed_member(offset):
+                yield data
+        while pending:
+            yield pending.popleft().get()
+
+    def _fill(self):
+        """ Appends next decompressed data to buffer.
+
+            Return value: False iff there's nothing left to decompress
+        """
+        for data in self.pieces:
+            if data:
+                self.buffer = self.buffer[self.position:] + data
+                self.position = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        """ Reads up to size bytes; reads rest of file if size < 0. """
+        while size < 0 or len(self.buffer) - self.position < size:
+            if not self._fill():
+                break
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(self.position + size, len(self.buffer))
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+    def readline(self):
+        """ Reads a line, including its trailing newline if present. """
+        while True:
+            newline = self.buffer.find('\n', self.position)
+            if newline != -1:
+                line = self.buffer[self.position:newline + 1]
+                self.position = newline + 1
+                return line
+            if not self._fill():
+                line = self.buffer[self.position:]
+                self.buffer, self.position = '', 0
+                return line
+
+    def readlines(self, sizehint=-1):
+        """ Reads lines totaling at least sizehint bytes or to end of file.
+        """
+        lines, size = [], 0
+        while sizehint < 0 or size < sizehint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            size += len(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+def gzip_threads():
+    """ Gets number of threads (de)compressing each gzip stream by default.
+
+        Return value: value of environment variable dooplicity_gzip_threads
+            if it's a positive integer; otherwise, _gzip_threads
+    """
+    try:
+        return max(int(os.environ[_gzip_threads_variable]), 1)
+    except (KeyError, ValueError):
+        return _gzip_threads
+
 @contextlib.contextmanager
-def xopen(gzipped, *args):
+def xopen(gzipped, *args, **kwargs):
     """ Passes args on to the appropriate opener, gzip or regular.
 
-        In compressed mode, functionality almost mimics gzip.open,
-        but uses gzip at command line.
+        In compressed mode, functionality almost mimics gzip.open, but
+        reading and writing are done by ParallelGzipReader and
+        ParallelGzipWriter, which (de)compress blocks on a thread pool.
 
         As of PyPy 2.5, gzip.py appears to leak memory when writing to
         a file object created with gzip.open().
@@ -199,17 +610,20 @@ def xopen(gzipped, *args):
         gzipped: True iff gzip.open() should be used to open rather than
             open(); False iff open() should be used; None if input should be
             read and guessed; '-' if writing to stdout
-        *args: unnamed arguments to pass
+        *args: unnamed arguments to pass; the third, if present, is the
+            level of gzip compression, which is 9 by default
+        **kwargs: threads, the number of threads (de)compressing a gzip;
+            gzip_threads() by default
 
         Yield value: file object
     """
     import sys
+    threads = kwargs.get('threads') or gzip_threads()
     if gzipped == '-':
         fh = sys.stdout
     else:
         if not args:
             raise IOError('Must provide filename')
-        import gzip
         if gzipped is None:
             with open(args[0], 'rb') as binary_input_stream:
                 # Check for magic number
@@ -223,25 +637,14 @@ def xopen(gzipped, *args):
             except IndexError:
                 mode = 'rb'
             if 'r' in mode:
-                # Be forgiving of gzips that end unexpectedly
-                old_read_eof = gzip.GzipFile._read_eof
-                gzip.GzipFile._read_eof = lambda *args, **kwargs: None
-                fh = gzip.open(*args)
+                fh = ParallelGzipReader(args[0], threads=threads)
             elif 'w' in mode or 'a' in mode:
                 try:
                     compresslevel = int(args[2])
                 except IndexError:
                     compresslevel = 9
-                if 'w' in mode:
-                    output_stream = open(args[0], 'wb')
-                else:
-                    output_stream = open(args[0], 'ab')
-                gzip_process = subprocess.Popen(['gzip',
-                                                    '-%d' % compresslevel],
-                                                    bufsize=-1,
-                                                    stdin=subprocess.PIPE,
-                                                    stdout=output_stream)
-                fh = gzip_process.stdin
+                fh = ParallelGzipWriter(args[0], mode, compresslevel,
+                                            threads=threads)
             else:
                 raise IOError('Mode ' + mode + ' not supported')
         else:
@@ -251,12 +654,6 @@ def xopen(gzipped, *args):
     finally:
         if fh is not sys.stdout:
             fh.close()
-        if 'gzip_process' in locals():
-            gzip_process.wait()
-        if 'output_stream' in locals():
-            output_stream.close()
-        if 'old_read_eof' in locals():
-            gzip.GzipFile._read_eof = old_read_eof
 
 def make_temp_dir(scratch=None):
     """ Creates temporary directory in some scratch directory.
@@ -409,8 +806,9 @@ def apply_async_with_errors(rc, ids, function_to_apply, *args, **kwargs):
                     function_to_apply[i],*new_args[i],**new_kwargs[i]
                 )
             )
-    while any([not asyncresult.ready() for asyncresult in asyncresults]):
-        time.sleep(1e-1)
+    # Block on each result rather than polling; done results return at once
+    for asyncresult in asyncresults:
+        asyncresult.wait()
     asyncexceptions = defaultdict(set)
     for asyncresult in asyncresults:
         try:
@@ -458,6 +856,14 @@ def apply_async_with_errors(rc, ids, function_to_apply, *args, **kwargs):
             to_return[asyncresult.metadata['engine_id']] = asyncresult.get()
     return to_return
 
+# Bytes of elements a dlist holds in memory before it spills to disk
+_dlist_byte_limit = 64 * 1024 * 1024
+# Bytes of elements compressed together into each run a dlist spills
+_dlist_run_size = 1024 * 1024
+# Rough number of bytes of memory taken up by an element beyond its length
+_dlist_overhead = 50
+_dlist_run_header = struct.Struct('<I')
+
 class dlist(object):
     """ List data type that spills to disk if a memlimit is reached.
 
@@ -466,33 +872,91 @@ class dlist(object):
 
         Random access is not currently permitted. The list should properly
         be used by appending all elements, then iterating through them to
-        read them.
+        read them; it may be iterated through any number of times, and
+        len() gives its number of elements.
+
+        Elements are held in memory until they take up about byte_limit
+        bytes or there are limit of them. Later elements are gathered into
+        runs of about run_size bytes, each of which is marshaled,
+        compressed, and written to a temporary file. Elements read back are
+        exactly the strings appended.
     """
-    def __init__(self, limit=5000000):
+    def __init__(self, limit=5000000, byte_limit=_dlist_byte_limit,
+                    run_size=_dlist_run_size, counter=None,
+                    compresslevel=1):
         """
             limit: maximum number of elements allowed in list before
                 spilling to disk
+            byte_limit: maximum number of bytes of elements, including
+                _dlist_overhead per element, held in memory before
+                spilling to disk
+            run_size: number of bytes of elements in each run spilled
+            counter: dooplicity.counters.Counter to which spill statistics
+                are added, or None
+            compresslevel: level of zlib compression of runs from 0 to 9
         """
         self.mem_list = []
         self.disk_stream = None
         self.limit = limit
+        self.byte_limit = byte_limit
+        self.run_size = run_size
+        self.counter = counter
+        self.compresslevel = compresslevel
+        self.size = 0
+        # Elements not yet in a run after spilling has started
+        self.run = []
+        self.run_bytes = 0
+        self.mem_bytes = 0
 
     def __enter__(self):
         return self
 
+    def __len__(self):
+        return self.size
+
     def __iter__(self):
         """ Iterates through list.
 
-            NOTE THAT seek to beginning of file is performed if some of the
-            list is not in memory!
+            Runs on disk are read with their own offsets, so iterations
+            may be nested.
         """
+        import marshal
         for item in self.mem_list:
             yield item
         if self.disk_stream is not None:
-            self.disk_stream.flush()
-            self.disk_stream.seek(0)
-            for line in self.disk_stream:
-                yield line.strip()
+            self.disk_stream.seek(0, os.SEEK_END)
+            offset, end = 0, self.disk_stream.tell()
+            while offset < end:
+                self.disk_stream.seek(offset)
+                run_length, = _dlist_run_header.unpack(
+                        self.disk_stream.read(_dlist_run_header.size)
+                    )
+                compressed = self.disk_stream.read(run_length)
+                offset += _dlist_run_header.size + run_length
+                self.disk_stream.seek(0, os.SEEK_END)
+                for item in marshal.loads(zlib.decompress(compressed)):
+                    yield item
+            for item in self.run:
+                yield item
+
+    def _spill(self):
+        """ Writes elements not yet in a run to disk as a run. """
+        import marshal
+        compressed = zlib.compress(marshal.dumps(self.run),
+                                    self.compresslevel)
+        self.disk_stream.seek(0, os.SEEK_END)
+        self.disk_stream.write(_dlist_run_header.pack(len(compressed)))
+        self.disk_stream.write(compressed)
+        if self.counter is not None:
+            self.counter.add('dlist_spilled_runs')
+            self.counter.add('dlist_spilled_items', len(self.run))
+            self.counter.add('dlist_spilled_bytes',
+                                self.run_bytes
+                                - _dlist_overhead * len(self.run))
+            self.counter.add('dlist_spilled_compressed_bytes',
+                                len(compressed))
+        self.run = []
+        self.run_bytes = 0
 
     def append(self, item):
         """ Appends item to list. Only strings are permitted right now.
@@ -501,20 +965,27 @@ class dlist(object):
         """
         if type(item) is not str:
             raise TypeError('An item appended to a dlist must be a string.')
+        self.size += 1
         if self.disk_stream is None:
-            if len(self.mem_list) < self.limit:
-                self.mem_list.append(item)
-            else:
-                # Open new temporary file
+            self.mem_list.append(item)
+            self.mem_bytes += len(item) + _dlist_overhead
+            if (self.mem_bytes >= self.byte_limit
+                    or len(self.mem_list) >= self.limit):
+                # Open new temporary file; later items go there
                 import tempfile
                 self.disk_stream = tempfile.TemporaryFile()
-                print >>self.disk_stream, item
+                if self.counter is not None:
+                    self.counter.add('dlist_spills')
         else:
-            print >>self.disk_stream, item
+            self.run.append(item)
+            self.run_bytes += len(item) + _dlist_overhead
+            if self.run_bytes >= self.run_size:
+                self._spill()
 
     def tear_down(self):
         if self.disk_stream is not None:
             self.disk_stream.close()
+            self.disk_stream = None
 
     def __exit__(self, type, value, traceback):
         self.tear_down()
@@ -522,24 +993,29 @@ class dlist(object):
 class xstream(object):
     """ Permits Pythonic iteration through partitioned/sorted input streams.
 
-        All iterators are implemented as generators. Could have subclassed
-        itertools.groupby here; however, implementation of itertools.groupby
-        may change from version to version of Python. Implementation is thus
-        just based on itertools.groupby from
-        https://docs.python.org/2/library/itertools.html .
+        All iterators are implemented as generators. Partitions are found
+        with itertools.groupby, which compares keys in C and, like the
+        recipe at https://docs.python.org/2/library/itertools.html this
+        class used to follow, reads a partition only as its values are
+        consumed, so memory use doesn't grow with partition size.
 
         Usage: for key, xpartition in xstream(hadoop_stream):
                    for value in xpartition:
                         <code goes here>
 
-        Each of key and value above is a tuple of strings.
+        Each of key and value above is a tuple of strings. If raw_values is
+        True, each value is instead the unsplit rest of its line after the
+        key fields, and only the key fields are split from each line; this
+        is faster for reducers that don't need every field of every value.
 
-        Properties
-        -------------
-        key: key tuple that denotes current partition; this is an attribute
-            of both an xstream. None when no lines have been read yet.
-        value: tuple that denotes current value. None when no lines have been
-            read yet.
+        For reducers that work on whole columns at a time:
+
+               for key, batches in xstream(hadoop_stream).batches():
+                   for columns in batches:
+                        <code goes here>
+
+        where columns is a list with a list of fields for each value field
+        and holds no more than batch_size values.
 
         Init vars
         -------------
@@ -548,53 +1024,138 @@ class xstream(object):
             considered the key denoting a partition
         separator: delimiter separating fields from each input line
         skip_duplicates: skip any duplicate lines that may follow a line
+        binary: input is a stream of records in the binary format of
+            dooplicity.records rather than lines; fields are decoded to
+            strings, and separator is ignored
+        raw_values: values are strings holding the rest of each line after
+            its key fields rather than tuples of fields; '' if a line has
+            only key fields. Not permitted if binary is True.
     """
     @staticmethod
     def stream_iterator(
             input_stream,
             separator='\t',
-            skip_duplicates=False
+            skip_duplicates=False,
+            binary=False
         ):
-        if skip_duplicates:
+        if binary:
+            from records import RecordReader, decoded
+            if skip_duplicates:
+                for record, _ in groupby(RecordReader(input_stream)):
+                    yield decoded(record)
+            else:
+                for record in RecordReader(input_stream):
+                    yield decoded(record)
+        elif skip_duplicates:
             for line, _ in groupby(input_stream):
                 yield tuple(line.strip().split(separator))
         else:
             for line in input_stream:
                 yield tuple(line.strip().split(separator))
 
+    @staticmethod
+    def raw_stream_iterator(
+            input_stream,
+            key_fields=1,
+            separator='\t',
+            skip_duplicates=False
+        ):
+        """ Yields pairs (list of key fields, rest of line).
+
+            A line with no more than key_fields fields has rest ''; its key
+            fields are just the fields it has, as in stream_iterator.
+        """
+        if skip_duplicates:
+            input_stream = (line for line, _ in groupby(input_stream))
+        for line in input_stream:
+            fields = line.strip().split(separator, key_fields)
+            if len(fields) > key_fields:
+                yield fields[:key_fields], fields[key_fields]
+            else:
+                yield fields, ''
+
     def __init__(
             self, 
             input_stream,
             key_fields=1,
             separator='\t',
-            skip_duplicates=False
+            skip_duplicates=False,
+            binary=False,
+            raw_values=False
         ):
         self._key_fields = key_fields
-        self.it = self.stream_iterator(
+        self._separator = separator
+        self._raw_values = raw_values
+        if raw_values:
+            if binary:
+                raise ValueError('Binary records have no raw values.')
+            rows = self.raw_stream_iterator(
                         input_stream,
+                        key_fields=key_fields,
                         separator=separator,
                         skip_duplicates=skip_duplicates
                     )
-        self.tgtkey = self.currkey = self.currvalue = object()
+            self._value = itemgetter(1)
+            self.it = groupby(rows, itemgetter(0))
+        else:
+            rows = self.stream_iterator(
+                        input_stream,
+                        separator=separator,
+                        skip_duplicates=skip_duplicates,
+                        binary=binary
+                    )
+            self._value = itemgetter(slice(key_fields, None))
+            self.it = groupby(rows, itemgetter(slice(0, key_fields)))
 
     def __iter__(self):
         return self
 
     def next(self):
-        while self.currkey == self.tgtkey:
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
-        self.tgtkey = self.currkey
-        return self.currkey, self._grouper(self.tgtkey)
-
-    def _grouper(self, tgtkey):
-        while self.currkey == tgtkey:
-            yield self.currvalue[self._key_fields:]
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
+        key, rows = next(self.it)    # Exit on StopIteration
+        return tuple(key), imap(self._value, rows)
+
+    def batches(self, batch_size=10000, converters=None):
+        """ Iterates through partitions, giving values a batch at a time.
+
+            batch_size: maximum number of values per batch
+            converters: None, or a sequence with a function for each value
+                field, such as int, to apply to every field in its column
+                besides padding; an element that's None leaves a column
+                alone
+
+            Yield value: tuple (key, iterator over batches of partition's
+                values); a batch is a list with a list of fields for each
+                value field, padded with None for values with fewer fields
+        """
+        for key, xpartition in self:
+            yield key, self._batched(xpartition, batch_size, converters)
+
+    def _batched(self, xpartition, batch_size, converters):
+        """ Yields lists of columns of at most batch_size values. """
+        while True:
+            rows = list(islice(xpartition, batch_size))
+            if not rows:
+                return
+            if self._raw_values:
+                separator = self._separator
+                rows = [row.split(separator) if row else ()
+                            for row in rows]
+            columns = [list(column) for column in izip_longest(*rows)]
+            if converters is not None:
+                for i, converter in enumerate(converters[:len(columns)]):
+                    if converter is None:
+                        continue
+                    if None in columns[i]:
+                        columns[i] = [None if field is None
+                                        else converter(field)
+                                        for field in columns[i]]
+                    else:
+                        columns[i] = map(converter, columns[i])
+            yield columns
 
 if __name__ == '__main__':
     # Run unit tests
+    import sys
     import unittest
     import os
     import shutil
@@ -704,6 +1265,84 @@ if __name__ == '__main__':
                      (('chr1', '2'), ('i', '91', '101'))]
                 )
 
+        def test_raw_values(self):
+            """ Fails if only key fields aren't split from lines. """
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write(
+                        'chr1\t1\ta\t20\t90\n'
+                        'chr1\t1\n'
+                        'chr1\t2\ti\t90\t1300\n'
+                    )
+            with open(self.input_file) as input_stream:
+                output = [(key, value) for key, xpartition
+                            in xstream(input_stream, 2, raw_values=True)
+                            for value in xpartition]
+            self.assertEqual(output,
+                    [(('chr1', '1'), 'a\t20\t90'),
+                     (('chr1', '1'), ''),
+                     (('chr1', '2'), 'i\t90\t1300')]
+                )
+
+        def test_raw_values_short_lines(self):
+            """ Fails if short lines' keys depend on raw_values. """
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write(
+                        'chr1\n'
+                        'chr1\t1\n'
+                        'chr1\t1\ta\n'
+                        'chr2\n'
+                    )
+            keys = []
+            for raw_values in [False, True]:
+                with open(self.input_file) as input_stream:
+                    keys.append([(key, len(list(xpartition)))
+                                    for key, xpartition
+                                    in xstream(input_stream, 2,
+                                                raw_values=raw_values)])
+            self.assertEqual(keys[0],
+                    [(('chr1',), 1), (('chr1', '1'), 2), (('chr2',), 1)]
+                )
+            self.assertEqual(keys[1], keys[0])
+
+        def test_batches(self):
+            """ Fails if values aren't batched into columns properly. """
+            with open(self.input_file, 'w') as input_stream:
+                for i in xrange(5):
+                    input_stream.write('1\t%d\tA\n' % i)
+                input_stream.write('2\t5\n')
+            for raw_values in [False, True]:
+                with open(self.input_file) as input_stream:
+                    output = [(key, list(batches)) for key, batches
+                                in xstream(input_stream, 1,
+                                            raw_values=raw_values).batches(
+                                        batch_size=2, converters=(int,)
+                                    )]
+                self.assertEqual(output,
+                        [(('1',), [[[0, 1], ['A', 'A']],
+                                   [[2, 3], ['A', 'A']],
+                                   [[4], ['A']]]),
+                         (('2',), [[[5]]])]
+                    )
+
+        def test_binary_records(self):
+            """ Fails if binary records aren't partitioned properly. """
+            from records import RecordWriter
+            with open(self.input_file, 'w') as input_stream:
+                writer = RecordWriter(input_stream, 'si', 'q')
+                for fields in [('chr1', 9, 'ACGT'), ('chr1', 9, 'ACGT'),
+                               ('chr1', 9, 'NNA'), ('chr1', 10, 'T')]:
+                    writer.write(fields)
+            with open(self.input_file) as input_stream:
+                output = [(key, value) for key, xpartition
+                            in xstream(input_stream, 2, skip_duplicates=True,
+                                        binary=True)
+                            for value in xpartition]
+            self.assertEqual(output,
+                    [(('chr1', '9'), ('ACGT',)),
+                     (('chr1', '9'), ('NNA',)),
+                     (('chr1', '10'), ('T',))]
+                )
+
         def test_empty_input(self):
             """ Fails if it fails. """
             with open(self.input_file, 'w') as input_stream:
@@ -717,6 +1356,37 @@ if __name__ == '__main__':
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
 
+    class TestDlist(unittest.TestCase):
+        """ Tests dlist class. """
+        def test_spill(self):
+            """ Fails if elements spilled to disk don't read back. """
+            from counters import Counter
+            from StringIO import StringIO
+            counter = Counter('test', StringIO())
+            items = ['%d\t%s\n' % (i, 'A' * (i % 100)) for i in xrange(5000)]
+            with dlist(byte_limit=10000, run_size=2000,
+                        counter=counter) as a_dlist:
+                for item in items:
+                    a_dlist.append(item)
+                self.assertEqual(len(a_dlist), 5000)
+                self.assertEqual(list(a_dlist), items)
+                # Iterate again, with a nested iteration
+                for i, (item, other_item) in enumerate(zip(a_dlist, a_dlist)):
+                    self.assertEqual(item, items[i])
+                    self.assertEqual(other_item, items[i])
+            self.assertEqual(counter.get('dlist_spills'), 1)
+            self.assertTrue(counter.get('dlist_spilled_runs') > 1)
+            self.assertTrue(counter.get('dlist_spilled_items') < 5000)
+
+        def test_count_limit(self):
+            """ Fails if count limit isn't respected. """
+            a_dlist = dlist(limit=10)
+            for i in xrange(25):
+                a_dlist.append(str(i))
+            self.assertTrue(a_dlist.disk_stream is not None)
+            self.assertEqual(list(a_dlist), [str(i) for i in xrange(25)])
+            a_dlist.tear_down()
+
     class TestXopen(unittest.TestCase):
         """ Tests xopen function. """
         def setUp(self):
@@ -762,8 +1432,78 @@ if __name__ == '__main__':
             self.assertEqual(second_line.strip(), 'second line')
             self.assertEqual(third_line, '')
 
+        def test_threaded_round_trip(self):
+            """ Fails if many members written on threads don't read back. """
+            lines = ['%d\t%s\n' % (i, os.urandom(i % 50).encode('hex'))
+                        for i in xrange(20000)]
+            with ParallelGzipWriter(self.unix_file, 'w', 3, threads=4,
+                                        block_size=4096) as unix_stream:
+                unix_stream.writelines(lines[:10000])
+                unix_stream.write(''.join(lines[10000:]))
+            output = subprocess.check_output(['gzip', '-cd', self.unix_file])
+            self.assertEqual(output, ''.join(lines))
+            with gzip.open(self.unix_file) as python_stream:
+                self.assertEqual(python_stream.read(), ''.join(lines))
+            with xopen(None, self.unix_file, threads=3) as unix_stream:
+                self.assertEqual(list(unix_stream), lines)
+
+        def test_inline_compression(self):
+            """ Fails if a writer with no threads starts any or misreads. """
+            lines = ['%d\t%s\n' % (i, 'x' * (i % 70)) for i in xrange(5000)]
+            thread_count = threading.active_count()
+            with ParallelGzipWriter(self.unix_file, 'w', 3, threads=0,
+                                        block_size=1000) as unix_stream:
+                unix_stream.writelines(lines)
+                self.assertEqual(threading.active_count(), thread_count)
+                # Nothing waits to be written but the last partial block
+                self.assertFalse(unix_stream.pending)
+                self.assertTrue(unix_stream.buffered < 1000)
+            with xopen(None, self.unix_file) as unix_stream:
+                self.assertEqual(list(unix_stream), lines)
+
+        def test_foreign_members(self):
+            """ Fails if members from gzip proper aren't read. """
+            with gzip.open(self.python_file, 'w') as python_stream:
+                python_stream.write('first line\nsecond ')
+            with xopen(True, self.python_file, 'a') as unix_stream:
+                unix_stream.write('line\nthird line\n')
+            subprocess.check_call('echo fourth line | gzip -c >>%s'
+                                    % self.python_file, shell=True)
+            with xopen(None, self.python_file, 'r', threads=2) \
+                    as python_stream:
+                self.assertEqual(python_stream.readlines(),
+                                    ['first line\n', 'second line\n',
+                                     'third line\n', 'fourth line\n'])
+
+        def test_empty_write(self):
+            """ Fails if writing nothing doesn't give a valid gzip. """
+            with xopen(True, self.unix_file, 'w') as unix_stream:
+                pass
+            output = subprocess.check_output(['gzip', '-cd', self.unix_file])
+            self.assertEqual(output, '')
+
+        def test_gzip_threads_from_environment(self):
+            """ Fails if xopen ignores dooplicity_gzip_threads. """
+            old_environ = os.environ.copy()
+            try:
+                os.environ.pop(_gzip_threads_variable, None)
+                self.assertEqual(gzip_threads(), _gzip_threads)
+                os.environ[_gzip_threads_variable] = 'x'
+                self.assertEqual(gzip_threads(), _gzip_threads)
+                os.environ[_gzip_threads_variable] = '3'
+                with xopen(True, self.unix_file, 'w') as unix_stream:
+                    self.assertEqual(unix_stream.threads, 3)
+                with xopen(True, self.unix_file, 'w', threads=2) \
+                        as unix_stream:
+                    self.assertEqual(unix_stream.threads, 2)
+                with xopen(None, self.unix_file) as unix_stream:
+                    self.assertEqual(unix_stream.threads, 3)
+            finally:
+                os.environ.clear()
+                os.environ.update(old_environ)
+
         def tearDown(self):
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
 
-    unittest.main()
+    unittest.main(argv=[sys.argv[0]])
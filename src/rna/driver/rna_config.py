@@ -558,6 +558,9 @@ def ready_engines(rc, base, prep=False):
                                     '.1.ebwt', '.2.ebwt', '.3.ebwt',
                                     '.4.ebwt', '.rev.1.ebwt', '.rev.2.ebwt'
                                 ]])
+        for extension in ['.rail2bit', '.motifs']:
+            if os.path.exists(base.bowtie1_idx + extension):
+                index_files.append(base.bowtie1_idx + extension)
         try:
             import herd.herd as herd
             if '$' in temp_dir: raise ImportError
@@ -689,7 +692,7 @@ def step(name, inputs, output,
     action_on_failure='TERMINATE_JOB_FLOW', jar=_hadoop_streaming_jar,
     tasks=0, partition_options=None, sort_options=None, archives=None,
     files=None, multiple_outputs=False, mod_partitioner=False,
-    inputformat=None, outputformat=None, extra_args=[]):
+    inputformat=None, outputformat=None, extra_args=[], combiner=None):
     """ Outputs JSON for a given step.
 
         name: name of step
@@ -709,6 +712,7 @@ def step(name, inputs, output,
         inputformat: -inputformat option
         outputformat: -outputformat option; overrides multiple_outputs
         extra_args: extra '-D' args
+        combiner: combiner command or None if there is no combiner
 
         Return value: step dictionary
     """
@@ -784,6 +788,10 @@ def step(name, inputs, output,
             '-mapper', mapper,
             '-reducer', reducer
         ])
+    if combiner is not None:
+        to_return['HadoopJarStep']['Args'].extend([
+                '-combiner', combiner
+            ])
     if outputformat is not None:
         to_return['HadoopJarStep']['Args'].extend([
                 '-outputformat', outputformat
@@ -823,6 +831,10 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                     unspecified, use IdentityMapper
                 'reducer' : argument of Hadoop Streaming's -reducer; if left
                     unspecified, use IdentityReducer
+                'combiner' : argument of Hadoop Streaming's -combiner; present
+                    only if sorted map output for each task can be combined
+                    by this script before it's shuffled. Its output must be
+                    valid input to both itself and the reducer
                 'inputs' : list of input directories
                 'no_input_prefix' : key that's present iff intermediate dir
                     should not be prepended to inputs
@@ -937,6 +949,11 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                         path_join(unix, step_dir,
                                         protostep['reducer'])]) 
                         if 'reducer' in protostep else 'cat',
+                combiner=' '.join(['pypy' if unix
+                        else _executable, 
+                        path_join(unix, step_dir,
+                                        protostep['combiner'])])
+                        if 'combiner' in protostep else None,
                 action_on_failure=action_on_failure,
                 jar=jar,
                 tasks=reducer_task_count,
@@ -2094,6 +2111,14 @@ class RailRnaLocal(object):
             default=(4 if parallel else 1),
             help=('maximum number of attempts per task')
         )
+        general_parser.add_argument(
+            '--profile-steps', action='store_const', const=True,
+            default=False,
+            help=('sample where Python steps spend CPU time and write each '
+                  'step\'s hotspots and flame-graph input to its '
+                  'dp.map.log and dp.reduce.log directories under the log '
+                  'directory')
+        )
 
 class RailRnaElastic(object):
     """ Checks elastic-mode input parameters and relevant programs.
@@ -4095,6 +4120,30 @@ class RailRnaAlign(object):
                                                 ) + ', and '
                                                 + missing_extensions[-1]
                                             ))
+                else:
+                    '''Sidecars are built once per index by index_prep.py;
+                    only check here whether they're current.'''
+                    from rail2bit import sidecar_current
+                    from motif_index import motif_index_current
+                    stale_sidecars = [
+                            sidecar for sidecar, current in [
+                                (bowtie1_idx + '.rail2bit', sidecar_current),
+                                (bowtie1_idx + '.motifs', motif_index_current)
+                            ] if not current(sidecar, bowtie1_idx)
+                        ]
+                    if stale_sidecars:
+                        print_to_screen(
+                                ('Warning: {0} missing or out of date, so '
+                                 'steps will parse the Bowtie index and scan '
+                                 'for splice-site motifs directly. Build '
+                                 'them once with "{1} {2} {3}".').format(
+                                        ' and '.join(stale_sidecars),
+                                        sys.executable,
+                                        os.path.join(utils_path,
+                                                     'index_prep.py'),
+                                        bowtie1_idx
+                                    )
+                            )
             base.bowtie1_idx, base.bowtie2_idx = bowtie1_idx, bowtie2_idx
             base.samtools_exe = base.check_program('samtools', 'SAMTools',
                                 '--samtools', entered_exe=samtools_exe,
@@ -5053,6 +5102,8 @@ class RailRnaAlign(object):
                                         '--collect-junctions'
                                         if base.jx else ''
                                     ),
+                'combiner' : ('junction_filter.py --manifest={0} '
+                              '--combine').format(manifest),
                 'inputs' : ['junction_search'],
                 'output' : 'junction_filter',
                 'multiple_outputs' : True,
@@ -5436,6 +5487,7 @@ class RailRnaAlign(object):
                 'reducer' : 'sum.py {0}'.format(
                                         keep_alive
                                     ),
+                'combiner' : 'sum.py',
                 'inputs' : [path_join(elastic, 'align_reads', 'exon_diff'),
                             path_join(elastic, 'compare_alignments',
                                                'exon_diff'),
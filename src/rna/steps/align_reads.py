@@ -390,8 +390,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         No return value.
     """
     global _input_line_count
-    reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
-    manifest_object = manifest.LabelsAndIndices(manifest_file)
+    reference_index = bowtie_index.cached_reference(bowtie_index_base)
+    manifest_object = manifest.cached_labels_and_indices(manifest_file)
     alignment_printer = AlignmentPrinter(
             manifest_object,
             reference_index,
@@ -465,7 +465,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
             '''Select highest-quality read with alphabetically last qname
             for first-pass alignment.'''
             best_name, best_mean_qual, best_qual_index, i = None, None, 0, 0
-            others_to_print = dlist()
+            others_to_print = dlist(counter=counter)
             for is_reversed, name, qual in xpartition:
                 _input_line_count += 1
                 others_to_print.append(
@@ -493,6 +493,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                 for j, other_to_print in enumerate(others_to_print):
                     if j != best_qual_index:
                         print >>other_stream, other_to_print
+            others_to_print.tear_down()
             print >>align_stream, to_align
     # Print dummy line
     print 'dummy\t-\tdummy'
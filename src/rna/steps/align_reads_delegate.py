@@ -105,6 +105,8 @@ def print_readletized_output(seq, sample_indexes,
     beginning of the input stream.'''
     to_write = []
     seq_size = len(seq)
+    # Counted locally and added to counter once per read
+    capping_readlets = non_capping_readlets = 0
     # Add capping readlets
     for cap_size in cap_sizes:
         readlet_seq = seq[:cap_size]
@@ -113,13 +115,13 @@ def print_readletized_output(seq, sample_indexes,
                     )
         if readlet_seq < reversed_complement_readlet_seq:
             if not no_polyA or set(readlet_seq) != _polyA:
-                counter.add('capping_readlets')
+                capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq, seq_id 
                                                         + '+', 0,
                                                         seq_size - cap_size))
         else:
             if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                counter.add('capping_readlets')
+                capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' \
                                     % (reversed_complement_readlet_seq,
                                         seq_id + '-', 0, seq_size - cap_size))
@@ -129,13 +131,13 @@ def print_readletized_output(seq, sample_indexes,
                     )
         if readlet_seq < reversed_complement_readlet_seq:
             if not no_polyA or set(readlet_seq) != _polyA:
-                counter.add('capping_readlets')
+                capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq,
                                                     seq_id + '+',
                                                     seq_size - cap_size, 0))
         else:
             if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                counter.add('capping_readlets')
+                capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' \
                                     % (reversed_complement_readlet_seq,
                                         seq_id + '-', seq_size - cap_size, 0))
@@ -148,18 +150,20 @@ def print_readletized_output(seq, sample_indexes,
                     )
         if readlet_seq < reversed_complement_readlet_seq:
             if not no_polyA or set(readlet_seq) != _polyA:
-                counter.add('non_capping_readlets')
+                non_capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq,
                                                     seq_id + '+', j, 
                                                     seq_size - j
                                                         - max_readlet_size))
         else:
             if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                counter.add('non_capping_readlets')
+                non_capping_readlets += 1
                 to_write.append('%s\t%s\x1e%d\x1e%d' \
                                     % (reversed_complement_readlet_seq,
                                         seq_id + '-', j, 
                                         seq_size - j - max_readlet_size))
+    counter.add('capping_readlets', capping_readlets)
+    counter.add('non_capping_readlets', non_capping_readlets)
     # Add additional info to first readlet in to_write
     try:
         to_write[0] = '\x1e'.join([to_write[0], seq,
@@ -981,8 +985,8 @@ def go(task_partition='0', other_reads=None, second_pass_reads=None,
             usually means only a transcript index is being constructed
         no_polyA: kill readlets that are all As
     """
-    reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
-    manifest_object = manifest.LabelsAndIndices(manifest_file)
+    reference_index = bowtie_index.cached_reference(bowtie_index_base)
+    manifest_object = manifest.cached_labels_and_indices(manifest_file)
     group_reads_object = group_reads.IndexGroup(index_count)
     if other_reads is not None:
         # First-pass Bowtie 2
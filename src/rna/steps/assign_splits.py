@@ -15,8 +15,9 @@ Tab-separated fields:
 1. #!splitload
 2. number of read(s) (pairs) in sample; number of pairs if paired-end and
     number of reads if single-end
-3 ... next-to-last. same as manifest line
-4. Phred format (Sanger or Phred64)
+3 ... next-to-next-to-last. same as manifest line
+next-to-last. comma-separated access points into FASTQs; see split_points.py
+last. Phred format (Sanger or Phred64)
 
 ---Otherwise:
 manifest line---
@@ -36,7 +37,9 @@ Tab-separated fields:
     each new file
 3. \x1d-separated list of numbers of reads to include in gzipped files
 4. \x1d-separated list of manifest lines whose tabs are replaced by \x1es
-5. Phred format (Sanger or Phred64)
+5. \x1d-separated list of access points at or before the reads at which to
+    start each new file; each is empty if there is no such access point
+6. Phred format (Sanger or Phred64)
 
 ---Otherwise:
 same as manifest line
@@ -62,6 +65,7 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from alignment_handlers import running_sum, pairwise
+from split_points import nearest_access_point
 import math
 import time
 from dooplicity.ansibles import Url
@@ -113,6 +117,8 @@ else:
     register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
     output_path = os.path.join(temp_dir_path, args.filename)
 samples = {}
+# Maps first URL of each sample to its serialized access points
+access_points = {}
 saved = []
 for input_line_count, line in enumerate(sys.stdin):
     tokens = line.strip().split('\t')
@@ -120,15 +126,16 @@ for input_line_count, line in enumerate(sys.stdin):
     if not (token_count > 4 and tokens[0] == '#!splitload'):
         saved.append('\t'.join(tokens[1:]))
         continue
-    assert token_count in [6, 8], (
-            'Line "{}" of input has {} fields, but 6 or 8 are expected.'
+    assert token_count in [7, 9], (
+            'Line "{}" of input has {} fields, but 7 or 9 are expected.'
         ).format(line, token_count)
-    if token_count == 6:
-        samples[(tokens[2], None)] = (int(tokens[1]),) + tuple(tokens[2:-1])
+    if token_count == 7:
+        samples[(tokens[2], None)] = (int(tokens[1]),) + tuple(tokens[2:-2])
     else:
-        # token_count is 8
+        # token_count is 9
         samples[(tokens[2], tokens[4])] = (int(tokens[1])*2,) \
-                                            + tuple(tokens[2:-1])
+                                            + tuple(tokens[2:-2])
+    access_points[tokens[2]] = tokens[-2]
     phred_format = tokens[-1]
 input_line_count += 1
 print >>sys.stderr, 'Before counter.add'
@@ -192,6 +199,15 @@ with open(output_path, 'w') as output_stream:
                             '\x1e'.join(samples[line_tuple[0]][1:])
                             for line_tuple in line_tuples
                         ),
+                    '\x1d'.join(
+                            nearest_access_point(
+                                access_points[line_tuple[0][0]],
+                                # Paired-end indexes count both mates
+                                line_tuple[-2]
+                                if line_tuple[0][1] is None
+                                else line_tuple[-2] / 2
+                            ) for line_tuple in line_tuples
+                        ),
                     phred_format
                     ))
     for line in saved:
@@ -142,11 +142,13 @@ if args.keep_alive:
 
 '''Make RNAME lengths available from reference FASTA so SAM header can be
 formed; reference_index.rname_lengths[RNAME] is the length of RNAME.''' 
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                             os.path.expandvars(args.bowtie_idx)
                         )
 # For mapping sample indices back to original sample labels
-manifest_object = manifest.LabelsAndIndices(os.path.expandvars(args.manifest))
+manifest_object = manifest.cached_labels_and_indices(
+                            os.path.expandvars(args.manifest)
+                        )
 # To convert sample-rname index to sample index-rname index tuple
 sample_and_rname_indexes = SampleAndRnameIndexes(
                                                     manifest_object,
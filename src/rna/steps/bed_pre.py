@@ -353,7 +353,7 @@ if __name__ == '__main__':
 
 if __name__ == '__main__' and not args.test:
     start_time = time.time()
-    manifest_object = manifest.LabelsAndIndices(
+    manifest_object = manifest.cached_labels_and_indices(
                                 os.path.expandvars(args.manifest)
                             )
     input_line_count, output_line_count = go(
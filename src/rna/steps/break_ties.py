@@ -178,10 +178,10 @@ global, properties of args are also arguments of the go() function so
 different command-line arguments can be passed to it for unit tests.'''
 args = parser.parse_args(argv[1:])
 
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                             os.path.expandvars(args.bowtie_idx)
                         )
-manifest_object = manifest.LabelsAndIndices(
+manifest_object = manifest.cached_labels_and_indices(
                             os.path.expandvars(args.manifest)
                         )
 alignment_count_to_report, seed, non_deterministic \
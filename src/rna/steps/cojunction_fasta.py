@@ -73,7 +73,7 @@ start_time = time.time()
 input_line_count = 0
 counter = Counter('cojunction_fasta')
 register_cleanup(counter.flush)
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                             os.path.expandvars(args.bowtie_idx)
                         )
 group_reads_object = group_reads.IndexGroup(args.index_count)
@@ -82,7 +82,7 @@ for (rname, poses, end_poses), xpartition in xstream(sys.stdin, 3,
     counter.add('partitions')
     reverse_strand_string = rname[-1]
     rname = rname[:-1]
-    read_seqs = dlist()
+    read_seqs = dlist(counter=counter)
     poses = [int(pos) for pos in poses.split(',')]
     end_poses = [int(end_pos) for end_pos in end_poses.split(',')]
     max_left_extend_size, max_right_extend_size = None, None
@@ -150,6 +150,7 @@ for (rname, poses, end_poses), xpartition in xstream(sys.stdin, 3,
         for read_seq in read_seqs:
             print '\t'.join([group_reads_object.index_group(read_seq),
                                 read_seq, fasta_info])
+    read_seqs.tear_down()
 
 print >>sys.stderr, 'DONE with cojunction_fasta.py; in=%d; ' \
                     'time=%0.3f s' % (input_line_count,
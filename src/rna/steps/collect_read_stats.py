@@ -95,11 +95,11 @@ if args.keep_alive:
 import time
 start_time = time.time()
 
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                                 os.path.expandvars(args.bowtie_idx)
                             )
 # For mapping sample indices back to original sample labels
-manifest_object = manifest.LabelsAndIndices(
+manifest_object = manifest.cached_labels_and_indices(
                                 os.path.expandvars(args.manifest)
                             )
 output_url = Url(args.out) if args.out is not None \
@@ -210,10 +210,10 @@ if __name__ == '__main__':
     args = parser.parse_args(argv[1:])
 
     reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
-    manifest_object = manifest.LabelsAndIndices(
+    manifest_object = manifest.cached_labels_and_indices(
                                     os.path.expandvars(args.manifest)
                                 )
-    reference_index = bowtie_index.BowtieIndexReference(
+    reference_index = bowtie_index.cached_reference(
                                     os.path.expandvars(args.bowtie_idx)
                                 )
     alignment_printer = AlignmentPrinter(
@@ -5,8 +5,10 @@ Rail-RNA-count_inputs
 START: follows no step
 Precedes Rail-RNA-assign-splits
 
-Runs "wc -cl" on each line of input (which is a manifest file) and prepends
-the result to the line if URLs are local.
+Counts records in the file(s) on each line of input (which is a manifest
+file) and prepends the result to the line if URLs are local. Access points
+into FASTQs are recorded during the same pass so preprocess tasks can seek to
+their first records.
 
 Input (read from stdin)
 ----------------------------
@@ -27,8 +29,11 @@ Tab-separated output fields:
 1. #!splitload
 2. number of read(s) (pairs) in sample; number of pairs if paired-end and
     number of reads if single-end
-3 ... end. same as manifest line
-4. Phred format (Sanger or Phred64)
+3 ... next-to-next-to-last. same as manifest line
+next-to-last. comma-separated access points into FASTQs, each of the form
+    <record index>:<offset>:<inner offset> with an offset and inner offset
+    per mate; see split_points.py
+last. Phred format (Sanger or Phred64)
 
 ---Otherwise:
 same as manifest line
@@ -54,13 +59,19 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.ansibles import Url
-from dooplicity.tools import xopen, register_cleanup
+from dooplicity.tools import register_cleanup
 from dooplicity.counters import Counter
 import argparse
+import multiprocessing
 from guess import inferred_phred_format
+from split_points import AccessPointReader, access_points_string
 # Print file's docstring if -h is invoked
 parser = argparse.ArgumentParser(description=__doc__, 
             formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument(
+        '-p', '--num-processes', type=int, required=False, default=1,
+        help='Number of files to count at once'
+    )
 
 args = parser.parse_args(sys.argv[1:])
 
@@ -68,26 +79,24 @@ start_time = time.time()
 # For telling apart FASTQs and FASTAs
 fastq_cues = set(['@'])
 fasta_cues = set(['>', ';'])
-
-input_line_count, output_line_count = 0, 0
-counter = Counter('count_inputs')
-register_cleanup(counter.flush)
 line_divider = 4
 
-for input_line_count, line in enumerate(sys.stdin):
-    # Kill offset from start of manifest file
+def census(line):
+    """ Counts records in and infers Phred format of a manifest line's file.
+
+        Each file is read only once: its first line is sniffed to tell FASTA
+        from FASTQ, and the rest is passed to inferred_phred_format, which
+        counts lines and samples quality strings in the same pass while
+        access points are recorded. A second mate's FASTQ is read only
+        for access points.
+
+        line: manifest line, including offset from start of manifest file
+
+        Return value: tuple (list of output lines, list of counters to
+            increment)
+    """
     tokens = line.strip().split('\t')[1:]
-    try:
-        stripped = tokens[0].strip()
-        if stripped[0] == '#' or not line.strip():
-            counter.add('comment_lines')
-            continue
-    except IndexError:
-        continue
     token_count = len(tokens)
-    assert token_count in [3, 5], (
-            'Line {} of input has {} fields, but 3 or 5 are expected.'
-        ).format(input_line_count + 1, token_count)
     file_to_count = tokens[0]
     if (not ((token_count == 3 and Url(tokens[0]).is_local) or
         (token_count == 5 and Url(tokens[0]).is_local
@@ -97,33 +106,92 @@ for input_line_count, line in enumerate(sys.stdin):
                     or tokens[0].endswith('.tar.bz2')
                     or tokens[0].endswith('.tar')))
             ):
-        sys.stdout.write(line)
-        output_line_count += 1
-        continue
-    with xopen(None, file_to_count) as input_stream:
-        first_char = input_stream.readline()[0]
+        return [line], []
+    output_lines, counters = [], []
+    census_start_time = time.time()
+    with AccessPointReader(file_to_count) as input_stream:
+        first_line = input_stream.readline()
+        first_char = first_line[0]
         if first_char in fasta_cues:
-            sys.stdout.write(line)
-            counter.add('fasta_line')
-            output_line_count += 1
+            output_lines.append(line)
+            counters.append('fasta_line')
         elif first_char in fastq_cues:
-            counter.add('fastq_line')
+            counters.append('fastq_line')
         else:
             raise RuntimeError(
                     'File "{}" is neither a FASTA nor a FASTQ file.'.format(
                             file_to_count
                         )
                 )
-    with xopen(None, file_to_count) as input_stream:
-        phred_format, line_count = inferred_phred_format(input_stream)
-        counter.add('inferred_' + phred_format)
+        phred_format, line_count = inferred_phred_format(
+                                            input_stream,
+                                            first_line=first_line
+                                        )
+        counters.append('inferred_' + phred_format)
+        access_points = [input_stream.access_points]
+    if first_char in fastq_cues and token_count == 5:
+        # Mates need access points at the same records
+        with AccessPointReader(tokens[2]) as mate_stream:
+            mate_stream.scan()
+            access_points.append(mate_stream.access_points)
+    census_time = max(time.time() - census_start_time, 1e-6)
+    file_size = os.path.getsize(file_to_count)
+    print >>sys.stderr, (
+            'Counted {} lines in "{}" in {:.3f} s; read {} bytes at '
+            '{:.1f} MB/s.'
+        ).format(line_count, file_to_count, census_time, file_size,
+                    file_size / census_time / 1048576)
     lines_and_bytes = str((int(line_count) + 1) / line_divider)
-    print '\t'.join(
+    output_lines.append('\t'.join(
             ['#!splitload', lines_and_bytes, line.partition('\t')[2].strip(),
+                access_points_string(access_points)
+                if first_char in fastq_cues else '',
                 phred_format]
-        )
-    output_line_count += 1
+        ) + '\n')
+    return output_lines, counters
+
+input_line_count, output_line_count = 0, 0
+counter = Counter('count_inputs')
+register_cleanup(counter.flush)
+
+def manifest_lines():
+    """ Yields noncomment lines of manifest from stdin.
+
+        Checks field counts and records comment lines along the way.
+    """
+    global input_line_count
+    for input_line_count, line in enumerate(sys.stdin):
+        # Kill offset from start of manifest file
+        tokens = line.strip().split('\t')[1:]
+        try:
+            stripped = tokens[0].strip()
+            if stripped[0] == '#' or not line.strip():
+                counter.add('comment_lines')
+                continue
+        except IndexError:
+            continue
+        token_count = len(tokens)
+        assert token_count in [3, 5], (
+                'Line {} of input has {} fields, but 3 or 5 are expected.'
+            ).format(input_line_count + 1, token_count)
+        yield line
+
+if args.num_processes > 1:
+    pool = multiprocessing.Pool(args.num_processes)
+    censuses = pool.imap(census, manifest_lines())
+else:
+    pool = None
+    censuses = (census(line) for line in manifest_lines())
+for output_lines, counters in censuses:
+    for output_line in output_lines:
+        sys.stdout.write(output_line)
+        output_line_count += 1
+    for name in counters:
+        counter.add(name)
     counter.flush()
+if pool is not None:
+    pool.close()
+    pool.join()
 
 sys.stdout.flush()
 print >>sys.stderr, 'DONE with count_inputs.py; in/out=%d/%d; ' \
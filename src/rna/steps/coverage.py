@@ -10,7 +10,8 @@ base coverage (horizontal axis: number of exonic chunks covering given base;
     vertical axis: number of bases covered) as the (k*100)-th coverage
 percentile, where k is input by the user via the command-line parameter
 --percentile. bigwig files encoding coverage per sample are also written to a
-specified destination, local or remote. Rail-RNA-coverage_post merely collects
+specified destination, local or remote. Up to --workers samples are written
+and uploaded at once. Rail-RNA-coverage_post merely collects
 the normalization factors and writes them to a file.
 
 Input (read from stdin)
@@ -50,8 +51,9 @@ import os
 import sys
 import site
 import argparse
-import subprocess
 import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 if '--test' in sys.argv:
     print("No unit tests")
@@ -76,6 +78,7 @@ from collections import defaultdict
 from dooplicity.tools import xstream, register_cleanup, make_temp_dir
 from dooplicity.counters import Counter
 from dooplicity.ansibles import Url
+from bigwig import BigWigWriter
 import tempdel
 from re import search
 
@@ -96,11 +99,16 @@ parser.add_argument('--manifest', type=str, required=False,
         help='Path to manifest file')
 parser.add_argument(
     '--bigwig-exe', type=str, required=False, default='bedGraphToBigWig',
-    help='Location of the Kent Tools bedGraphToBigWig executable')
+    help='Ignored; bigwigs are now written without Kent Tools. Accepted so '
+         'existing job flows still run')
 parser.add_argument('--bigwig-basename', type=str, required=False, default='',
     help='The basename (excluding path) of all bigwig output. Basename is'
          'followed by ".[sample label].bw"; if basename is an empty string, '
          'a sample\'s bigwig filename is simply [sample label].bw')
+parser.add_argument(
+    '--workers', metavar='<int>', type=int, required=False, default=2,
+    help='Maximum number of samples whose bigwigs are written and uploaded '
+         'at once')
 parser.add_argument(
     '--keep-alive', action='store_const', const=True, default=False,
     help='Prints reporter:status:alive messages to stderr to keep EMR '
@@ -124,18 +132,34 @@ if args.keep_alive:
     keep_alive_thread = KeepAlive(sys.stderr)
     keep_alive_thread.start()
 
-if args.keep_alive:
-    class BedTobigwigThread(threading.Thread):
-        """ Wrapper class for bedtobigwig that permits polling for completion.
-        """
-        def __init__(self, command_list):
-            super(BedTobigwigThread, self).__init__()
-            self.command_list = command_list
-            self.bedtobigwig_process = None
-        def run(self):
-            self.bedtobigwig_process = subprocess.Popen(self.command_list,
-                                            stdout=sys.stderr,
-                                            stderr=sys.stderr).wait()
+# Number of input lines passed to a worker at once
+_batch_size = 10000
+# Maximum number of batches waiting for a worker
+_queued_batches = 8
+
+class SampleFeed(object):
+    """ Bounded queue of batches of a sample's input lines.
+
+        The thread reading stdin puts batches on the queue followed by None,
+        and a worker iterates over the lines as they arrive.
+    """
+    def __init__(self, max_batches=_queued_batches):
+        self.batches = Queue.Queue(max_batches)
+        self.done = False
+
+    def __iter__(self):
+        while not self.done:
+            batch = self.batches.get()
+            if batch is None:
+                self.done = True
+                return
+            for line in batch:
+                yield line
+
+    def drain(self):
+        """ Discards remaining lines so the reading thread isn't blocked. """
+        for _ in self:
+            pass
 
 def percentile(histogram, percentile=0.75):
     """ Given histogram, computes desired percentile.
@@ -157,38 +181,147 @@ def percentile(histogram, percentile=0.75):
     raise RuntimeError('Percentile computation should have terminated '
                        'mid-loop.')
 
+def write_sample(sample_index, sample_label, real_sample, feed):
+    """ Writes a sample's bigwigs and uploads them if necessary.
+
+        Runs in a worker thread. Coverage intervals are passed to a
+        BigWigWriter for each of the two bigwigs as they are found, so no
+        bedGraph is written.
+
+        sample_index: sample index OR mean[.RNAME] OR median[.RNAME]
+        sample_label: label of sample to use in bigwig filenames
+        real_sample: True iff normalization factors should be computed
+        feed: SampleFeed with the sample's input lines
+
+        Return value: tuple (normalization factor output line or None,
+            dictionary of counter increments, number of input lines)
+    """
+    try:
+        counts = defaultdict(int)
+        input_line_count = 0
+        '''Dictionary for which each key is a coverage (i.e., number of ECs
+        covering a given base). Its corresponding value is the number of
+        bases with that coverage.'''
+        coverage_histogram, unique_coverage_histogram = (
+                defaultdict(int),
+                defaultdict(int)
+            )
+        bigwig_filenames = [((args.bigwig_basename + '.') 
+                            if args.bigwig_basename != '' else '')
+                            + sample_label]*2
+        bigwig_filenames[0] += '.bw'
+        bigwig_filenames[1] += '.unique.bw'
+        if output_url.is_local:
+            # Write directly to local destination
+            bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
+                                    for bigwig_filename in bigwig_filenames]
+        else:
+            # Write to temporary directory, and later upload to URL
+            bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
+                                    for bigwig_filename in bigwig_filenames]
+        if args.verbose:
+            print >>sys.stderr, 'Writing bigwigs %s and %s .' % tuple(
+                                                            bigwig_file_paths
+                                                        )
+        with BigWigWriter(bigwig_file_paths[0], reference_index.rname_lengths,
+                            temp_dir=temp_dir_path) as bigwig, \
+            BigWigWriter(bigwig_file_paths[1], reference_index.rname_lengths,
+                            temp_dir=temp_dir_path) as unique_bigwig:
+            for rname, coverages in itertools.groupby(feed,
+                                                    key=lambda val: val[0]):
+                try:
+                    rname = reference_index.l_string_to_rname[rname]
+                except KeyError:
+                    raise RuntimeError(
+                            'RNAME number string "%s" not in Bowtie index.' 
+                            % rname
+                        )
+                (last_pos, last_coverage,
+                    last_unique_pos, last_unique_coverage) = 0, 0, 0, 0
+                for _, pos, coverage, unique_coverage in coverages:
+                    # bigWig is zero-indexed, while input is 1-indexed
+                    pos, coverage, unique_coverage = (
+                            int(pos) - 1, float(coverage),
+                            float(unique_coverage)
+                        )
+                    input_line_count += 1
+                    if coverage != last_coverage:
+                        counts['intervals'] += 1
+                        bigwig.add(rname, last_pos, pos, last_coverage)
+                        if last_coverage != 0:
+                            # Only care about nonzero-coverage regions
+                            coverage_histogram[last_coverage] \
+                                += pos - last_pos
+                        last_pos, last_coverage = pos, coverage
+                    if unique_coverage != last_unique_coverage:
+                        counts['unique_intervals'] += 1
+                        unique_bigwig.add(rname, last_unique_pos, pos,
+                                            last_unique_coverage)
+                        if last_unique_coverage != 0:
+                            # Only care about nonzero-coverage regions
+                            unique_coverage_histogram[last_unique_coverage] \
+                                += pos - last_unique_pos
+                        last_unique_pos, last_unique_coverage = (
+                                pos,
+                                unique_coverage
+                            )
+                if last_pos != reference_index.rname_lengths[rname]:
+                    # Add coverage up to end of strand
+                    counts['intervals'] += 1
+                    bigwig.add(rname, last_pos,
+                                reference_index.rname_lengths[rname],
+                                coverage)
+                if last_unique_pos != reference_index.rname_lengths[rname]:
+                    # Add unique coverage up to end of strand
+                    counts['unique_intervals'] += 1
+                    unique_bigwig.add(rname, last_unique_pos,
+                                        reference_index.rname_lengths[rname],
+                                        unique_coverage)
+        counts['bigwigs_written'] += 2
+        if not output_url.is_local:
+            # bigwigs must be uploaded to URL and deleted
+            for bigwig_file_path, bigwig_filename in zip(bigwig_file_paths,
+                                                         bigwig_filenames):
+                counts['files_moved'] += 1
+                mover.put(bigwig_file_path,
+                            output_url.plus(bigwig_filename))
+                os.remove(bigwig_file_path)
+        '''Output normalization factors iff working with real sample'''
+        if not real_sample:
+            return None, counts, input_line_count
+        auc = sum(coverage_value * coverage_histogram[coverage_value]
+                    for coverage_value in coverage_histogram)
+        unique_auc = sum(coverage_value
+                            * unique_coverage_histogram[coverage_value]
+                        for coverage_value in unique_coverage_histogram)
+        return ('3\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d\t%d\t%d' % (
+                        sample_index,
+                        percentile(coverage_histogram, args.percentile),
+                        percentile(unique_coverage_histogram,
+                                    args.percentile),
+                        auc,
+                        unique_auc
+                    ), counts, input_line_count)
+    finally:
+        feed.drain()
+        worker_slots.release()
+
 import time
 start_time = time.time()
 
 temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
 # Clean up after script
 register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
-bed_filename = os.path.join(temp_dir_path, 'temp.bed')
-unique_bed_filename = os.path.join(temp_dir_path, 'temp.unique.bed')
-if args.verbose:
-    print >>sys.stderr, 'Writing to temporary beds %s and %s.' % (
-            bed_filename,
-            unique_bed_filename
-        )
-output_filename, output_url = None, None
 
 '''Make RNAME lengths available from reference FASTA so SAM header can be
 formed; reference_index.rname_lengths[RNAME] is the length of RNAME.''' 
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                         os.path.expandvars(args.bowtie_idx)
                     )
 # For mapping sample indices back to original sample labels
-manifest_object = manifest.LabelsAndIndices(
+manifest_object = manifest.cached_labels_and_indices(
                         os.path.expandvars(args.manifest)
                     )
-# Create file with chromosome sizes for bedTobigwig
-sizes_filename = os.path.join(temp_dir_path, 'chrom.sizes')
-if args.verbose:
-    print >>sys.stderr, 'Sizes file: %s .' % sizes_filename
-with open(sizes_filename, 'w') as sizes_stream:
-    for rname in reference_index.rname_lengths:
-        print >>sizes_stream, '%s %d' % (rname, 
-            reference_index.rname_lengths[rname])
 
 input_line_count, output_line_count = 0, 0
 output_url = Url(args.out)
@@ -197,167 +330,66 @@ if output_url.is_local:
     try: os.makedirs(output_url.to_url())
     except: pass
 mover = filemover.FileMover(args=args)
-track_line = ('track type=bedGraph name="{name}" '
-         'description="{description}" visibility=full '
-         'color=227,29,118 altColor=0,179,220 priority=400')
-for (sample_index,), xpartition in xstream(sys.stdin, 1):
-    counter.add('partitions')
-    real_sample = True
-    try:
-        sample_label = manifest_object.index_to_label[sample_index]
-    except KeyError:
-        # It's a nonref track, a mean, or a median
-        real_sample = False
-        if search('\.[ATCGN]', sample_index):
-            try:
-                sample_label = (
-                        manifest_object.index_to_label[sample_index[:-2]]
-                        + sample_index[-2:]
-                    )
-            except KeyError:
+'''Each sample is written by a worker thread while this thread reads the
+next sample's input; compression and uploads release the GIL. A worker's
+slot is released only after its uploads finish, so at most --workers
+samples are held in memory or on scratch at once.'''
+workers = max(args.workers, 1)
+worker_slots = threading.BoundedSemaphore(workers)
+pool = ThreadPool(workers)
+results = []
+try:
+    for (sample_index,), xpartition in xstream(sys.stdin, 1):
+        counter.add('partitions')
+        real_sample = True
+        try:
+            sample_label = manifest_object.index_to_label[sample_index]
+        except KeyError:
+            # It's a nonref track, a mean, or a median
+            real_sample = False
+            if search('\.[ATCGN]', sample_index):
+                try:
+                    sample_label = (
+                            manifest_object.index_to_label[sample_index[:-2]]
+                            + sample_index[-2:]
+                        )
+                except KeyError:
+                    raise RuntimeError(
+                            'Sample label index "%s" was not recorded.'
+                            % sample_index
+                        )
+            elif 'mean' in sample_index or 'median' in sample_index:
+                sample_label = sample_index
+            else:
                 raise RuntimeError('Sample label index "%s" was not recorded.'
                                     % sample_index)
-        elif 'mean' in sample_index or 'median' in sample_index:
-            sample_label = sample_index
-        else:
-            raise RuntimeError('Sample label index "%s" was not recorded.'
-                                % sample_index)
-    '''Dictionary for which each key is a coverage (i.e., number of ECs
-    covering a given base). Its corresponding value is the number of bases with
-    that coverage.'''
-    coverage_histogram, unique_coverage_histogram = (
-            defaultdict(int),
-            defaultdict(int)
-        )
-    with open(bed_filename, 'w') as bed_stream, \
-        open(unique_bed_filename, 'w') as unique_bed_stream:
-        print >>bed_stream, track_line.format(name=sample_label,
-                                              description=(
-                                                    'base coverage by '
-                                                    'primary alignments'
-                                                ))
-        print >>unique_bed_stream, track_line.format(name=sample_label,
-                                                     description=(
-                                                        'base coverage by '
-                                                        'uniquely mapping '
-                                                        'reads')
-                                                     )
-        for rname, coverages in itertools.groupby(xpartition, 
-                                                    key=lambda val: val[0]):
-            try:
-                rname = reference_index.l_string_to_rname[rname]
-            except KeyError:
-                raise RuntimeError(
-                        'RNAME number string "%s" not in Bowtie index.' 
-                        % rname
-                    )
-            (last_pos, last_coverage,
-                last_unique_pos, last_unique_coverage) = 0, 0, 0, 0
-            for _, pos, coverage, unique_coverage in coverages:
-                # BED is zero-indexed, while input is 1-indexed
-                pos, coverage, unique_coverage = (
-                        int(pos) - 1, float(coverage), float(unique_coverage)
-                    )
-                input_line_count += 1
-                if coverage != last_coverage:
-                    counter.add('bed_lines')
-                    print >>bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_pos, pos, last_coverage)
-                    if last_coverage != 0:
-                        # Only care about nonzero-coverage regions
-                        coverage_histogram[last_coverage] += pos - last_pos
-                    last_pos, last_coverage = pos, coverage
-                if unique_coverage != last_unique_coverage:
-                    counter.add('unique_bed_lines')
-                    print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_unique_pos, pos, last_unique_coverage)
-                    if last_unique_coverage != 0:
-                        # Only care about nonzero-coverage regions
-                        unique_coverage_histogram[last_unique_coverage] \
-                            += pos - last_unique_pos
-                    last_unique_pos, last_unique_coverage = (
-                            pos,
-                            unique_coverage
-                        )
-            if last_pos != reference_index.rname_lengths[rname]:
-                # Print coverage up to end of strand
-                counter.add('bed_lines')
-                print >>bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_pos,
-                        reference_index.rname_lengths[rname],
-                        coverage
-                    )
-            if last_unique_pos != reference_index.rname_lengths[rname]:
-                # Print unique coverage up to end of strand
-                counter.add('unique_bed_lines')
-                print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_unique_pos,
-                        reference_index.rname_lengths[rname],
-                        unique_coverage
-                    )
-    '''Output normalization factors iff working with real sample'''
-    if real_sample:
-        auc = sum(coverage_value * coverage_histogram[coverage_value]
-                    for coverage_value in coverage_histogram)
-        unique_auc = sum(coverage_value
-                            * unique_coverage_histogram[coverage_value]
-                        for coverage_value in unique_coverage_histogram)
-        print '3\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d\t%d\t%d' % (sample_index,
-                                                percentile(coverage_histogram,
-                                                            args.percentile),
-                                                percentile(
-                                                    unique_coverage_histogram,
-                                                    args.percentile),
-                                                auc,
-                                                unique_auc
-                                            )
-    output_line_count += 1
-    # Write bigwigs
-    assert os.path.exists(sizes_filename)
-    bigwig_filenames = [((args.bigwig_basename + '.') 
-                        if args.bigwig_basename != '' else '')
-                        + sample_label]*2
-    bigwig_filenames[0] += '.bw'
-    bigwig_filenames[1] += '.unique.bw'
-    if output_url.is_local:
-        # Write directly to local destination
-        bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    else:
-        # Write to temporary directory, and later upload to URL
-        bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    bigwig_commands = [[args.bigwig_exe, bed_filename, sizes_filename,
-                        bigwig_file_paths[0]], 
-                       [args.bigwig_exe, unique_bed_filename, sizes_filename,
-                        bigwig_file_paths[1]]]
-    for i, bigwig_command in enumerate(bigwig_commands):
-        if args.verbose:
-            print >>sys.stderr, 'Writing bigwig with command %s .' \
-                % ' '.join(bigwig_command)
-        counter.add('call_bedgraphtobigwig')
-        bedtobigwig_process = subprocess.Popen(
-                                    bigwig_command,
-                                    stderr=sys.stderr,
-                                    stdout=sys.stderr,
-                                    bufsize=-1
-                                )
-        bedtobigwig_process.wait()
-        if bedtobigwig_process.returncode:
-            raise RuntimeError('bedgraphtobigwig process failed w/ '
-                               'exitlevel %d.'
-                                % bedtobigwig_process.returncode)
-        if args.verbose:
-            print >>sys.stderr, ('bedTobigwig command %s succeeded .'
-                                  % ' '.join(bigwig_command))
-        if not output_url.is_local:
-            # bigwig must be uploaded to URL and deleted
-            counter.add('files_moved')
-            mover.put(bigwig_file_paths[i],
-                        output_url.plus(bigwig_filenames[i]))
-            os.remove(bigwig_file_paths[i])
+        worker_slots.acquire()
+        for result in results:
+            # Stop early if a worker has failed
+            if result.ready():
+                result.get()
+        feed = SampleFeed()
+        results.append(pool.apply_async(write_sample,
+                                        (sample_index, sample_label,
+                                         real_sample, feed)))
+        while True:
+            batch = list(itertools.islice(xpartition, _batch_size))
+            if not batch:
+                break
+            feed.batches.put(batch)
+        feed.batches.put(None)
+    pool.close()
+    for result in results:
+        output_line, counts, sample_input_line_count = result.get()
+        input_line_count += sample_input_line_count
+        for name, count in counts.items():
+            counter.add(name, count)
+        if output_line is not None:
+            print output_line
+        output_line_count += 1
+    pool.join()
+finally:
+    pool.terminate()
 
 print >>sys.stderr, 'DONE with coverage.py; in/out=%d/%d; time=%0.3f s' \
                         % (input_line_count, output_line_count,
@@ -58,11 +58,6 @@ import argparse
 import time
 import itertools
 
-if '--test' in sys.argv:
-    print("No unit tests")
-    #unittest.main(argv=[sys.argv[0]])
-    sys.exit(0)
-
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
                         os.path.realpath(__file__)))
@@ -78,8 +73,194 @@ import manifest
 from dooplicity.tools import xstream, xopen, register_cleanup
 from dooplicity.counters import Counter
 from collections import defaultdict
+from bisect import bisect_left, insort
 from re import search
 
+try:
+    # For fast means over many samples; PyPy may not have NumPy
+    import numpy as np
+except ImportError:
+    np = None
+
+class CoverageRow(object):
+    """ Normalized coverages of the samples averaged in a mean or median row.
+
+        Values are kept in manifest order so means are summed in the same
+        order as ever, and a sorted copy is updated in place as coverages
+        change so medians are read off without sorting.
+    """
+    def __init__(self, read_counts, sample_indexes, library_size, weight):
+        """
+            read_counts: dictionary mapping sample indexes to the read
+                counts by which their coverages are normalized; samples
+                with no reads are left out of the row
+            sample_indexes: iterable of sample indexes in manifest order
+            library_size: number of reads to which coverages are normalized
+            weight: factor by which each coverage is multiplied in the mean
+        """
+        self.slots = {}
+        self.scales = []
+        for sample_index in sample_indexes:
+            if read_counts[sample_index]:
+                self.slots[sample_index] = len(self.scales)
+                self.scales.append(read_counts[sample_index])
+        self.library_size = library_size
+        self.weight = weight
+        self.reset()
+
+    def reset(self):
+        """ Zeroes coverages of all samples. """
+        if np is not None:
+            self.values = np.zeros(len(self.scales))
+        else:
+            self.values = [0.0] * len(self.scales)
+        self.sorted_values = [0.0] * len(self.scales)
+
+    def update(self, sample_index, coverage):
+        """ Sets a sample's coverage.
+
+            sample_index: sample index; ignored if it's not in row
+            coverage: coverage of sample before normalization
+
+            No return value.
+        """
+        try:
+            slot = self.slots[sample_index]
+        except KeyError:
+            return
+        value = float(coverage) / self.scales[slot] * self.library_size
+        old_value = self.values[slot]
+        if value == old_value:
+            return
+        self.values[slot] = value
+        del self.sorted_values[bisect_left(self.sorted_values, old_value)]
+        insort(self.sorted_values, value)
+
+    def mean(self):
+        """ Computes weighted sum of normalized coverages.
+
+            Return value: mean
+        """
+        if not self.scales:
+            return 0
+        if np is not None:
+            # cumsum adds in order, so its last element is exactly sum()
+            return np.cumsum(self.values * self.weight)[-1]
+        return sum([value * self.weight for value in self.values])
+
+    def median(self):
+        """ Finds canonically defined median of normalized coverages.
+
+            Return value: median
+        """
+        if not self.sorted_values:
+            # Median's nothing for empty input in this case
+            return 0
+        list_size = len(self.sorted_values)
+        index = (list_size - 1) // 2
+        if (list_size % 2):
+            return self.sorted_values[index]
+        return (self.sorted_values[index]
+                    + self.sorted_values[index + 1]) / 2.0
+
+if '--test' in sys.argv:
+    import unittest
+    import random
+
+    class TestCoverageRow(unittest.TestCase):
+        """ Tests CoverageRow against sorting and summing from scratch. """
+
+        def setUp(self):
+            self.np = np
+
+        def tearDown(self):
+            global np
+            np = self.np
+
+        def implementations(self):
+            """ Yields once with NumPy if it's available and once without. """
+            global np
+            if self.np is not None:
+                np = self.np
+                yield
+            np = None
+            yield
+
+        def expected(self, coverages, read_counts, sample_indexes,
+                        library_size, weight):
+            """ Computes mean and median of normalized coverages anew. """
+            values = [float(coverages[sample_index])
+                        / read_counts[sample_index] * library_size
+                        for sample_index in sample_indexes
+                        if read_counts[sample_index]]
+            if not values:
+                return 0, 0
+            mean = sum([value * weight for value in values])
+            values.sort()
+            index = (len(values) - 1) // 2
+            if len(values) % 2:
+                return mean, values[index]
+            return mean, (values[index] + values[index + 1]) / 2.0
+
+        def test_random_updates(self):
+            """ Fails if mean or median drifts from a fresh computation. """
+            random.seed(5)
+            for _ in self.implementations():
+                for sample_count in [1, 2, 7, 12]:
+                    sample_indexes = [str(i) for i in xrange(sample_count)]
+                    # Few distinct values make for ties in the sorted copy
+                    read_counts = dict(
+                            (sample_index, random.choice([0, 1, 2, 4]))
+                            for sample_index in sample_indexes
+                        )
+                    nonzero_count = len(
+                            [_ for _ in read_counts.values() if _]
+                        )
+                    weight = 1. / nonzero_count if nonzero_count else 0.0
+                    row = CoverageRow(read_counts, sample_indexes,
+                                        40000000, weight)
+                    for _ in xrange(5):
+                        # Each partition starts from zero coverage
+                        row.reset()
+                        self.assertEqual((row.mean(), row.median()), (0, 0))
+                        coverages = dict.fromkeys(sample_indexes, 0)
+                        for _ in xrange(200):
+                            sample_index = random.choice(
+                                    sample_indexes + ['unknown']
+                                )
+                            coverage = random.randint(0, 6)
+                            row.update(sample_index, coverage)
+                            if sample_index in coverages:
+                                coverages[sample_index] = coverage
+                            mean, median = self.expected(
+                                    coverages, read_counts, sample_indexes,
+                                    40000000, weight
+                                )
+                            self.assertEqual(row.mean(), mean)
+                            self.assertEqual(row.median(), median)
+                            self.assertEqual(
+                                    row.sorted_values,
+                                    sorted(list(row.values))
+                                )
+
+        def test_zero_read_counts(self):
+            """ Fails if samples with no reads aren't left out. """
+            for _ in self.implementations():
+                row = CoverageRow({'a' : 10, 'b' : 0, 'c' : 30},
+                                    ['a', 'b', 'c'], 60, 0.5)
+                self.assertEqual(len(row.sorted_values), 2)
+                row.update('b', 100)
+                row.update('a', 1)
+                row.update('c', 1)
+                self.assertEqual(row.mean(), 4.0)
+                self.assertEqual(row.median(), 4.0)
+                row = CoverageRow({'a' : 0, 'b' : 0}, ['a', 'b'], 60, 0.0)
+                row.update('a', 5)
+                self.assertEqual((row.mean(), row.median()), (0, 0))
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit(0)
+
 parser = argparse.ArgumentParser(description=__doc__, 
             formatter_class=argparse.RawDescriptionHelpFormatter)
 parser.add_argument(
@@ -105,23 +286,6 @@ bowtie.add_args(parser)
 manifest.add_args(parser)
 args = parser.parse_args()
 
-def median(a_list):
-    """ Finds canonically defined median of list.
-
-        a_list: a list
-
-        Return value: median
-    """
-    if not a_list:
-        # Median's nothing for empty input in this case
-        return 0
-    sorted_list = sorted(a_list)
-    list_size = len(a_list)
-    index = (list_size - 1) // 2
-    if (list_size % 2):
-        return sorted_list[index]
-    return (sorted_list[index] + sorted_list[index + 1]) / 2.0
-
 library_size = args.library_size * 1000000
 start_time = time.time()
 input_line_count, output_line_count = 0, 0
@@ -129,10 +293,10 @@ counter = Counter('coverage')
 register_cleanup(counter.flush)
 bin_count = 0
 # For converting RNAMEs to number strings
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                         os.path.expandvars(args.bowtie_idx)
                     )
-manifest_object = manifest.LabelsAndIndices(
+manifest_object = manifest.cached_labels_and_indices(
                         os.path.expandvars(args.manifest)
                     )
 # Grab read counts
@@ -158,6 +322,15 @@ try:
 except ZeroDivisionError:
     unique_mean_weight = 0.0
 
+coverage_row, nonref_coverage_row = [
+        CoverageRow(mapped_read_counts, manifest_object.index_to_label,
+                        library_size, mean_weight) for _ in xrange(2)
+    ]
+unique_coverage_row, unique_nonref_coverage_row = [
+        CoverageRow(unique_mapped_read_counts,
+                        manifest_object.index_to_label,
+                        library_size, unique_mean_weight) for _ in xrange(2)
+    ]
 for (partition_id,), xpartition in xstream(sys.stdin, 1):
     counter.add('partitions')
     bin_count += 1
@@ -170,6 +343,9 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
     nonref_coverages, unique_nonref_coverages = (
             defaultdict(int), defaultdict(int)
         )
+    for row in [coverage_row, unique_coverage_row,
+                nonref_coverage_row, unique_nonref_coverage_row]:
+        row.reset()
     for (pos, sample_indexes_and_diffs) in itertools.groupby(
                                             xpartition, lambda val: val[0]
                                         ):
@@ -179,18 +355,30 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
         for sample_index, diffs in itertools.groupby(
                                 sample_indexes_and_diffs, lambda val: val[1]
                             ):
+            nonref = search('\.[ATCG]', sample_index) is not None
+            # All non-N nonreference bases go here
+            real_sample_index = sample_index[:-2]
             for _, _, uniqueness, diff in diffs:
                 diff = int(diff)
                 coverages[sample_index] += diff
                 if uniqueness == '1':
                     unique_coverages[sample_index] += diff
-                if search('\.[ATCG]', sample_index):
-                    # All non-N nonreference bases go here
-                    real_sample_index = sample_index[:-2]
+                if nonref:
                     nonref_coverages[real_sample_index] += diff
                     if uniqueness == '1':
                         unique_nonref_coverages[real_sample_index] += diff
                 bin_diff_count += 1
+            coverage_row.update(sample_index, coverages[sample_index])
+            unique_coverage_row.update(sample_index,
+                                        unique_coverages[sample_index])
+            if nonref:
+                nonref_coverage_row.update(
+                        real_sample_index, nonref_coverages[real_sample_index]
+                    )
+                unique_nonref_coverage_row.update(
+                        real_sample_index,
+                        unique_nonref_coverages[real_sample_index]
+                    )
             counter.add('coverage_lines')
             print 'coverage\t%s\t%s\t%012d\t%d\t%d' % (
                         sample_index, 
@@ -199,54 +387,29 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
                     )
             output_line_count += 1
         # Now output measures of center
-        coverage_row = [float(coverages[sample_index])
-                         / mapped_read_counts[sample_index]
-                         * library_size
-                        for sample_index in manifest_object.index_to_label
-                        if mapped_read_counts[sample_index]]
-        unique_coverage_row = [float(unique_coverages[sample_index])
-                                / unique_mapped_read_counts[sample_index]
-                                * library_size
-                               for sample_index
-                               in manifest_object.index_to_label
-                               if unique_mapped_read_counts[sample_index]]
-        nonref_coverage_row = [float(nonref_coverages[sample_index])
-                                / mapped_read_counts[sample_index]
-                                * library_size
-                                for sample_index
-                                in manifest_object.index_to_label
-                                if mapped_read_counts[sample_index]]
-        unique_nonref_coverage_row = [
-                    float(unique_nonref_coverages[sample_index])
-                        / unique_mapped_read_counts[sample_index]
-                        * library_size
-                        for sample_index in manifest_object.index_to_label
-                        if unique_mapped_read_counts[sample_index]
-                ]
         print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
                 'mean' + maybe_rname, 
                 rname_index, pos,
-                sum([cov * mean_weight for cov in coverage_row]),
-                sum([cov * unique_mean_weight for cov in unique_coverage_row])
+                coverage_row.mean(),
+                unique_coverage_row.mean()
             )
         print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
                 'median' + maybe_rname, 
                 rname_index, pos,
-                median(coverage_row),
-                median(unique_coverage_row)
+                coverage_row.median(),
+                unique_coverage_row.median()
             )
         print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
                 'mean.nonref' + maybe_rname, 
                 rname_index, pos,
-                sum([cov * mean_weight for cov in nonref_coverage_row]),
-                sum([cov * unique_mean_weight for cov
-                        in unique_nonref_coverage_row])
+                nonref_coverage_row.mean(),
+                unique_nonref_coverage_row.mean()
             )
         print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
                 'median.nonref' + maybe_rname, 
                 rname_index, pos,
-                median(nonref_coverage_row),
-                median(unique_nonref_coverage_row)
+                nonref_coverage_row.median(),
+                unique_nonref_coverage_row.median()
             )
 
     if args.partition_stats:
@@ -101,7 +101,7 @@ register_cleanup(counter.flush)
 
 start_time = time.time()
 
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                         os.path.expandvars(args.bowtie_idx)
                     )
 for (_, rname_string, intron_pos, intron_end_pos,
@@ -76,7 +76,7 @@ start_time = time.time()
 input_line_count = 0
 counter = Counter('junction_fasta')
 register_cleanup(counter.flush)
-reference_index = bowtie_index.BowtieIndexReference(
+reference_index = bowtie_index.cached_reference(
                         os.path.expandvars(args.bowtie_idx)
                     )
 for key, xpartition in xstream(sys.stdin, 3, skip_duplicates=True):
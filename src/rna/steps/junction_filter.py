@@ -12,6 +12,10 @@ of reads.
 In the special mode --collect-junctions, this step just collects and outputs
 junctions across samples, and no step should follow it.
 
+In the special mode --combine, this step is a combiner: it merges the sample
+lists of all input lines with the same junction into a single line in the
+input format.
+
 Input (read from stdin)
 ----------------------------
 Tab-delimited columns:
@@ -70,7 +74,7 @@ register_cleanup(counter.flush)
 
 def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
         sample_fraction=0.05, coverage_threshold=5, collect_junctions=False,
-        verbose=False):
+        combine=False, verbose=False):
     """ Runs Rail-RNA-junction_filter.
 
         Filters out every junction from input_stream that is not either:
@@ -123,6 +127,9 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
             satisfied
         collect_junctions: collects and outputs junctions across samples;
             ignores sample_fraction and coverage_threshold
+        combine: merges lines with the same junction into a single line in
+            the input format, so go() can serve as a combiner; ignores
+            all other options
         verbose: output extra debugging statements
 
         Return value: tuple (input line count, output line count)
@@ -144,6 +151,17 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
                                         current_sample_indexes.split('\x1f')
                                     ):
                 sample_indexes[sample_index] += int(current_sample_counts[i])
+        if combine:
+            samples_to_dump = sorted(sample_indexes.items(),
+                                        key=lambda sample: int(sample[0]))
+            counter.add('combined_junction_lines')
+            print >>output_stream, '%s\t%s\t%s\t%s\t%s' % (
+                    rname_and_strand, pos, end_pos,
+                    '\x1f'.join([sample[0] for sample in samples_to_dump]),
+                    '\x1f'.join([str(sample[1]) for sample in samples_to_dump])
+                )
+            output_line_count += 1
+            continue
         pos, end_pos = int(pos), int(end_pos)
         if collect_junctions:
             samples_to_dump = sorted(sample_indexes.items(),
@@ -195,6 +213,10 @@ if __name__ == '__main__':
         const=True, default=False,
         help=('Just collects and outputs unfiltered junctions; overrides '
               '--sample-fraction and --coverage-threshold'))
+    parser.add_argument('--combine', action='store_const',
+        const=True, default=False,
+        help=('Just merges sample lists of each junction, writing output in '
+              'the input format; for use as a combiner'))
     parser.add_argument('--sample-fraction', type=float, required=False,
         default=0.05,
         help=('A junction passes the filter if it is present in this '
@@ -218,7 +240,7 @@ if __name__ == '__main__':
 
 if __name__ == '__main__' and not args.test:
     start_time = time.time()
-    manifest_object = manifest.LabelsAndIndices(
+    manifest_object = manifest.cached_labels_and_indices(
                                     os.path.expandvars(args.manifest)
                                 )
     input_line_count, output_line_count = go(
@@ -228,6 +250,7 @@ if __name__ == '__main__' and not args.test:
             sample_fraction=args.sample_fraction,
             coverage_threshold=args.coverage_threshold,
             collect_junctions=args.collect_junctions,
+            combine=args.combine,
             verbose=args.verbose
         )
     print >>sys.stderr, 'DONE with junction_filter.py; in/out=%d/%d; ' \
@@ -362,6 +385,46 @@ elif __name__ == '__main__':
                     len(output_lines), 2
                 )
 
+        def test_combine(self):
+            """ Fails if combined output of go() is wrong. """
+            manifest_content = (
+                    'file1.fastq\t0\tfile2.fastq\t0\t0\n'
+                    'file3.fastq\t0\tfile4.fastq\t0\t1\n'
+                    'file5.fastq\t0\tfile6.fastq\t0\t2\n'
+                )
+            with open(self.manifest_file, 'w') as manifest_stream:
+                manifest_stream.write(manifest_content)
+            junctions = (
+                    'chr1+\t000000000100\t000000000140\t0\t6\n'
+                    'chr2-\t000000000171\t000000000185\t2\x1f1\t2\x1f3\n'
+                    'chr2-\t000000000171\t000000000185\t2\t1\n'
+                    'chr3+\t000000000023\t000000000085\t1\t2\n'
+                )
+            with open(self.input_file, 'w') as output_stream:
+                output_stream.write(junctions)
+            manifest_object = manifest.LabelsAndIndices(self.manifest_file)
+            with open(self.input_file) as input_stream, \
+                open(self.output_file, 'w') as output_stream:
+                input_line_count, output_line_count = go(
+                    manifest_object=manifest_object,
+                    input_stream=input_stream,
+                    output_stream=output_stream,
+                    combine=True
+                )
+            self.assertEquals(
+                    input_line_count, 4
+                )
+            self.assertEquals(
+                    output_line_count, 3
+                )
+            with open(self.output_file) as output_stream:
+                self.assertEquals(
+                        output_stream.read(),
+                        'chr1+\t000000000100\t000000000140\t0\t6\n'
+                        'chr2-\t000000000171\t000000000185\t1\x1f2\t3\x1f3\n'
+                        'chr3+\t000000000023\t000000000085\t1\t2\n'
+                    )
+
         def tearDown(self):
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
@@ -62,6 +62,7 @@ site.addsitedir(base_path)
 
 import bowtie
 import bowtie_index
+from motif_index import cached_motif_index
 import partition
 from dooplicity.tools import xstream, register_cleanup
 from dooplicity.counters import Counter
@@ -89,223 +90,223 @@ _right_forward_elements = set(['AG', 'AC'])
 _left_elements = _left_reverse_elements | _left_forward_elements
 _right_elements = _right_reverse_elements | _right_forward_elements
 
-if 'pypy' not in sys.version.lower():
-    # For fast global alignment without PyPy
-    try:
-        from scipy import weave
-    except ImportError:
-        '''Weave is now standalone and may not be included in recent
-        versions of scipy. Try importing weave directly; the user 
-        should have "pip install weave"'d for this to work.'''
-        import weave
-    class GlobalAlignment(object):
-        """ Invokes Weave to obtain alignment score matrix with C. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                Places substitution_matrix directly in string containing C code
-                that obtains score matrix for global alignment. Executes C with
-                Weave on trivial case (two sequences, each one character) to 
-                ensure code is precompiled.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            '''Set supporting code including libraries and the function 
-            integer_sequence(), which converts a sequence of nucleotides to
-            an array of indices that correspond to indices of the substitution
-            matrix---also set in the constructor.'''
-            self.support_code = """ 
-                        int* integer_sequence(const char* seq, int length) {
-                            int i;
-                            int* int_seq = (int *)malloc(sizeof(int)*length);
-                            for (i = 0; seq[i]; i++) {
-                                switch (seq[i]) {
-                                    case 'A':
-                                    case 'a':
-                                        int_seq[i] = 0;
-                                        break;
-                                    case 'C':
-                                    case 'c':
-                                        int_seq[i] = 1;
-                                        break;
-                                    case 'G':
-                                    case 'g':
-                                        int_seq[i] = 2;
-                                        break;
-                                    case 'T':
-                                    case 't':
-                                        int_seq[i] = 3;
-                                        break;
-                                    case 'N':
-                                        int_seq[i] = 4;
-                                        break;
-                                    case '-':
-                                        int_seq[i] = 5;
-                                        break;
-                                    default:
-                                        int_seq[i] = 4;
-                                }
-                            }
-                            return int_seq;
-                        }
-                        """
-            '''Score matrix code is written in C/C++; see self.support_code
-            above for dependencies. substitution_matrix is embedded in code
-            below.'''
-            self.score_matrix_code = """
-                const char* c_first_seq = first_seq.c_str();
-                const char* c_second_seq = second_seq.c_str();
-                int row_count = first_seq.length() + 1;
-                int column_count = second_seq.length() + 1;
-                npy_intp dims[2] = {row_count, column_count};
-                PyObject* to_return = PyArray_SimpleNew(2, dims, NPY_INT);
-                int* score_matrix = (int *)((PyArrayObject*) to_return)->data;
-                int* substitution_matrix = (int *)malloc(sizeof(int)*6*6);
-                int* int_first_seq = integer_sequence(c_first_seq,
-                                                        row_count - 1);
-                int* int_second_seq = integer_sequence(c_second_seq,
-                                                        column_count - 1);
-            """ + """""".join(
-                            [("""substitution_matrix[%d] = %d;""" % ((i*6 + j), 
-                                substitution_matrix[i][j])) 
-                                for i in xrange(6) for j in xrange(6)]
-                        ) \
-            + """
-                int i, j;
-                score_matrix[0] = 0;
-                for (i = 1; i < row_count; i++) {
-                    score_matrix[i*column_count] = i 
-                        * substitution_matrix[int_first_seq[i-1]*6+5];
-                }
-                for (j = 1; j < column_count; j++) {
-                    score_matrix[j] = j 
-                        * substitution_matrix[5*6+int_second_seq[j-1]];
-                }
-                int diagonal, vertical, horizontal;
-                for (i = 1; i < row_count; i++) {
-                    for (j = 1; j < column_count; j++) {
-                        diagonal = score_matrix[(i-1)*column_count + j-1]
-                            + substitution_matrix[int_first_seq[i-1]*6
-                                                    +int_second_seq[j-1]];
-                        vertical = score_matrix[(i-1)*column_count + j]
-                            + substitution_matrix[int_first_seq[i-1]*6+5];
-                        horizontal = score_matrix[i*column_count + j-1]
-                            + substitution_matrix[5*6+int_second_seq[j-1]];
-                        score_matrix[i*column_count + j] = std::max(
-                                horizontal, std::max(diagonal, vertical)
-                            );
-                    }
-                }
-                free(int_first_seq);
-                free(int_second_seq);
-                free(substitution_matrix);
-                return_val = to_return;
-            """
-            stdout_holder = os.dup(sys.stdout.fileno())
-            try:
-                # Suppress compiler output by redirecting stdout temporarily
-                devnull = open(os.devnull, 'w')
-                os.dup2(devnull.fileno(), sys.stdout.fileno())
-                self.score_matrix('N', 'N')
-            except Exception as e:
-                print >>sys.stderr, 'C code for computing score matrix ' \
-                                    'failed to compile. Get Python\'s ' \
-                                    'distutils to use g++, and try again.'
-                raise
-            finally:
-                # Turn the tap back on
-                os.dup2(stdout_holder, sys.stdout.fileno())
-
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
-
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
-
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
-
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            return weave.inline(
-                                    self.score_matrix_code,
-                                    ['first_seq', 'second_seq'], 
-                                    support_code=self.support_code,
-                                    verbose=0
-                                )
-else:
-    # Use Python version of class
-    class GlobalAlignment(object):
-        """ Uses Python to obtain alignment score matrix. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            self.substitution_matrix = substitution_matrix
+try:
+    # For fast global alignment; PyPy may not have NumPy
+    import numpy as np
+except ImportError:
+    np = None
+
+# Maps characters to rows/columns of substitution matrix; anything else is N
+_substitution_index = ''.join(
+        chr('ACGTN-'.index(char.upper()) if char.upper() in 'ACGTN-' else 4)
+        for char in map(chr, xrange(256))
+    )
+
+class GlobalAlignment(object):
+    """ Obtains global alignment scores with NumPy if it's available.
+
+        A row of the score matrix is computed from the row above it with a
+        handful of vectorized operations: diagonal and vertical moves are
+        elementwise, and horizontal moves, which chain along the row, reduce
+        to a running maximum after subtracting cumulative gap penalties. Pure
+        Python is used if NumPy can't be imported.
+    """
 
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
+    def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
+                                            [-1, 0,-1,-1,-1,-1],
+                                            [-1,-1, 0,-1,-1,-1],
+                                            [-1,-1,-1, 0,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1]],
+                    use_numpy=True):
+        """ Constructor for GlobalAlignment.
+
+            substitution_matrix: 6 x 6 substitution matrix (list of
+                lists); rows and columns correspond to ACGTN-, where N is
+                aNy and - is a gap. Default: +1 for match, -5 for gap,
+                -1 for everything else.
+            use_numpy: False iff pure Python should be used even if NumPy
+                is available
+        """
+        self.substitution_matrix = substitution_matrix
+        self.use_numpy = use_numpy and np is not None
+        if self.use_numpy:
+            self.substitution_array = np.array(substitution_matrix,
+                                                dtype=np.int64)
+
+    def score_rows(self, first_seq, second_seq, transpose=False):
+        """ Yields rows of score matrix for global alignment one by one.
+
+            first_seq: first sequence (string); rows correspond to its
+                prefixes.
+            second_seq: second sequence (string); columns correspond to its
+                prefixes.
+            transpose: True iff substitution matrix should be transposed,
+                which is how the score matrix of (second_seq, first_seq) is
+                obtained by passing the sequences in the other order.
+
+            Yield value: row of score matrix; a numpy array if NumPy is
+                used and a list otherwise.
+        """
+        first_seq = first_seq.translate(_substitution_index)
+        second_seq = second_seq.translate(_substitution_index)
+        column_count = len(second_seq) + 1
+        if not self.use_numpy:
+            substitution_matrix = (zip(*self.substitution_matrix)
+                                    if transpose else self.substitution_matrix)
+            first_seq, second_seq = map(ord, first_seq), map(ord, second_seq)
+            gap_row = substitution_matrix[5]
+            row = [0] + [j * gap_row[second_seq[j-1]]
+                            for j in xrange(1, column_count)]
+            yield row
+            for i in xrange(1, len(first_seq) + 1):
+                substitution_row = substitution_matrix[first_seq[i-1]]
+                above, row = row, [i * substitution_row[5]]
+                for j in xrange(1, column_count):
+                    row.append(max(above[j-1]
+                                    + substitution_row[second_seq[j-1]],
+                                   above[j] + substitution_row[5],
+                                   row[j-1] + gap_row[second_seq[j-1]]))
+                yield row
+            return
+        cumulative_horizontal, rows = self.shifted_rows(first_seq,
+                                                        second_seq, transpose)
+        for row in rows:
+            yield row + cumulative_horizontal
+
+    def shifted_rows(self, first_seq, second_seq, transpose=False):
+        """ Obtains rows of score matrix with NumPy, offset to save work.
+
+            Each row is kept with the gap penalties accumulated along it
+            subtracted. Then the best score with horizontal moves into
+            position j, the max over k <= j of row[k] + cumulative[j]
+            - cumulative[k], is just a running max, and diagonal penalties
+            absorb the offset between neighboring columns.
+
+            first_seq: first sequence, already passed through
+                _substitution_index.
+            second_seq: second sequence, already passed through
+                _substitution_index.
+            transpose: True iff substitution matrix should be transposed
+
+            Return value: tuple (cumulative gap penalties along a row,
+                generator of score matrix rows minus those penalties)
+        """
+        substitution_array = (self.substitution_array.T if transpose
+                                else self.substitution_array)
+        first_seq = np.array(bytearray(first_seq), dtype=np.intp)
+        second_seq = np.array(bytearray(second_seq), dtype=np.intp)
+        column_count = len(second_seq) + 1
+        horizontal = substitution_array[5, second_seq]
+        cumulative_horizontal = np.zeros(column_count, dtype=np.int64)
+        np.cumsum(horizontal, out=cumulative_horizontal[1:])
+        diagonal = substitution_array[:, second_seq] - horizontal
+        vertical = substitution_array[:, 5]
+        def rows():
+            row = np.zeros(column_count, dtype=np.int64)
+            row[1:] = np.arange(1, column_count) * horizontal
+            row -= cumulative_horizontal
+            yield row
+            for i, char in enumerate(first_seq, 1):
+                above, row = row, np.empty(column_count, dtype=np.int64)
+                row[0] = i * vertical[char]
+                np.add(above[:-1], diagonal[char], out=row[1:])
+                np.maximum(row[1:], above[1:] + vertical[char], out=row[1:])
+                np.maximum.accumulate(row, out=row)
+                yield row
+        return cumulative_horizontal, rows()
+
+    def score_matrix(self, first_seq, second_seq):
+        """ Computes score matrix for global alignment of two sequences.
+
+            The substitution matrix is specified when the GlobalAlignment
+            class is instantiated.
+
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+
+            Return value: score_matrix, a numpy array (list of lists without
+                NumPy) whose dimensions are (len(first_seq) + 1) x
+                (len(second_seq) + 1). It can be used to trace back the best
+                global alignment.
+        """
+        if not self.use_numpy:
+            return list(self.score_rows(first_seq, second_seq))
+        return np.vstack(list(self.score_rows(first_seq, second_seq)))
 
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
+    def score(self, first_seq, second_seq):
+        """ Computes score of global alignment of two sequences.
 
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
+            Equivalent to score_matrix(first_seq, second_seq)[-1][-1], but
+            only a row of the score matrix is kept at a time, and there's a
+            row per character of the shorter sequence.
 
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            first_seq = ['ACGTN-'.index(char) for char in first_seq]
-            second_seq = ['ACGTN-'.index(char) for char in second_seq]
-            row_count = len(first_seq) + 1
-            column_count = len(second_seq) + 1
-            score_matrix = [[0 for i in xrange(column_count)]
-                                for j in xrange(row_count)]
-            for j in xrange(1, column_count):
-                score_matrix[0][j] = j \
-                    * self.substitution_matrix[5][second_seq[j-1]]
-            for i in xrange(1, row_count):
-                score_matrix[i][0] = i \
-                    * self.substitution_matrix[first_seq[i-1]][5]
-            for i in xrange(1, row_count):
-                for j in xrange(1, column_count):
-                    score_matrix[i][j] = max(score_matrix[i-1][j-1] 
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]]
-                                                        [second_seq[j-1]
-                                                    ], # diagonal
-                                             score_matrix[i-1][j]
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]][5
-                                                    ], # vertical
-                                             score_matrix[i][j-1]
-                                                + self.substitution_matrix[
-                                                        5][second_seq[j-1]
-                                                    ] # horizontal
-                                            )
-            return score_matrix
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+
+            Return value: alignment score (int).
+        """
+        if not self.use_numpy:
+            for row in self.score_rows(first_seq, second_seq):
+                pass
+            return row[-1]
+        first_seq = first_seq.translate(_substitution_index)
+        second_seq = second_seq.translate(_substitution_index)
+        if len(first_seq) > len(second_seq):
+            cumulative_horizontal, rows = self.shifted_rows(
+                    second_seq, first_seq, transpose=True
+                )
+        else:
+            cumulative_horizontal, rows = self.shifted_rows(first_seq,
+                                                            second_seq)
+        for row in rows:
+            pass
+        return int(row[-1] + cumulative_horizontal[-1])
+
+def benchmark_global_alignment(pair_count=1000, read_size=100,
+                                max_gaps_mismatches=3, seed=0):
+    """ Times GlobalAlignment.score with and without NumPy.
+
+        Each pair is a random read and a reference stretch obtained by
+        introducing up to max_gaps_mismatches mismatches and single-base
+        gaps, much like the realignments performed by junctions_from_clique.
+
+        pair_count: number of read/reference pairs to align
+        read_size: length of each read
+        max_gaps_mismatches: max number of edits per reference stretch
+        seed: seed of random number generator
+
+        Return value: dictionary mapping 'python' and 'numpy' to seconds
+            taken to score all pairs
+    """
+    import time
+    generator = random.Random(seed)
+    pairs = []
+    for _ in xrange(pair_count):
+        read_seq = [generator.choice('ACGT') for _ in xrange(read_size)]
+        reference_seq = list(read_seq)
+        for _ in xrange(generator.randint(0, max_gaps_mismatches)):
+            position = generator.randrange(len(reference_seq))
+            edit = generator.random()
+            if edit < 0.5:
+                reference_seq[position] = generator.choice('ACGT')
+            elif edit < 0.75:
+                del reference_seq[position]
+            else:
+                reference_seq.insert(position, generator.choice('ACGT'))
+        pairs.append((''.join(read_seq), ''.join(reference_seq)))
+    timings, scores = {}, {}
+    for engine, use_numpy in [('python', False), ('numpy', True)]:
+        global_alignment = GlobalAlignment(use_numpy=use_numpy)
+        if use_numpy and not global_alignment.use_numpy:
+            break
+        start_time = time.time()
+        scores[engine] = [global_alignment.score(read_seq, reference_seq)
+                            for read_seq, reference_seq in pairs]
+        timings[engine] = time.time() - start_time
+    if len(scores) == 2:
+        assert scores['python'] == scores['numpy']
+    return timings
 
 def maximal_suffix_match(query_seq, search_window,
                             min_cap_size=8, max_cap_count=5):
@@ -333,16 +334,17 @@ def maximal_suffix_match(query_seq, search_window,
     suffixes = []
     first_search = True
     while len(suffixes) <= max_cap_count:
-        suffix = re.search(suffix_seq, search_window[offset:])
-        if suffix is None:
+        # Search in place rather than in a copy of the rest of the window
+        suffix_offset = search_window.find(suffix_seq, offset)
+        if suffix_offset == -1:
             break
-        elif first_search and not suffix.start():
+        elif first_search and suffix_offset == offset:
             '''Suffix was found on first search at very beginning of window;
             it's VERY likely just an extension.'''
             return None
         else:
             extra_base_count = 0
-            offset += suffix.start()
+            offset = suffix_offset
             while min_cap_size + extra_base_count < query_seq_size:
                 if query_seq[-min_cap_size-extra_base_count-1] \
                     == search_window[offset-extra_base_count-1]:
@@ -363,6 +365,23 @@ def maximal_suffix_match(query_seq, search_window,
         # No suffixes found
         return None
 
+def occurrences(query_seq, search_window):
+    """ Finds every occurrence of query_seq in search_window.
+
+        query_seq: sequence to search for.
+        search_window: sequence to search in.
+
+        Return value: list of offsets of occurrences from beginning of
+            search_window in ascending order, including overlapping
+            occurrences
+    """
+    offsets = []
+    offset = search_window.find(query_seq)
+    while offset != -1:
+        offsets.append(offset)
+        offset = search_window.find(query_seq, offset + 1)
+    return offsets
+
 def alignment_adjacencies(alignments):
     """ Generates adjacency matrix for graph described below.
 
@@ -561,7 +580,109 @@ def maximum_clique(cluster):
     counter.add('largest_clique_ties')
     return random.choice(largest_cliques)
 
-def selected_readlet_alignments_by_clustering(readlets, experimental=False):
+def maximum_chain(cluster):
+    """ Finds largest set of mutually order-consistent alignments.
+
+        Order-consistency, as described in maximum_clique(), makes the
+        alignments to a given strand a partial order: alignments sharing a
+        displacement and position are interchangeable, and otherwise one
+        precedes another iff both its displacement and position are smaller.
+        A maximum clique is thus a heaviest chain of groups of alignments
+        sharing a displacement and position. It's found by sweeping groups
+        in order of displacement while a Fenwick tree keyed by position
+        tracks the heaviest chain ending before each position. The tree
+        also counts heaviest chains so a tie is broken uniformly at random,
+        as in maximum_clique(), by walking back from a chain's end through
+        groups whose chains are exactly as heavy as what remains. Weights
+        strictly decrease along the walk, so indexing groups by weight has
+        it look at each group at most once. All this takes O(n log n) time
+        rather than time exponential in the worst case.
+
+        cluster: a list of alignment tuples
+            (rname, reverse_strand, pos, end_pos, displacement), each
+            corresponding to a distinct readlet
+
+        Return value: maximum clique -- a list of alignments.
+    """
+    # Group interchangeable alignments
+    groups = defaultdict(list)
+    for alignment in cluster:
+        groups[alignment[:3] + (alignment[4],)].append(alignment)
+    strand_groups = defaultdict(list)
+    for group in groups:
+        strand_groups[group[:2]].append(group)
+    # Weight and number of heaviest chains ending at each group
+    chain_weights, chain_counts = {}, {}
+    for strand_group in strand_groups.itervalues():
+        ranks = dict((pos, i) for i, pos in enumerate(
+                        sorted(set(group[2] for group in strand_group)), 1
+                    ))
+        tree = [(0, 0)] * (len(ranks) + 1)
+        strand_group.sort(key=lambda group: (group[3], group[2]))
+        for _, same_displacement in itertools.groupby(
+                                            strand_group,
+                                            key=lambda group: group[3]
+                                        ):
+            same_displacement = list(same_displacement)
+            for group in same_displacement:
+                # Query heaviest chains ending at smaller positions
+                weight, count = 0, 1
+                i = ranks[group[2]] - 1
+                while i:
+                    if tree[i][0] > weight:
+                        weight, count = tree[i]
+                    elif tree[i][0] == weight:
+                        count += tree[i][1]
+                    i -= i & -i
+                chain_weights[group] = weight + len(groups[group])
+                chain_counts[group] = count
+            '''Add chains only after all groups with the same displacement
+            are queried since they can't be in the same chain.'''
+            for group in same_displacement:
+                i = ranks[group[2]]
+                while i < len(tree):
+                    if chain_weights[group] > tree[i][0]:
+                        tree[i] = (chain_weights[group], chain_counts[group])
+                    elif chain_weights[group] == tree[i][0]:
+                        tree[i] = (tree[i][0],
+                                    tree[i][1] + chain_counts[group])
+                    i += i & -i
+    if not groups:
+        return []
+    # Groups by strand and weight of heaviest chain ending at them
+    weight_groups = defaultdict(list)
+    for group in groups:
+        weight_groups[group[:2] + (chain_weights[group],)].append(group)
+    max_chain_weight = max(chain_weights.itervalues())
+    candidates = [group for group in groups
+                    if chain_weights[group] == max_chain_weight]
+    if len(candidates) > 1 or chain_counts[candidates[0]] > 1:
+        counter.add('largest_clique_ties')
+    chain = []
+    while candidates:
+        if len(candidates) == 1:
+            group = candidates[0]
+        else:
+            # Choose group with probability proportional to its chain count
+            choice = random.randrange(
+                    sum(chain_counts[group] for group in candidates)
+                )
+            for group in sorted(candidates):
+                choice -= chain_counts[group]
+                if choice < 0:
+                    break
+        chain.extend(groups[group])
+        remaining_weight = chain_weights[group] - len(groups[group])
+        candidates = [predecessor for predecessor in weight_groups[
+                                group[:2] + (remaining_weight,)
+                            ]
+                        if predecessor[3] < group[3]
+                        and predecessor[2] < group[2]]
+    chain.reverse()
+    return chain
+
+def selected_readlet_alignments_by_clustering(readlets, experimental=False,
+                                                exhaustive_cliques=False):
     """ Selects multireadlet alignment via a correlation clustering algorithm.
     
         Consider a list "readlets" whose items {R_i} correspond to the aligned
@@ -617,6 +738,9 @@ def selected_readlet_alignments_by_clustering(readlets, experimental=False):
             (rname, reverse_strand, pos, end_pos, displacement).
             See above for a detailed explanation.
         experimental: True iff experimental algos should be run.
+        exhaustive_cliques: True iff maximum cliques of clusters should be
+            found by enumerating maximal cliques with maximum_clique() rather
+            than by chaining with maximum_chain(); for validation
 
         Return value: a list of selected alignment tuples
             (rname, reverse_strand, pos, end_pos, displacement).
@@ -657,7 +781,10 @@ def selected_readlet_alignments_by_clustering(readlets, experimental=False):
     maximum_cliques = []
     done_one = False
     for i, cluster in enumerate(clustered_alignments):
-        current_maximum_clique = maximum_clique(cluster)
+        if exhaustive_cliques:
+            current_maximum_clique = maximum_clique(cluster)
+        else:
+            current_maximum_clique = maximum_chain(cluster)
         maximum_cliques.append(current_maximum_clique)
         try:
             if len(current_maximum_clique) > len(clustered_alignments[i+1]):
@@ -745,7 +872,7 @@ def junctions_from_clique(clique, read_seq, reference_index,
         min_exon_size=8, min_intron_size=10, max_intron_size=500000,
         search_window_size=1000, stranded=False, motif_radius=1,
         reverse_reverse_strand=False, global_alignment=GlobalAlignment(),
-        max_gaps_mismatches=5, sign=1):
+        max_gaps_mismatches=5, sign=1, motif_index=None):
     """ 
         NOTE THAT clique LIST IS SORTED ASSUMING THE ONLY READLETS WHOSE
         DISPLACEMENTS ARE THE SAME ARE CAPPING READLETS. IF THE READLETIZING
@@ -775,6 +902,8 @@ def junctions_from_clique(clique, read_seq, reference_index,
             in realignments to reference minus intron per 100 bp or None if
             unlimited
         sign: '+' for standard; '-' for nonstandard
+        motif_index: object of class motif_index.MotifIndex used to find
+            splice-site motifs without scanning reference or None to scan
     """
     if not clique:
         return
@@ -896,28 +1025,42 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                     - left_motif_search_bounds[0]
         right_motif_search_size = right_motif_search_bounds[1] \
                                     - right_motif_search_bounds[0]
-        left_motif_window = reference_index.get_stretch(
+        if motif_index is not None:
+            left_offsets, left_motifs = motif_index.motifs_in_window(
                                         rname,
                                         left_motif_search_bounds[0] - 1,
-                                        left_motif_search_size
+                                        left_motif_search_size,
+                                        left_search_motifs
                                     )
-        right_motif_window = reference_index.get_stretch(
+            right_offsets, right_motifs = motif_index.motifs_in_window(
                                         rname,
                                         right_motif_search_bounds[0] - 1,
-                                        right_motif_search_size
+                                        right_motif_search_size,
+                                        right_search_motifs
                                     )
-        left_offsets = []
-        left_motifs = []
-        right_offsets = []
-        right_motifs = []
-        for i in xrange(left_motif_search_size):
-            if left_motif_window[i:i+2] in left_search_motifs:
-                left_motifs.append(left_motif_window[i:i+2])
-                left_offsets.append(i)
-        for i in xrange(right_motif_search_size):
-            if right_motif_window[i:i+2] in right_search_motifs:
-                right_motifs.append(right_motif_window[i:i+2])
-                right_offsets.append(i)
+        else:
+            left_motif_window = reference_index.get_stretch(
+                                            rname,
+                                            left_motif_search_bounds[0] - 1,
+                                            left_motif_search_size
+                                        )
+            right_motif_window = reference_index.get_stretch(
+                                            rname,
+                                            right_motif_search_bounds[0] - 1,
+                                            right_motif_search_size
+                                        )
+            left_offsets = []
+            left_motifs = []
+            right_offsets = []
+            right_motifs = []
+            for i in xrange(left_motif_search_size):
+                if left_motif_window[i:i+2] in left_search_motifs:
+                    left_motifs.append(left_motif_window[i:i+2])
+                    left_offsets.append(i)
+            for i in xrange(right_motif_search_size):
+                if right_motif_window[i:i+2] in right_search_motifs:
+                    right_motifs.append(right_motif_window[i:i+2])
+                    right_offsets.append(i)
         product_offsets = list(itertools.product(left_offsets, right_offsets))
         product_motifs = list(itertools.product(left_motifs, right_motifs))
         candidate_junctions = []
@@ -962,12 +1105,12 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         - intron_end_pos
                                                     )
                         reference_minus_intron = left_stretch + right_stretch
-                        alignment_score = global_alignment.score_matrix(
+                        alignment_score = global_alignment.score(
                                                 read_seq[
                                                     left_displacement:
                                                     left_displacement+read_span
                                                 ],
-                                                reference_minus_intron)[-1][-1]
+                                                reference_minus_intron)
                         counter.add('candidate_without_small_exon')
                         tmpmotif = product_motifs[i][0] + '_' + product_motifs[i][1]
                         counter.add('candidate_with_motif_' + tmpmotif)
@@ -1042,29 +1185,49 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         search_window_size
                                                     )]
                         found_alignment_score = False
+                        '''Find small exon in each window just once; matches
+                        of capped exons are occurrences with the right caps.
+                        Like re.finditer(), don't report a match overlapping
+                        the previous one.'''
+                        small_exon_offsets = [
+                                occurrences(small_exon, search_window)
+                                for search_window in search_windows
+                            ]
                         for cap_combo in cap_combos:
-                            capped_exon \
-                                = cap_combo[0] + small_exon + cap_combo[1]
                             for j, search_window in enumerate(search_windows):
-                                for small_exon_match \
-                                    in re.finditer(capped_exon, search_window):
+                                match_end = 0
+                                for small_exon_offset in small_exon_offsets[j]:
+                                    match_start = small_exon_offset - 2
+                                    window_exon_end \
+                                        = small_exon_offset + small_exon_size
+                                    if match_start < match_end or (
+                                            search_window[match_start:
+                                                            small_exon_offset]
+                                            != cap_combo[0]
+                                        ) or (
+                                            search_window[window_exon_end:
+                                                            window_exon_end + 2]
+                                            != cap_combo[1]
+                                        ):
+                                        continue
+                                    match_end = window_exon_end + 2
                                     if not found_alignment_score:
                                         alignment_score \
-                                            = global_alignment.score_matrix(
+                                            = global_alignment.score(
                                                     read_seq[
                                                         left_displacement:
                                                         left_displacement
                                                         + read_span
                                                     ],
                                                     reference_minus_introns
-                                                )[-1][-1]
+                                                )
                                         found_alignment_score = True
                                     # Split original intron
                                     if j == 0:
                                         # First search-window type
                                         first_intron_end_pos \
                                             = intron_pos \
-                                                + small_exon_match.start() + 2
+                                                + match_start + 2
                                         second_intron_pos \
                                             = first_intron_end_pos \
                                                 + small_exon_size
@@ -1073,7 +1236,7 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                         second_intron_pos \
                                             = intron_end_pos \
                                                 - search_window_size \
-                                                + small_exon_match.end() - 2
+                                                + match_end - 2
                                         first_intron_end_pos \
                                             = second_intron_pos \
                                                 - small_exon_size
@@ -1129,7 +1292,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
     bowtie_index_base='genome', verbose=False, stranded=False, min_exon_size=8,
     min_intron_size=15, max_intron_size=500000, motif_radius=1,
     search_window_size=1000, global_alignment=GlobalAlignment(),
-    max_gaps_mismatches=5, experimental=False):
+    max_gaps_mismatches=5, experimental=False, exhaustive_cliques=False):
     """ Runs Rail-RNA-junction_search.
 
         Input (read from stdin)
@@ -1210,11 +1373,15 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
             read, or first readlet of a read written to stderr increases
             exponentially with base report_multiplier.
         experimental: True iff experimental algos should be run
+        exhaustive_cliques: True iff maximal cliques of readlet alignments
+            should be enumerated rather than chained; for validation
 
         No return value.
     """
     global _input_line_count, _output_line_count
-    reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
+    reference_index = bowtie_index.cached_reference(bowtie_index_base)
+    # None if motif_index.py hasn't indexed reference; motifs are then scanned
+    motif_index = cached_motif_index(bowtie_index_base)
     '''Input is readletized, and readlets must be composed.'''
     for (seq_id,), xpartition in xstream(input_stream, 1):
         readlet_displacements, collected_readlets = [], []
@@ -1263,7 +1430,10 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
             random.seed(seq)
             selected_readlets = selected_readlet_alignments_by_clustering(
                                             multireadlets,
-                                            experimental=experimental
+                                            experimental=experimental,
+                                            exhaustive_cliques=(
+                                                exhaustive_cliques
+                                            )
                                         )
             fake_junctions = []
             if stranded:
@@ -1280,7 +1450,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                             motif_radius=motif_radius,
                             reverse_reverse_strand=False,
                             global_alignment=global_alignment,
-                            max_gaps_mismatches=max_gaps_mismatches
+                            max_gaps_mismatches=max_gaps_mismatches,
+                            motif_index=motif_index
                         ))
                     if experimental and selected_readlets[1]:
                         fake_junctions = list(junctions_from_clique(
@@ -1296,7 +1467,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                                 reverse_reverse_strand=False,
                                 global_alignment=global_alignment,
                                 max_gaps_mismatches=max_gaps_mismatches,
-                                sign=-1
+                                sign=-1,
+                                motif_index=motif_index
                             ))
                     for (junction_rname, junction_reverse_strand,
                             intron_pos, intron_end_pos) in itertools.chain(
@@ -1324,7 +1496,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                             motif_radius=motif_radius,
                             reverse_reverse_strand=True,
                             global_alignment=global_alignment,
-                            max_gaps_mismatches=max_gaps_mismatches
+                            max_gaps_mismatches=max_gaps_mismatches,
+                            motif_index=motif_index
                         )
                     if experimental and selected_readlets[1]:
                         fake_junctions = list(junctions_from_clique(
@@ -1340,7 +1513,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                                 reverse_reverse_strand=False,
                                 global_alignment=global_alignment,
                                 max_gaps_mismatches=max_gaps_mismatches,
-                                sign=-1
+                                sign=-1,
+                                motif_index=motif_index
                             ))
                     for (junction_rname, junction_reverse_strand,
                              intron_pos, intron_end_pos) in itertools.chain(
@@ -1384,7 +1558,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                         motif_radius=motif_radius,
                         stranded=stranded,
                         global_alignment=global_alignment,
-                        max_gaps_mismatches=max_gaps_mismatches
+                        max_gaps_mismatches=max_gaps_mismatches,
+                        motif_index=motif_index
                     )
                 if experimental and selected_readlets[1]:
                     fake_junctions = list(junctions_from_clique(
@@ -1400,7 +1575,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                                 reverse_reverse_strand=False,
                                 global_alignment=global_alignment,
                                 max_gaps_mismatches=max_gaps_mismatches,
-                                sign=-1
+                                sign=-1,
+                                motif_index=motif_index
                             ))
                 for (junction_rname, junction_reverse_strand,
                             intron_pos, intron_end_pos) in itertools.chain(
@@ -1431,6 +1607,10 @@ if __name__ == '__main__':
         '--stranded', action='store_const', const=True, default=False,
         help='Assume input reads come from the sense strand; then partitions '
              'in output have terminal + and - indicating sense strand')
+    parser.add_argument('--benchmark', action='store_const', const=True,
+        default=False,
+        help='Time global alignment with and without NumPy on simulated '
+             'reads; DOES NOT NEED INPUT FROM STDIN')
     parser.add_argument('--test', action='store_const', const=True,
         default=False,
         help='Run unit tests; DOES NOT NEED INPUT FROM STDIN, AND DOES NOT '
@@ -1438,6 +1618,12 @@ if __name__ == '__main__':
     parser.add_argument('--experimental', action='store_const', const=True,
         default=False,
         help='includes experimental algorithms')
+    parser.add_argument('--exhaustive-cliques', action='store_const',
+        const=True,
+        default=False,
+        help='Select readlet alignments by enumerating maximal cliques, which '
+             'takes exponential time in the worst case, rather than by '
+             'chaining; for validation')
     parser.add_argument('--min-intron-size', type=int, required=False,
         default=5,
         help='Filters introns of length smaller than this value')
@@ -1469,7 +1655,19 @@ if __name__ == '__main__':
     different command-line arguments can be passed to it for unit tests.'''
     args = parser.parse_args(sys.argv[1:])
 
-if __name__ == '__main__' and not args.test:
+if __name__ == '__main__' and args.benchmark:
+    timings = benchmark_global_alignment(
+            max_gaps_mismatches=args.max_gaps_mismatches
+        )
+    for engine in sorted(timings):
+        print >>sys.stderr, '%s: %0.3f s' % (engine, timings[engine])
+    if 'numpy' not in timings:
+        print >>sys.stderr, 'NumPy is unavailable.'
+    else:
+        print >>sys.stderr, 'speedup: %0.1fx' % (
+                timings['python'] / timings['numpy']
+            )
+elif __name__ == '__main__' and not args.test:
     import time
     start_time = time.time()
     global_alignment = GlobalAlignment()
@@ -1483,6 +1681,7 @@ if __name__ == '__main__' and not args.test:
         search_window_size=args.search_window_size,
         max_gaps_mismatches=args.max_gaps_mismatches,
         experimental=args.experimental,
+        exhaustive_cliques=args.exhaustive_cliques,
         global_alignment=global_alignment)
     print >> sys.stderr, 'DONE with junction_search.py; in/out=%d/%d; ' \
         'time=%0.3f s' % (_input_line_count, _output_line_count,
@@ -1503,6 +1702,52 @@ elif __name__ == '__main__':
         """
         return ''.join([random.choice('ATCG') for _ in xrange(seq_size)])
     
+    class TestGlobalAlignment(unittest.TestCase):
+        """ Tests GlobalAlignment; needs no fixture. """
+        def test_small_alignment(self):
+            """ Fails if score of a known alignment is incorrect. """
+            global_alignment = GlobalAlignment()
+            self.assertEqual(global_alignment.score('ACGTACGT', 'ACGTACGT'),
+                                0)
+            # One mismatch
+            self.assertEqual(global_alignment.score('ACGTACGT', 'ACCTACGT'),
+                                -1)
+            # One deletion
+            self.assertEqual(global_alignment.score('ACGTACGT', 'ACGACGT'),
+                                -1)
+            self.assertEqual(global_alignment.score('', 'ACG'), -3)
+
+        def test_numpy_and_python_agree(self):
+            """ Fails if engines disagree, also with asymmetric scores. """
+            random.seed(5)
+            substitution_matrix = [[random.randint(-4, 2) for _ in xrange(6)]
+                                    for _ in xrange(6)]
+            for python_alignment, numpy_alignment in [
+                    (GlobalAlignment(use_numpy=False), GlobalAlignment()),
+                    (GlobalAlignment(substitution_matrix, use_numpy=False),
+                        GlobalAlignment(substitution_matrix))
+                ]:
+                for _ in xrange(200):
+                    first_seq = random_sequence(random.randint(0, 20))
+                    second_seq = random_sequence(random.randint(0, 20))
+                    score_matrix = python_alignment.score_matrix(
+                                                first_seq, second_seq
+                                            )
+                    self.assertEqual(
+                            [list(row) for row in
+                                numpy_alignment.score_matrix(first_seq,
+                                                                second_seq)],
+                            score_matrix
+                        )
+                    self.assertEqual(
+                            numpy_alignment.score(first_seq, second_seq),
+                            score_matrix[-1][-1]
+                        )
+                    self.assertEqual(
+                            python_alignment.score(first_seq, second_seq),
+                            score_matrix[-1][-1]
+                        )
+
     class TestMaximalSuffixMatch(unittest.TestCase):
         """ Tests maximal_suffix_match(); needs no fixture. """
         def test_one_instance_1(self):
@@ -1549,6 +1794,66 @@ elif __name__ == '__main__':
                     None
                 )
 
+    class TestMaximumChain(unittest.TestCase):
+        """ Tests maximum_chain(); needs no fixture. """
+        def test_known_chain(self):
+            """ Fails if largest consistent set of alignments isn't found.
+            """
+            cluster = [('chr1', False, 100, 120, 0),
+                       ('chr1', False, 130, 150, 30),
+                       ('chr1', False, 90, 110, 10),
+                       ('chr1', False, 140, 160, 40),
+                       ('chr1', False, 140, 150, 40),
+                       ('chr1', True, 135, 155, 35)]
+            self.assertEqual(
+                    sorted(maximum_chain(cluster)),
+                    [('chr1', False, 100, 120, 0),
+                     ('chr1', False, 130, 150, 30),
+                     ('chr1', False, 140, 150, 40),
+                     ('chr1', False, 140, 160, 40)]
+                )
+            self.assertEqual(maximum_chain([]), [])
+
+        def test_same_size_as_maximum_clique(self):
+            """ Fails if chaining and clique enumeration disagree on size.
+            """
+            random.seed(7)
+            for _ in xrange(200):
+                cluster = []
+                for i in xrange(random.randint(1, 10)):
+                    displacement = random.randrange(0, 50, 5)
+                    pos = random.randint(100, 150)
+                    if any(alignment[2] == pos and alignment[4] != displacement
+                            for alignment in cluster):
+                        # Positions match iff displacements match
+                        continue
+                    cluster.append(('chr1', random.random() < 0.2, pos,
+                                        pos + 20, displacement, i))
+                self.assertEqual(len(maximum_chain(cluster)),
+                                    len(maximum_clique(cluster)))
+
+        def test_long_chain(self):
+            """ Fails if walking back a long chain takes quadratic time.
+
+                Rescanning every group at each step of the walk took
+                minutes here.
+            """
+            cluster = [('chr1', False, i, i + 10, i) for i in xrange(20000)]
+            cluster.extend(('chr1', False, i + 1, i + 11, i)
+                            for i in xrange(0, 20000, 2))
+            chain = maximum_chain(cluster)
+            self.assertEqual(len(chain), 20000)
+            self.assertEqual([alignment[4] for alignment in chain],
+                             range(20000))
+
+    class TestOccurrences(unittest.TestCase):
+        """ Tests occurrences(); needs no fixture. """
+        def test_overlapping_occurrences(self):
+            """ Fails if overlapping occurrences are not all found.
+            """
+            self.assertEqual(occurrences('ATA', 'CATATATGATA'), [1, 3, 8])
+            self.assertEqual(occurrences('ATA', 'CAGT'), [])
+
     class TestJunctionsFromClique(unittest.TestCase):
         """ Tests junctions_from_clique(). """
         def setUp(self):
@@ -1603,7 +1908,34 @@ elif __name__ == '__main__':
                     list(junctions),
                     [('chr1', False, 48, 66), ('chr1', False, 75, 95)]
                 )
-            
+
+        def test_split_intron_with_motif_index(self):
+            """ Fails if motif index changes junctions found. """
+            from motif_index import MotifIndex, write_motif_index
+            write_motif_index(self.reference_index,
+                                self.bowtie_build_base + '.motifs',
+                                self.bowtie_build_base)
+            motif_index = MotifIndex()
+            self.assertTrue(motif_index.load(
+                    self.bowtie_build_base + '.motifs', self.bowtie_build_base
+                ))
+            read_seq = 'AGGACCTTTACCTACATACTGGCATACTAGATCCAGATTACGATAC'
+            clique = [('chr1', False, 27, 48, 0), ('chr1', False, 95, 111, 30)]
+            for motif_radius in [0, 1, 3]:
+                for stranded in [False, True]:
+                    self.assertEquals(*[
+                            list(junctions_from_clique(list(clique), read_seq,
+                                            self.reference_index,
+                                            min_exon_size=8,
+                                            min_intron_size=5,
+                                            search_window_size=1000,
+                                            stranded=stranded,
+                                            motif_radius=motif_radius,
+                                            max_gaps_mismatches=5,
+                                            motif_index=index))
+                            for index in [None, motif_index]
+                        ])
+
 
         def tearDown(self):
             # Kill temporary directory
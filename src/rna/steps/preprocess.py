@@ -17,6 +17,12 @@ Tab-separated fields:
     each new file
 3. \x1d-separated list of numbers of reads to include in gzipped files
 4. \x1d-separated list of manifest lines whose tabs are replaced by \x1es
+5. \x1d-separated list of access points, one per manifest line, from
+    which to start reading each file rather than from its beginning (see
+    split_points.py); each is empty if there is none or has the form
+    <record index>:<offset>:<inner offset>, with an offset and inner
+    offset per mate. This field may be absent.
+6. Phred format of qualities
 
 ---Otherwise:
 manifest line
@@ -72,6 +78,7 @@ import os
 import sys
 import site
 import string
+import math
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -89,8 +96,8 @@ import filemover
 import tempdel
 import subprocess
 from guess import phred_converter
+from split_points import xopen_at, parsed_access_point
 from encode import encode, encode_sequence
-import re
 
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
@@ -108,6 +115,23 @@ _MX, _MN = 6, 2
 '''This table depends on _MX, _MN above; it maps mismatch penalties to quality
 scores, each an "exemplar" from a different bin.'''
 _mismatch_penalties_to_quality_scores = string.maketrans('23456', '#05Hh')
+'''Maps each phred+33 quality character to the exemplar of its bin. The
+mismatch penalty for a quality q is _MN + floor((_MX - _MN) * min(q, 40) / 40);
+characters below '!' only arise from malformed input and go to the lowest
+bin.'''
+_binned_quality_translation_table = ''.join([
+        str(int(_MN + math.floor(
+                (_MX - _MN) * min(max(i - 33.0, 0.0), 40.0) / 40.0
+            ))) for i in xrange(256)
+    ]).translate(_mismatch_penalties_to_quality_scores)
+'''Maps each character of a read sequence to itself uppercased if it's one of
+ATCGN and to N otherwise.'''
+_sanitized_sequence_translation_table = ''.join([
+        chr(i).upper() if chr(i).upper() in 'ATCGN' else 'N'
+        for i in xrange(256)
+    ])
+# Number of output lines to write at once
+_output_batch_size = 1000
 
 def qname_from_read(qname, seq, sample_label, mate=None):
     """ Returns QNAME including sample label and ID formed from hash.
@@ -288,6 +312,13 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         3. \x1d-separated list of numbers of reads to include in gzipped files
         4. \x1d-separated list of manifest lines whose tabs are replaced by
             \x1es
+        5. \x1d-separated list of access points, one per manifest line,
+            from which to start reading each file rather than from its
+            beginning (see split_points.py); each is empty if there is
+            none or has the form <record index>:<offset>:<inner offset>,
+            with an offset and inner offset per mate. This field may be
+            absent.
+        6. Phred format of qualities
 
         ---Otherwise:
         manifest line
@@ -362,7 +393,6 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         No return value
     """
     if bin_qualities:
-        import math
         def round_quality_string(qual):
             """ Bins phred+33 quality string to improve compression.
 
@@ -372,14 +402,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
 
                 Return value: "binned" quality string.
             """
-            return ''.join(
-                [str(int(
-                    _MN + math.floor((_MX - _MN) * min(
-                                                    ord(qual_char) - 33.0, 40.0
-                                                ) / 40.0)
-                        )) for qual_char in qual]).translate(
-                                _mismatch_penalties_to_quality_scores
-                            )
+            return qual.translate(_binned_quality_translation_table)
     else:
         def round_quality_string(qual):
             """ Leaves quality string unbinned and untouched.
@@ -433,14 +456,21 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
             read_counts = tokens[2].split('\x1d')
             manifest_lines = [token.split('\x1e')
                                 for token in tokens[3].split('\x1d')]
-            assert len(indexes) == len(read_counts) == len(manifest_lines)
+            if token_count > 5:
+                access_points = [parsed_access_point(token)
+                                    for token in tokens[4].split('\x1d')]
+            else:
+                access_points = [None] * len(indexes)
+            assert (len(indexes) == len(read_counts) == len(manifest_lines)
+                        == len(access_points))
             for i, manifest_line in enumerate(manifest_lines):
                 manifest_line_field_count = len(manifest_line)
                 if manifest_line_field_count == 3:
                     source_dict[(Url(manifest_line[0]),)] = (
                             manifest_line[-1],
                             int(indexes[i]),
-                            int(read_counts[i])
+                            int(read_counts[i]),
+                            access_points[i]
                         )
                 else:
                     assert manifest_line_field_count == 5
@@ -448,7 +478,8 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                  Url(manifest_line[2]))] = (
                                                         manifest_line[-1],
                                                         int(indexes[i]),
-                                                        int(read_counts[i])
+                                                        int(read_counts[i]),
+                                                        access_points[i]
                                                     )
         elif token_count == 3:
             # SRA or single-end reads
@@ -468,8 +499,10 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         downloaded = set()
         sources = []
         records_printed = 0
-        if len(source_dict[source_urls]) == 3:
+        access_point = None
+        if len(source_dict[source_urls]) == 4:
             skip_count = source_dict[source_urls][1]
+            access_point = source_dict[source_urls][3]
             if len(source_urls) == 2:
                 records_to_consume = source_dict[source_urls][2]
                 if skip_count % 2:
@@ -482,6 +515,11 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
             else:
                 records_to_consume = source_dict[source_urls][2]
                 read_index = skip_count
+            if access_point is not None:
+                '''Start reading at access point, skipping only the records
+                between it and the first record of the split.'''
+                skip_count -= access_point[0] * len(source_urls)
+                counter.add('access_points_used')
         else:
             skip_count = 0
             records_to_consume = None # Consume all records
@@ -677,9 +715,16 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
             # Figure out Phred format
             with xopen(None, sources[0]) as source_stream:
                 qual_getter = phred_converter(fastq_stream=source_stream)
-        with xopen(None, sources[0]) as source_stream_1, xopen(
-                None, sources[1]
-            ) as source_stream_2:
+        if access_point is None:
+            source_openers = [xopen(None, source) for source in sources]
+        else:
+            source_openers = [
+                    xopen_at(source, *access_point[1][i])
+                    if source != os.devnull else xopen(None, source)
+                    for i, source in enumerate(sources)
+                ]
+        with source_openers[0] as source_stream_1, \
+            source_openers[1] as source_stream_2:
             source_streams = [source_stream_1, source_stream_2]
             reorganize = all([source == os.devnull for source in sources])
             sra_live = False
@@ -744,6 +789,8 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                     line_numbers = [0, 0]
                     read_next_line = True
                     lines = []
+                    # Formatted records waiting to be written
+                    output_lines = []
                     nucs_read = 0
                     pairs_read = 0
                     while True:
@@ -775,9 +822,9 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                             ((skip_count / 2) * 4 - 1), 0
                                         )
                                     for _ in xrange(line_skip_count):
-                                        next(source_stream_2)
+                                        source_stream_2.readline()
                                 for _ in xrange(line_skip_count):
-                                    next(source_stream_1)
+                                    source_stream_1.readline()
                                 if skip_count:
                                     lines = []
                                     for source_stream in source_streams:
@@ -966,8 +1013,9 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                 original_qnames[1] += '/2'
                             assert seqs[1]
                             assert quals[1]
-                            seqs = [re.sub(r'[^ATCGN]', 'N', seq.upper())
-                                    for seq in seqs]
+                            seqs = [seq.translate(
+                                        _sanitized_sequence_translation_table
+                                    ) for seq in seqs]
                             reversed_complement_seqs = [
                                     seqs[0][::-1].translate(
                                         _reversed_complement_translation_table
@@ -1000,7 +1048,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                             else:
                                 left_qname_to_write = original_qnames[0]
                                 right_qname_to_write = original_qnames[1]
-                            print >>output_stream, '\t'.join(
+                            output_lines.append('\t'.join(
                                         [
                                             left_seq,
                                             left_reversed,
@@ -1024,11 +1072,13 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                                 ),
                                             round_quality_string(right_qual)
                                         ]
-                                    )
+                                    ))
                             records_printed += 2
                             _output_line_count += 1
                         else:
-                            seqs[0] = re.sub(r'[^ATCGN]', 'N', seqs[0].upper())
+                            seqs[0] = seqs[0].translate(
+                                    _sanitized_sequence_translation_table
+                                )
                             reversed_complement_seqs = [
                                     seqs[0][::-1].translate(
                                         _reversed_complement_translation_table
@@ -1047,7 +1097,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                 qname_to_write = encode(read_index)
                             else:
                                 qname_to_write = original_qnames[0]
-                            print >>output_stream, '\t'.join(
+                            output_lines.append('\t'.join(
                                         [
                                             seq,
                                             is_reversed,
@@ -1058,9 +1108,13 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                             ),
                                             round_quality_string(qual)
                                         ]
-                                    )
+                                    ))
                             records_printed += 1
                             _output_line_count += 1
+                        if len(output_lines) >= _output_batch_size:
+                            output_stream.write('\n'.join(output_lines))
+                            output_stream.write('\n')
+                            output_lines = []
                         read_index += 1
                         for seq in seqs:
                             nucs_read += len(seq)
@@ -1072,6 +1126,9 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                             nucs_read > nucleotides_per_input:
                             file_number += 1
                             break
+                    if output_lines:
+                        output_stream.write('\n'.join(output_lines))
+                        output_stream.write('\n')
                 if verbose:
                     print >>sys.stderr, (
                             'Exited with statement; line numbers are %s' 
@@ -161,7 +161,8 @@ elif args.type == 2:
         line = sys.stdin.readline()
 else:
     last_key, totals, write_line \
-        = None, [dlist() for i in xrange(args.value_count)], False
+        = None, [dlist(counter=counter)
+                    for i in xrange(args.value_count)], False
     while True:
         counter.add('type3_inputs')
         if not line:
@@ -192,8 +193,8 @@ else:
             output_line_count += 1
             for a_list in totals:
                 a_list.tear_down()
-            totals, write_line = [dlist() for i in xrange(args.value_count)], \
-                False
+            totals, write_line = [dlist(counter=counter)
+                                    for i in xrange(args.value_count)], False
         if not line: break
         for i in xrange(1, args.value_count+1):
             if tokens[-i] != '\x1c':
@@ -0,0 +1,694 @@
+#!/usr/bin/env python
+"""
+bigwig.py
+Part of Rail-RNA
+
+Writes bigWig files directly from a stream of bedGraph intervals, so no
+bedGraph has to be written to disk and passed to Kent Tools'
+bedGraphToBigWig. Intervals are packed into compressed sections of
+bedGraph items as they arrive, and each zoom level's summaries are built
+on the fly and spilled to a temporary file. When the writer is closed,
+the R-tree indexes are built from the section bounds, the zoom data is
+appended, and the header is filled in.
+
+Layout follows version 4 of the bigWig format (Kent et al., 2010): the
+header, zoom headers, total summary, chromosome B+ tree, full data, full
+data index, and then each zoom level's data and index, ending in the
+magic number. Chromosome IDs are assigned in order of chromosome name, as
+bedGraphToBigWig does, but chromosomes may be written in any order.
+"""
+import zlib
+import struct
+import tempfile
+
+_magic = 0x888FFC26
+_bpt_magic = 0x78CA8C91
+_cir_tree_magic = 0x2468ACE0
+_version = 4
+# Defaults of bedGraphToBigWig
+_block_size = 256
+_items_per_slot = 1024
+# Resolution of the first zoom level; each subsequent level is 4x coarser
+_initial_reduction = 256
+_zoom_increment = 4
+_max_zoom_levels = 10
+# Type code of bedGraph sections
+_bedgraph_type = 1
+
+_header = struct.Struct('<IHHQQQHHQQIQ')
+_zoom_header = struct.Struct('<IIQQ')
+_summary = struct.Struct('<Qdddd')
+_section_header = struct.Struct('<IIIIIBBH')
+_item = struct.Struct('<IIf')
+_zoom_record = struct.Struct('<IIIIffff')
+_node_header = struct.Struct('<BBH')
+_bpt_header = struct.Struct('<IIIIQQ')
+_cir_tree_header = struct.Struct('<IIQIIIIQII')
+_cir_leaf_item = struct.Struct('<IIIIQQ')
+_cir_node_item = struct.Struct('<IIIIQ')
+
+def _write_chrom_tree(stream, chrom_names, chrom_sizes,
+                        block_size=_block_size):
+    """
+    Write B+ tree mapping chromosome names to IDs and sizes.
+
+    @param stream: where to write
+    @param chrom_names: chromosome names sorted so index is chromosome ID
+    @param chrom_sizes: dictionary mapping chromosome names to sizes
+    @param block_size: maximum number of children per node
+    @return: None
+    """
+    item_count = len(chrom_names)
+    block_size = max(min(block_size, item_count), 1)
+    key_size = max([len(chrom_name) for chrom_name in chrom_names] + [1])
+    stream.write(_bpt_header.pack(_bpt_magic, block_size, key_size, 8,
+                                    item_count, 0))
+    level_count, level_items = 1, item_count
+    while level_items > block_size:
+        level_items = (level_items + block_size - 1) // block_size
+        level_count += 1
+    # Child offsets and (chrom ID, size) values are both 8 bytes
+    node_size = _node_header.size + block_size * (key_size + 8)
+    offset = stream.tell()
+    for level in xrange(level_count - 1, 0, -1):
+        slot_size = block_size ** level
+        node_items = slot_size * block_size
+        node_count = (item_count + node_items - 1) // node_items
+        next_child = offset + node_count * node_size
+        for start in xrange(0, item_count, node_items):
+            count = min(block_size,
+                        (item_count - start + slot_size - 1) // slot_size)
+            stream.write(_node_header.pack(0, 0, count))
+            for i in xrange(start, start + count * slot_size, slot_size):
+                stream.write(chrom_names[i].ljust(key_size, '\x00'))
+                stream.write(struct.pack('<Q', next_child))
+                next_child += node_size
+            stream.write('\x00' * ((block_size - count) * (key_size + 8)))
+        offset += node_count * node_size
+    for start in xrange(0, max(item_count, 1), block_size):
+        count = min(block_size, item_count - start)
+        stream.write(_node_header.pack(1, 0, count))
+        for chrom_id in xrange(start, start + count):
+            stream.write(chrom_names[chrom_id].ljust(key_size, '\x00'))
+            stream.write(struct.pack('<II', chrom_id,
+                                        chrom_sizes[chrom_names[chrom_id]]))
+        stream.write('\x00' * ((block_size - count) * (key_size + 8)))
+
+def _write_cir_tree(stream, leaves, end_file_offset,
+                        block_size=_block_size):
+    """
+    Write R-tree index of compressed blocks.
+
+    @param stream: where to write
+    @param leaves: list of tuples (start chromosome ID, start base,
+        end chromosome ID, end base, offset of block in file, size of block
+        in bytes) sorted by start
+    @param end_file_offset: offset in file of the end of the indexed data
+    @param block_size: maximum number of children per node
+    @return: None
+    """
+    if leaves:
+        bounds = leaves[0][:2] + max(leaf[2:4] for leaf in leaves)
+    else:
+        bounds = (0, 0, 0, 0)
+    stream.write(_cir_tree_header.pack(_cir_tree_magic, block_size,
+                                        len(leaves), bounds[0], bounds[1],
+                                        bounds[2], bounds[3],
+                                        end_file_offset, 1, 0))
+    '''levels[0] is a list of leaf items; each subsequent level is a list of
+    the bounds of the nodes of the level before it.'''
+    levels = [leaves]
+    while len(levels[-1]) > block_size:
+        children = levels[-1]
+        levels.append([])
+        for start in xrange(0, len(children), block_size):
+            node = children[start:start + block_size]
+            levels[-1].append(node[0][:2] + max(child[2:4]
+                                                for child in node))
+    node_sizes = [_node_header.size + block_size * _cir_leaf_item.size] + [
+            _node_header.size + block_size * _cir_node_item.size
+        ] * (len(levels) - 1)
+    level_offsets = [0] * len(levels)
+    offset = stream.tell()
+    for level in xrange(len(levels) - 1, -1, -1):
+        level_offsets[level] = offset
+        offset += (max(len(levels[level]) - 1, 0) // block_size + 1) \
+                    * node_sizes[level]
+    for level in xrange(len(levels) - 1, -1, -1):
+        items = levels[level]
+        for start in xrange(0, max(len(items), 1), block_size):
+            node = items[start:start + block_size]
+            stream.write(_node_header.pack(int(level == 0), 0, len(node)))
+            if level:
+                # Item i of this level bounds node i of the level below
+                for i, item in enumerate(node, start):
+                    stream.write(_cir_node_item.pack(*(item + (
+                            level_offsets[level - 1]
+                            + i * node_sizes[level - 1],
+                        ))))
+                stream.write('\x00' * ((block_size - len(node))
+                                            * _cir_node_item.size))
+            else:
+                for item in node:
+                    stream.write(_cir_leaf_item.pack(*item))
+                stream.write('\x00' * ((block_size - len(node))
+                                            * _cir_leaf_item.size))
+
+class ZoomLevel(object):
+    """
+    Summarizes coverage in bins of a fixed size for one zoom level. Bins are
+    aligned to multiples of the reduction, so each bin of a level is
+    contained in a bin of the next coarser level, and summaries cascade
+    from finer to coarser levels. Records are packed into compressed blocks
+    spilled to a temporary file until the bigWig is written.
+    """
+
+    def __init__(self, reduction, coarser=None, temp_dir=None,
+                    items_per_slot=_items_per_slot):
+        """
+        @param reduction: number of bases per bin
+        @param coarser: ZoomLevel to which finished records are passed or
+            None if this is the coarsest level
+        @param temp_dir: where to spill blocks; None for system default
+        @param items_per_slot: maximum number of records per block
+        """
+        self.reduction = reduction
+        self.coarser = coarser
+        self.items_per_slot = items_per_slot
+        self.spill = tempfile.TemporaryFile(dir=temp_dir)
+        # Packed records of the current block and its bounds
+        self.records, self.block_bounds = [], None
+        # Tuples (chrom ID, start, chrom ID, end, spill offset, size)
+        self.leaves = []
+        self.record_count = 0
+        self.max_block_size = 0
+        '''Current bin: [chrom ID, bin end, start, end, valid count, min,
+        max, sum, sum of squares]'''
+        self.bin = None
+
+    def _flush_block(self):
+        """ Compresses current block and spills it. """
+        if not self.records:
+            return
+        block = ''.join(self.records)
+        self.max_block_size = max(self.max_block_size, len(block))
+        compressed = zlib.compress(block)
+        self.leaves.append(self.block_bounds
+                            + (self.spill.tell(), len(compressed)))
+        self.spill.write(compressed)
+        self.records, self.block_bounds = [], None
+
+    def _flush_bin(self):
+        """ Writes current bin as a record and passes it on. """
+        if self.bin is None:
+            return
+        chrom_id, _, start, end, valid, min_val, max_val, sum_data, \
+            sum_squares = self.bin
+        if self.records and self.block_bounds[0] != chrom_id:
+            self._flush_block()
+        self.records.append(_zoom_record.pack(chrom_id, start, end, valid,
+                                                min_val, max_val, sum_data,
+                                                sum_squares))
+        self.record_count += 1
+        if self.block_bounds is None:
+            self.block_bounds = (chrom_id, start, chrom_id, end)
+        else:
+            self.block_bounds = self.block_bounds[:3] + (end,)
+        if len(self.records) >= self.items_per_slot:
+            self._flush_block()
+        if self.coarser is not None:
+            self.coarser.add_summary(chrom_id, start, end, valid, min_val,
+                                        max_val, sum_data, sum_squares)
+        self.bin = None
+
+    def add_summary(self, chrom_id, start, end, valid, min_val, max_val,
+                        sum_data, sum_squares):
+        """
+        Adds summary of a region lying in a single bin of this level.
+
+        @param chrom_id: chromosome ID
+        @param start: start of region, 0-based
+        @param end: end of region, exclusive
+        @param valid: number of bases with data in region
+        @param min_val: minimum value in region
+        @param max_val: maximum value in region
+        @param sum_data: sum of values over bases in region
+        @param sum_squares: sum of squared values over bases in region
+        @return: None
+        """
+        current = self.bin
+        if (current is None or current[0] != chrom_id
+                or start >= current[1]):
+            self._flush_bin()
+            self.bin = [chrom_id,
+                        start - start % self.reduction + self.reduction,
+                        start, end, valid, min_val, max_val, sum_data,
+                        sum_squares]
+            return
+        current[3] = end
+        current[4] += valid
+        if min_val < current[5]: current[5] = min_val
+        if max_val > current[6]: current[6] = max_val
+        current[7] += sum_data
+        current[8] += sum_squares
+
+    def add_value(self, chrom_id, start, end, value):
+        """
+        Adds interval with constant value, splitting it across bins.
+
+        @param chrom_id: chromosome ID
+        @param start: start of interval, 0-based
+        @param end: end of interval, exclusive
+        @param value: value over interval
+        @return: None
+        """
+        reduction = self.reduction
+        while start < end:
+            bin_end = min(start - start % reduction + reduction, end)
+            span = bin_end - start
+            self.add_summary(chrom_id, start, bin_end, span, value, value,
+                                value * span, value * value * span)
+            start = bin_end
+
+    def finish(self):
+        """ Flushes current bin and block at end of data. """
+        self._flush_bin()
+        self._flush_block()
+        if self.coarser is not None:
+            self.coarser.finish()
+
+class BigWigWriter(object):
+    """
+    Writes a bigWig file from bedGraph intervals. Intervals for a given
+    chromosome must be added together, sorted by start, and must not
+    overlap. Use as a context manager or call close() when done.
+    """
+
+    def __init__(self, filename, chrom_sizes, temp_dir=None,
+                    block_size=_block_size, items_per_slot=_items_per_slot,
+                    initial_reduction=_initial_reduction):
+        """
+        @param filename: path of bigWig to write
+        @param chrom_sizes: dictionary mapping chromosome names to sizes
+        @param temp_dir: where to spill zoom data; None for system default
+        @param block_size: maximum number of children per index node
+        @param items_per_slot: maximum number of items per section
+        @param initial_reduction: resolution of first zoom level
+        """
+        self.filename = filename
+        self.chrom_sizes = chrom_sizes
+        self.chrom_names = sorted(chrom_sizes)
+        self.chrom_ids = dict((chrom_name, chrom_id) for chrom_id, chrom_name
+                                in enumerate(self.chrom_names))
+        self.block_size = block_size
+        self.items_per_slot = items_per_slot
+        max_chrom_size = max(chrom_sizes.values() + [1])
+        reductions = [initial_reduction * _zoom_increment ** i
+                        for i in xrange(_max_zoom_levels)]
+        reductions = [reduction for reduction in reductions
+                        if reduction <= max_chrom_size] or reductions[:1]
+        self.zoom_levels = []
+        coarser = None
+        for reduction in reversed(reductions):
+            coarser = ZoomLevel(reduction, coarser=coarser,
+                                temp_dir=temp_dir,
+                                items_per_slot=items_per_slot)
+            self.zoom_levels.append(coarser)
+        self.zoom_levels.reverse()
+        self.stream = open(filename, 'w+b')
+        self.stream.write('\x00' * (_header.size
+                                    + _zoom_header.size
+                                        * len(self.zoom_levels)))
+        self.summary_offset = self.stream.tell()
+        self.stream.write('\x00' * _summary.size)
+        self.chrom_tree_offset = self.stream.tell()
+        _write_chrom_tree(self.stream, self.chrom_names, chrom_sizes,
+                            block_size=block_size)
+        self.data_offset = self.stream.tell()
+        self.stream.write(struct.pack('<Q', 0))
+        # Items of current section, its chromosome ID, start, and end
+        self.items, self.section = [], None
+        # Tuples (chrom ID, start, chrom ID, end, file offset, size)
+        self.leaves = []
+        self.max_block_size = 0
+        # Total summary
+        self.bases_covered, self.sum_data, self.sum_squares = 0, 0.0, 0.0
+        self.min_val, self.max_val = float('inf'), float('-inf')
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.stream.close()
+            for zoom_level in self.zoom_levels:
+                zoom_level.spill.close()
+
+    def _flush_section(self):
+        """ Compresses current section and writes it. """
+        if not self.items:
+            return
+        chrom_id, start, end = self.section
+        block = ''.join([_section_header.pack(chrom_id, start, end, 0, 0,
+                                                _bedgraph_type, 0,
+                                                len(self.items))]
+                            + self.items)
+        self.max_block_size = max(self.max_block_size, len(block))
+        compressed = zlib.compress(block)
+        self.leaves.append((chrom_id, start, chrom_id, end,
+                            self.stream.tell(), len(compressed)))
+        self.stream.write(compressed)
+        self.items, self.section = [], None
+
+    def add(self, chrom_name, start, end, value):
+        """
+        Adds interval with constant value.
+
+        @param chrom_name: chromosome name
+        @param start: start of interval, 0-based
+        @param end: end of interval, exclusive
+        @param value: value over interval
+        @return: None
+        """
+        if end <= start:
+            return
+        chrom_id = self.chrom_ids[chrom_name]
+        if self.section is None:
+            self.section = [chrom_id, start, end]
+        elif self.section[0] != chrom_id:
+            self._flush_section()
+            self.section = [chrom_id, start, end]
+        else:
+            self.section[2] = end
+        self.items.append(_item.pack(start, end, value))
+        if len(self.items) >= self.items_per_slot:
+            self._flush_section()
+        span = end - start
+        self.bases_covered += span
+        self.sum_data += value * span
+        self.sum_squares += value * value * span
+        if value < self.min_val: self.min_val = value
+        if value > self.max_val: self.max_val = value
+        if self.zoom_levels:
+            self.zoom_levels[0].add_value(chrom_id, start, end, value)
+
+    def close(self):
+        """ Writes indexes, zoom levels, and header; closes file. """
+        if self.closed:
+            return
+        self._flush_section()
+        stream = self.stream
+        self.leaves.sort()
+        index_offset = stream.tell()
+        _write_cir_tree(stream, self.leaves, index_offset,
+                            block_size=self.block_size)
+        max_block_size = self.max_block_size
+        zoom_headers = []
+        if self.zoom_levels:
+            self.zoom_levels[0].finish()
+        for zoom_level in self.zoom_levels:
+            max_block_size = max(max_block_size, zoom_level.max_block_size)
+            zoom_data_offset = stream.tell()
+            stream.write(struct.pack('<I', zoom_level.record_count))
+            spill_offset = stream.tell()
+            zoom_level.spill.seek(0)
+            while True:
+                buf = zoom_level.spill.read(1048576)
+                if not buf: break
+                stream.write(buf)
+            zoom_level.spill.close()
+            zoom_index_offset = stream.tell()
+            _write_cir_tree(stream, sorted(
+                                    leaf[:4] + (leaf[4] + spill_offset,
+                                                leaf[5])
+                                    for leaf in zoom_level.leaves
+                                ), zoom_index_offset,
+                            block_size=self.block_size)
+            zoom_headers.append(_zoom_header.pack(zoom_level.reduction, 0,
+                                                    zoom_data_offset,
+                                                    zoom_index_offset))
+        stream.write(struct.pack('<I', _magic))
+        stream.seek(0)
+        stream.write(_header.pack(_magic, _version, len(self.zoom_levels),
+                                    self.chrom_tree_offset, self.data_offset,
+                                    index_offset, 0, 0, 0,
+                                    self.summary_offset, max_block_size, 0))
+        stream.write(''.join(zoom_headers))
+        if self.bases_covered:
+            stream.write(_summary.pack(self.bases_covered, self.min_val,
+                                        self.max_val, self.sum_data,
+                                        self.sum_squares))
+        stream.seek(self.data_offset)
+        stream.write(struct.pack('<Q', len(self.leaves)))
+        stream.close()
+        self.closed = True
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import unittest
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    if '--test' in sys.argv:
+
+        def read_struct(stream, structure, offset=None):
+            """ Unpacks structure at offset, or where stream is. """
+            if offset is not None:
+                stream.seek(offset)
+            return structure.unpack(stream.read(structure.size))
+
+        def read_chrom_tree(stream, offset):
+            """ Returns header and list of (name, ID, size) of B+ tree. """
+            header = read_struct(stream, _bpt_header, offset)
+            key_size = header[2]
+            items = []
+            def read_node(node_offset):
+                is_leaf, _, count = read_struct(stream, _node_header,
+                                                node_offset)
+                children = []
+                for _ in xrange(count):
+                    key = stream.read(key_size).rstrip('\x00')
+                    if is_leaf:
+                        chrom_id, size = struct.unpack('<II', stream.read(8))
+                        items.append((key, chrom_id, size))
+                    else:
+                        children.append(
+                                (key, struct.unpack('<Q', stream.read(8))[0])
+                            )
+                for key, child in children:
+                    first = len(items)
+                    read_node(child)
+                    # Key of a child is the first key under it
+                    assert items[first][0] == key
+            read_node(offset + _bpt_header.size)
+            return header, items
+
+        def read_cir_tree(stream, offset):
+            """ Returns header and list of leaf items of R-tree. """
+            header = read_struct(stream, _cir_tree_header, offset)
+            leaves = []
+            def read_node(node_offset, bounds):
+                is_leaf, _, count = read_struct(stream, _node_header,
+                                                node_offset)
+                if is_leaf:
+                    node_items = [read_struct(stream, _cir_leaf_item)
+                                    for _ in xrange(count)]
+                    leaves.extend(node_items)
+                else:
+                    node_items = [read_struct(stream, _cir_node_item)
+                                    for _ in xrange(count)]
+                for item in node_items:
+                    # A node's bounds contain its children's
+                    assert bounds[:2] <= item[:2]
+                    assert item[2:4] <= bounds[2:4]
+                if not is_leaf:
+                    for item in node_items:
+                        read_node(item[4], item[:4])
+            read_node(offset + _cir_tree_header.size, header[3:7])
+            return header, leaves
+
+        def read_blocks(stream, leaves):
+            """ Returns decompressed blocks indexed by R-tree leaves. """
+            blocks = []
+            for leaf in leaves:
+                stream.seek(leaf[4])
+                blocks.append(zlib.decompress(stream.read(leaf[5])))
+            return blocks
+
+        class TestBigWigWriter(unittest.TestCase):
+
+            def setUp(self):
+                self.temp_dir = mkdtemp()
+                self.bigwig = os.path.join(self.temp_dir, 'test.bw')
+                self.chrom_sizes = {'chr2' : 5000, 'chr10' : 3000,
+                                    'chr1' : 200000, 'chrM' : 100}
+
+            def tearDown(self):
+                rmtree(self.temp_dir)
+
+            def test_multiple_chromosomes(self):
+                # Chromosomes are added out of name order
+                intervals = []
+                for chrom, count, step in [('chr2', 40, 100),
+                                           ('chr10', 7, 400),
+                                           ('chr1', 300, 600)]:
+                    for i in xrange(count):
+                        intervals.append((chrom, i * step + 3,
+                                          i * step + 3 + step // 2 + i % 7,
+                                          float(i % 5 + 1)))
+                with BigWigWriter(self.bigwig, self.chrom_sizes,
+                                    block_size=3, items_per_slot=8,
+                                    initial_reduction=64) as writer:
+                    for interval in intervals:
+                        writer.add(*interval)
+                    # Empty intervals are ignored
+                    writer.add('chr1', 500000, 500000, 9.0)
+                with open(self.bigwig, 'rb') as stream:
+                    header = read_struct(stream, _header, 0)
+                    (magic, version, zoom_level_count, chrom_tree_offset,
+                        data_offset, index_offset, field_count,
+                        defined_field_count, autosql_offset, summary_offset,
+                        uncompress_buf_size, extension_offset) = header
+                    self.assertEqual(magic, _magic)
+                    self.assertEqual(version, _version)
+                    self.assertEqual((field_count, defined_field_count,
+                                      autosql_offset, extension_offset),
+                                     (0, 0, 0, 0))
+                    # 64, 256, 1024, 4096, 16384, and 65536 fit in chr1
+                    self.assertEqual(zoom_level_count, 6)
+                    zoom_headers = [read_struct(stream, _zoom_header)
+                                        for _ in xrange(zoom_level_count)]
+                    self.assertEqual([zoom_header[0] for zoom_header
+                                        in zoom_headers],
+                                     [64 * 4 ** i for i in xrange(6)])
+                    stream.seek(-4, os.SEEK_END)
+                    self.assertEqual(struct.unpack('<I', stream.read(4))[0],
+                                     _magic)
+                    # Total summary
+                    bases_covered = sum(end - start for _, start, end, _
+                                            in intervals)
+                    sum_data = sum((end - start) * value
+                                    for _, start, end, value in intervals)
+                    summary = read_struct(stream, _summary, summary_offset)
+                    self.assertEqual(summary[0], bases_covered)
+                    self.assertEqual(summary[1:3], (1.0, 5.0))
+                    self.assertAlmostEqual(summary[3], sum_data)
+                    # Chromosome IDs are in order of name
+                    bpt_header, chroms = read_chrom_tree(stream,
+                                                         chrom_tree_offset)
+                    self.assertEqual(bpt_header[0], _bpt_magic)
+                    self.assertEqual(bpt_header[1:5], (3, 5, 8, 4))
+                    self.assertEqual(chroms, [('chr1', 0, 200000),
+                                              ('chr10', 1, 3000),
+                                              ('chr2', 2, 5000),
+                                              ('chrM', 3, 100)])
+                    chrom_names = [chrom[0] for chrom in chroms]
+                    # Full data
+                    section_count = read_struct(stream, struct.Struct('<Q'),
+                                                data_offset)[0]
+                    cir_header, leaves = read_cir_tree(stream, index_offset)
+                    self.assertEqual(cir_header[0], _cir_tree_magic)
+                    self.assertEqual(cir_header[2], section_count)
+                    self.assertEqual(len(leaves), section_count)
+                    self.assertEqual(leaves, sorted(leaves))
+                    self.assertEqual(cir_header[3:7],
+                                     (0, intervals[40 + 7][1],
+                                      2, intervals[39][2]))
+                    read_intervals = []
+                    blocks = read_blocks(stream, leaves)
+                    for leaf, block in zip(leaves, blocks):
+                        self.assertTrue(len(block) <= uncompress_buf_size)
+                        (chrom_id, start, end, _, _, item_type, _,
+                            item_count) = _section_header.unpack_from(block)
+                        self.assertEqual(item_type, _bedgraph_type)
+                        self.assertEqual(leaf[:4],
+                                         (chrom_id, start, chrom_id, end))
+                        self.assertTrue(item_count <= 8)
+                        for i in xrange(item_count):
+                            item_start, item_end, value = _item.unpack_from(
+                                    block,
+                                    _section_header.size + i * _item.size
+                                )
+                            self.assertTrue(start <= item_start
+                                            < item_end <= end)
+                            read_intervals.append((chrom_names[chrom_id],
+                                                   item_start, item_end,
+                                                   value))
+                    self.assertEqual(
+                            read_intervals,
+                            sorted(intervals,
+                                   key=lambda interval: (
+                                        chrom_names.index(interval[0]),
+                                        interval[1]
+                                    ))
+                        )
+                    # Each zoom level summarizes all the data
+                    for reduction, _, zoom_data_offset, zoom_index_offset \
+                            in zoom_headers:
+                        record_count = read_struct(stream,
+                                                   struct.Struct('<I'),
+                                                   zoom_data_offset)[0]
+                        _, zoom_leaves = read_cir_tree(stream,
+                                                        zoom_index_offset)
+                        records = []
+                        for block in read_blocks(stream, zoom_leaves):
+                            self.assertEqual(len(block) % _zoom_record.size,
+                                             0)
+                            self.assertTrue(len(block)
+                                                <= uncompress_buf_size)
+                            records.extend(
+                                    _zoom_record.unpack_from(block, offset)
+                                    for offset in xrange(0, len(block),
+                                                         _zoom_record.size)
+                                )
+                        self.assertEqual(len(records), record_count)
+                        for (chrom_id, start, end, valid, min_val, max_val,
+                                _, _) in records:
+                            # Records don't cross bins
+                            self.assertEqual(start // reduction,
+                                             (end - 1) // reduction)
+                            self.assertTrue(valid <= end - start)
+                            self.assertTrue(1.0 <= min_val <= max_val <= 5.0)
+                        self.assertEqual(sum(record[3] for record in records),
+                                         bases_covered)
+                        self.assertAlmostEqual(
+                                sum(record[6] for record in records),
+                                sum_data, places=2
+                            )
+                        self.assertEqual(
+                                set(record[0] for record in records),
+                                set([0, 1, 2])
+                            )
+
+            def test_empty(self):
+                BigWigWriter(self.bigwig, self.chrom_sizes).close()
+                with open(self.bigwig, 'rb') as stream:
+                    header = read_struct(stream, _header, 0)
+                    self.assertEqual(header[0], _magic)
+                    zoom_headers = [read_struct(stream, _zoom_header)
+                                        for _ in xrange(header[2])]
+                    self.assertEqual(read_struct(stream, _summary, header[9]),
+                                     (0, 0.0, 0.0, 0.0, 0.0))
+                    _, chroms = read_chrom_tree(stream, header[3])
+                    self.assertEqual(len(chroms), 4)
+                    stream.seek(header[4])
+                    self.assertEqual(struct.unpack('<Q', stream.read(8))[0],
+                                     0)
+                    cir_header, leaves = read_cir_tree(stream, header[5])
+                    self.assertEqual((cir_header[2], leaves), (0, []))
+                    for _, _, zoom_data_offset, zoom_index_offset \
+                            in zoom_headers:
+                        stream.seek(zoom_data_offset)
+                        self.assertEqual(
+                                struct.unpack('<I', stream.read(4))[0], 0
+                            )
+                        self.assertEqual(
+                                read_cir_tree(stream, zoom_index_offset)[1],
+                                []
+                            )
+
+        unittest.main(argv=[sys.argv[0]])
@@ -1,18 +1,37 @@
 import os
 import struct
 import mmap
+from rail2bit import PackedReference, _cached_blocks
 
 
-class Bowtie2IndexReference(object):
+class Bowtie2IndexReference(PackedReference):
     """
     Given prefix of a Bowtie 2 index, parses the reference names, parses the
     extents of the unambiguous stretches, and memory-maps the file containing
     the unambiguous-stretch sequences.  get_stretch member function can
     retrieve stretches of characters from the reference, even if the stretch
-    contains ambiguous characters.
+    contains ambiguous characters. If a current .rail2bit sidecar of the index
+    exists (see rail2bit.py), everything is loaded from it instead.
     """
 
-    def __init__(self, idx_prefix):
+    def __init__(self, idx_prefix, cached_blocks=_cached_blocks, sidecar=True):
+        PackedReference.__init__(self, cached_blocks)
+        # Index files whose changing invalidates a sidecar
+        self.extensions = [
+                '.%d.%s' % (i, 'bt2' if os.path.exists(idx_prefix + '.3.bt2')
+                                else 'bt2l') for i in [1, 3, 4]
+            ]
+        if not (sidecar and self.load_sidecar(idx_prefix + '.rail2bit',
+                                                idx_prefix)):
+            self.parse_index(idx_prefix)
+        self.lengths = [self.length.get(refname, 0) for refname in self.refnames]
+        self.ref_id_to_offset = {self.refnames[i]: i for i in xrange(len(self.refnames))}
+
+    def parse_index(self, idx_prefix):
+        """
+        Parse reference names and unambiguous stretches from the index files,
+        and memory-map the unambiguous sequence.
+        """
 
         # Open file handles
         if os.path.exists(idx_prefix + '.3.bt2'):
@@ -91,28 +110,27 @@ class Bowtie2IndexReference(object):
         nrecs = struct_unsigned.unpack(fh3.read(sz))[0]
 
         running_unambig_preceding, running_length = 0, 0
-        recs = []
-        starting_offsets = []
-        unambig_preceding, lengths = [], []
+        ref_id, ref_name = 0, None
 
         for i in xrange(nrecs):
             off = struct_unsigned.unpack(fh3.read(sz))[0]
             ln = struct_unsigned.unpack(fh3.read(sz))[0]
             first = ord(fh3.read(1)) != 0
-            recs.append((off, ln, first))
             if first:
-                starting_offsets.append(len(recs)-1)
-                unambig_preceding.append(running_unambig_preceding)
                 if i > 0:
-                    lengths.append(running_length)
+                    self.length[ref_name] = running_length
+                ref_name = refnames[ref_id]
+                ref_id += 1
                 running_length = 0
+            self.add_stretch(ref_name, running_length + off, ln,
+                             running_unambig_preceding)
             running_length += (off + ln)
             running_unambig_preceding += ln
 
-        lengths.append(running_length)
-        starting_offsets.append(len(recs))
+        if ref_name is not None:
+            self.length[ref_name] = running_length
         tot_unambig_len = running_unambig_preceding
-        assert len(recs) == nrecs
+        assert len(self.stretch_starts) == nrecs
 
         #
         # Memory-map the .4.bt2 file
@@ -120,51 +138,8 @@ class Bowtie2IndexReference(object):
         ln_bytes = (tot_unambig_len + 3) // 4
         self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
 
-        # These are per-unambiguous-stretch
-        self.recs = recs
-
         # These are per-reference
-        self.unambig_preceding = unambig_preceding
-        self.lengths = lengths
-        self.starting_offsets = starting_offsets
         self.refnames = refnames
-        self.ref_id_to_offset = {self.refnames[i]: i for i in xrange(len(self.refnames))}
-
-    def get_stretch(self, ref_id, ref_off, count):
-        assert ref_id in self.ref_id_to_offset
-        ref_idx = self.ref_id_to_offset[ref_id]
-        rec_i, rec_f = self.starting_offsets[ref_idx], self.starting_offsets[ref_idx + 1]
-        cur, off = 0, 0
-        buf_off = self.unambig_preceding[ref_idx]
-        stretch = []
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for i in xrange(rec_i, rec_f):
-            off += self.recs[i][0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-            if ref_off < off + self.recs[i][1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
-            else:
-                buf_off += self.recs[i][1]
-            off += self.recs[i][1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append('ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3])
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        while count > 0:
-            count -= 1
-            stretch.append('N')
-        return ''.join(stretch)
 
 
 def which(program):
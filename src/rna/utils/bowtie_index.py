@@ -2,19 +2,59 @@ import os
 import struct
 import mmap
 from operator import itemgetter
-from collections import defaultdict
-from bisect import bisect_right
+from rail2bit import PackedReference, _cached_blocks
 
-class BowtieIndexReference(object):
+class BowtieIndexReference(PackedReference):
     """
     Given prefix of a Bowtie index, parses the reference names, parses the
     extents of the unambiguous stretches, and memory-maps the file containing
     the unambiguous-stretch sequences.  get_stretch member function can
     retrieve stretches of characters from the reference, even if the stretch
-    contains ambiguous characters.
+    contains ambiguous characters. If a current .rail2bit sidecar of the index
+    exists (see rail2bit.py), everything is loaded from it instead.
     """
 
-    def __init__(self, idx_prefix):
+    # Index files whose changing invalidates a sidecar
+    extensions = ['.1.ebwt', '.3.ebwt', '.4.ebwt']
+
+    def __init__(self, idx_prefix, cached_blocks=_cached_blocks, sidecar=True):
+        PackedReference.__init__(self, cached_blocks)
+        if not (sidecar and self.load_sidecar(idx_prefix + '.rail2bit',
+                                                idx_prefix)):
+            self.parse_index(idx_prefix)
+
+        # To facilitate sorting reference names in order of descending length
+        sorted_rnames = sorted(self.length.items(),
+                               key=lambda x: itemgetter(1)(x), reverse=True)
+        '''A case-sensitive sort is also necessary here because new versions of
+        bedGraphToBigWig complain on encountering a nonlexicographic sort
+        order.'''
+        lexicographically_sorted_rnames = sorted(self.length.items(),
+                                                    key=lambda x:
+                                                    itemgetter(0)(x))
+        self.rname_to_string, self.l_rname_to_string = {}, {}
+        self.string_to_rname, self.l_string_to_rname = {}, {}
+        for i, (rname, _) in enumerate(sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.rname_to_string[rname] = rname_string
+            self.string_to_rname[rname_string] = rname
+        for i, (rname, _) in enumerate(lexicographically_sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.l_rname_to_string[rname] = rname_string
+            self.l_string_to_rname[rname_string] = rname
+        # Handle unmapped reads
+        unmapped_string = ('%012d' % len(sorted_rnames))
+        self.rname_to_string['*'] = unmapped_string
+        self.string_to_rname[unmapped_string] = '*'
+
+        # For compatibility
+        self.rname_lengths = self.length
+
+    def parse_index(self, idx_prefix):
+        """
+        Parse reference names and unambiguous stretches from the index files,
+        and memory-map the unambiguous sequence.
+        """
 
         # Open file handles
         if os.path.exists(idx_prefix + '.3.ebwt'):
@@ -89,9 +129,6 @@ class BowtieIndexReference(object):
         nrecs = struct_unsigned.unpack(fh3.read(sz))[0]
 
         running_unambig, running_length = 0, 0
-        self.recs = defaultdict(list)
-        self.offset_in_ref = defaultdict(list)
-        self.unambig_preceding = defaultdict(list)
         length = {}
 
         ref_id, ref_namenrecs_added = 0, None
@@ -106,14 +143,13 @@ class BowtieIndexReference(object):
                 ref_id += 1
                 running_length = 0
             assert ref_name is not None
-            self.recs[ref_name].append((off, ln, first_of_chromosome))
-            self.offset_in_ref[ref_name].append(running_length)
-            self.unambig_preceding[ref_name].append(running_unambig)
+            self.add_stretch(ref_name, running_length + off, ln,
+                             running_unambig)
             running_length += (off + ln)
             running_unambig += ln
 
         length[ref_name] = running_length
-        assert nrecs == sum(map(len, self.recs.itervalues()))
+        assert nrecs == len(self.stretch_starts)
 
         #
         # Memory-map the .4.bt2 file
@@ -125,86 +161,29 @@ class BowtieIndexReference(object):
         self.length = length
         self.refnames = refnames
 
-        # To facilitate sorting reference names in order of descending length
-        sorted_rnames = sorted(self.length.items(),
-                               key=lambda x: itemgetter(1)(x), reverse=True)
-        '''A case-sensitive sort is also necessary here because new versions of
-        bedGraphToBigWig complain on encountering a nonlexicographic sort
-        order.'''
-        lexicographically_sorted_rnames = sorted(self.length.items(),
-                                                    key=lambda x:
-                                                    itemgetter(0)(x))
-        self.rname_to_string, self.l_rname_to_string = {}, {}
-        self.string_to_rname, self.l_string_to_rname = {}, {}
-        for i, (rname, _) in enumerate(sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.rname_to_string[rname] = rname_string
-            self.string_to_rname[rname_string] = rname
-        for i, (rname, _) in enumerate(lexicographically_sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.l_rname_to_string[rname] = rname_string
-            self.l_string_to_rname[rname_string] = rname
-        # Handle unmapped reads
-        unmapped_string = ('%012d' % len(sorted_rnames))
-        self.rname_to_string['*'] = unmapped_string
-        self.string_to_rname[unmapped_string] = '*'
-
-        # For compatibility
-        self.rname_lengths = self.length
 
-    def get_stretch(self, ref_id, ref_off, count):
-        """
-        Return a stretch of characters from the reference, retrieved
-        from the Bowtie index.
+# Maps index prefixes and file modification times to loaded references
+_references = {}
 
-        @param ref_id: name of ref seq, up to & excluding whitespace
-        @param ref_off: offset into reference, 0-based
-        @param count: # of characters
-        @return: string extracted from reference
-        """
-        assert ref_id in self.recs
-        # Account for negative reference offsets by padding with Ns
-        N_count = min(abs(min(ref_off, 0)), count)
-        stretch = ['N'] * N_count
-        count -= N_count
-        if not count: return ''.join(stretch)
-        ref_off = max(ref_off, 0)
-        starting_rec = bisect_right(self.offset_in_ref[ref_id], ref_off) - 1
-        assert starting_rec >= 0
-        off = self.offset_in_ref[ref_id][starting_rec]
-        buf_off = self.unambig_preceding[ref_id][starting_rec]
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for rec in self.recs[ref_id][starting_rec:]:
-            off += rec[0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-            if ref_off < off + rec[1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
-            else:
-                buf_off += rec[1]
-            off += rec[1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append(
-                    'ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3]
-                )
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        # If the requested stretch went past the last unambiguous
-        # character in the chromosome, pad with Ns
-        while count > 0:
-            count -= 1
-            stretch.append('N')
-        return ''.join(stretch)
+def cached_reference(idx_prefix):
+    """
+    Return BowtieIndexReference for the index with the given prefix, parsing
+    the index only the first time it's requested by this process. A worker
+    that runs task after task in one process (see emr_simulator.py's
+    --warm-workers) thus pays for parsing once. The index is reparsed if its
+    files have since changed.
+    """
+    key = (os.path.abspath(idx_prefix),) + tuple(
+            os.path.getmtime(idx_prefix + extension)
+            for extension in BowtieIndexReference.extensions + ['.rail2bit']
+            if os.path.exists(idx_prefix + extension)
+        )
+    if key not in _references:
+        for cached_key in _references.keys():
+            if cached_key[0] == key[0]:
+                del _references[cached_key]
+        _references[key] = BowtieIndexReference(idx_prefix)
+    return _references[key]
 
 
 def which(program):
@@ -309,6 +288,38 @@ CA
                 self.assertEqual(ref.length['short_name2'], 80)
                 self.assertEqual(ref.length['short_name3'], 2)
 
+            def test_block_cache(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                uncached_ref = BowtieIndexReference(self.fa_fn_1,
+                                                    cached_blocks=1)
+                for ref_id in ref.length:
+                    for ref_off in xrange(-5, ref.length[ref_id] + 5, 7):
+                        self.assertEqual(
+                                ref.get_stretch(ref_id, ref_off, 50),
+                                uncached_ref.get_stretch(ref_id, ref_off, 50)
+                            )
+                self.assertEqual('ACGTACGTAC', ref.get_stretch('short_name1', 0, 10))
+                self.assertEqual(len(uncached_ref.blocks), 1)
+
+            def test_sidecar(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                ref.write_sidecar(self.fa_fn_1 + '.rail2bit', self.fa_fn_1,
+                                  ref.extensions)
+                sidecar_ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertEqual(sidecar_ref.length, ref.length)
+                self.assertTrue(sidecar_ref.from_sidecar)
+                for ref_id in ref.length:
+                    for ref_off in xrange(-5, ref.length[ref_id] + 5, 7):
+                        self.assertEqual(
+                                ref.get_stretch(ref_id, ref_off, 50),
+                                sidecar_ref.get_stretch(ref_id, ref_off, 50)
+                            )
+                # A sidecar older than the index is ignored
+                os.utime(self.fa_fn_1 + '.rail2bit', (0, 0))
+                self.assertFalse(
+                        BowtieIndexReference(self.fa_fn_1).from_sidecar
+                    )
+
             def test_off_reference_values(self):
                 ref = BowtieIndexReference(self.fa_fn_1)
                 self.assertEqual('NNNACG', ref.get_stretch('short_name1', -3, 6))
@@ -5,7 +5,6 @@ Part of Rail-RNA
 
 Tools for inferring the properties of samples.
 """
-from itertools import islice
 import math
 import random
 import sys
@@ -17,36 +16,106 @@ Phred64 : (64, 104) . Check out maxes and mins of ord(chars) in
 phred_converter functions below; they are written to guarantee that the ranges
 of quality chars fall within these ranges of valid chars.'''
 
-def inferred_phred_format(fastq_stream, sample_size=10000, verbose=True):
+# Number of bytes read at once when taking a census of a FASTQ
+_census_block_size = 1048576
+
+def _uniform(sampler):
+    """ Draws uniformly from the open interval (0, 1).
+
+        sampler: random.Random object
+
+        Return value: float on (0, 1)
+    """
+    while True:
+        value = sampler.random()
+        if value: return value
+
+def inferred_phred_format(fastq_stream, sample_size=10000, verbose=True,
+                            first_line=None, block_size=_census_block_size):
     """ Studies a selection of reads from a sample to determine Phred format.
 
+        The stream is read in blocks. Lines are counted per block, and a block
+        is split into lines only if one of its quality strings enters the
+        random sample. Once the sample is full, the index of the next quality
+        string to enter it is drawn directly (Li's Algorithm L), so most
+        blocks are never split.
+
         fastq_stream: where to read input fastq lines or None if format is
             provided
         sample_size: number of quality records to sample from file
         verbose: talk about range of quality values found in FASTQ
+        first_line: first line of fastq_stream if it was already read, or
+            None
+        block_size: number of bytes to read at once
 
         Return value: tuple (one of {Sanger, Solexa, Phred64}; assumes Sanger
             if no distinguishing characters are found or if it's a FASTA file,
             number of lines in file)
     """
-    first_line = fastq_stream.readline()
+    if first_line is None:
+        first_line = fastq_stream.readline()
     try:
         if first_line[0] in '>;':
             # It's a FASTA file; return Sanger immediately
             print >>sys.stderr, 'FASTA file encountered. Returning Sanger.'
-            return ('Sanger', sum(1 for line in fastq_stream) + 1)
+            line_count, last_char = 1, '\n'
+            for block in iter(lambda: fastq_stream.read(block_size), ''):
+                line_count += block.count('\n')
+                last_char = block[-1]
+            return ('Sanger', line_count + (last_char != '\n'))
     except IndexError:
         print >>sys.stderr, 'Empty file encountered. Returning Sanger.'
         return ('Sanger', 0)
     # Now assume FASTQ; use first line as seed
-    random.seed(first_line)
+    sampler = random.Random(first_line)
     quals = []
-    # Grab random sample of sample_size quals
-    for i, qual in enumerate(islice(fastq_stream, 2, None, 4)):
-        if len(quals) < sample_size:
-            quals.append(qual.strip())
-        elif random.random() * (i + 1) < sample_size:
-            quals[random.randint(0, sample_size - 1)] = qual.strip()
+    '''Index among lines after the first of the next line to be read, number
+    of quality strings read, and index of the next quality string to enter
+    the sample once it's full'''
+    line_index, qual_count, next_pick = 0, 0, None
+    carry = ''
+    while True:
+        block = fastq_stream.read(block_size)
+        data = carry + block
+        if block:
+            last_newline = data.rfind('\n')
+            if last_newline == -1:
+                carry = data
+                continue
+            # Complete lines, without the trailing newline
+            lines, carry = data[:last_newline], data[last_newline+1:]
+        elif data:
+            # Last line has no trailing newline
+            lines, carry = data, ''
+        else:
+            break
+        line_count = lines.count('\n') + 1
+        first_qual = (2 - line_index) % 4
+        block_qual_count = max((line_count - first_qual + 3) // 4, 0)
+        if block_qual_count and (len(quals) < sample_size
+                                  or next_pick < qual_count
+                                                  + block_qual_count):
+            block_quals = lines.split('\n')[first_qual::4]
+            if len(quals) < sample_size:
+                quals.extend(qual.strip() for qual
+                                in block_quals[:sample_size - len(quals)])
+                if len(quals) == sample_size:
+                    weight = math.exp(math.log(_uniform(sampler))
+                                        / sample_size)
+                    next_pick = sample_size + int(
+                            math.log(_uniform(sampler))
+                            / math.log(1 - weight)
+                        )
+            while next_pick is not None \
+                    and next_pick < qual_count + block_qual_count:
+                quals[sampler.randint(0, sample_size - 1)] = \
+                    block_quals[next_pick - qual_count].strip()
+                weight *= math.exp(math.log(_uniform(sampler))
+                                    / sample_size)
+                next_pick += int(math.log(_uniform(sampler))
+                                    / math.log(1 - weight)) + 1
+        line_index += line_count
+        qual_count += block_qual_count
     # Get range of quality scores
     quals = [ord(char) for char in set(''.join(quals))]
     try:
@@ -64,19 +133,19 @@ def inferred_phred_format(fastq_stream, sample_size=10000, verbose=True):
     if qual_range[0] >= 64:
         # Don't even check max; choose Phred64 and round down as necessary
         print >>sys.stderr, message % 'Phred64'
-        return ('Phred64', (i + 1) * 4)
+        return ('Phred64', qual_count * 4)
     if qual_range[0] < 59:
         '''Now we're choosing between Sanger and Solexa, and this means there
         are Sanger-unique characters.'''
         print >>sys.stderr, message % 'Sanger'
-        return ('Sanger', (i + 1) * 4)
+        return ('Sanger', qual_count * 4)
     # Min qual is now on [59, 63]; could still be either Sanger or Solexa
     if qual_range[1] >= 94:
         print >>sys.stderr, message % 'Solexa'
-        return ('Solexa', (i + 1) * 4)
+        return ('Solexa', qual_count * 4)
     # Default to Sanger
     print >>sys.stderr, message % 'Sanger'
-    return ('Sanger', (i + 1) * 4)
+    return ('Sanger', qual_count * 4)
 
 def phred_converter(fastq_stream=None, phred_format=None, sample_size=10000):
     """ Provides a function that converts a quality string to Sanger format
@@ -103,20 +172,21 @@ def phred_converter(fastq_stream=None, phred_format=None, sample_size=10000):
         phred_format = inferred_phred_format(fastq_stream,
                                                 sample_size=sample_size)[0]
     if phred_format == 'Solexa':
-       def final_converter(qual):
-           return ''.join([
-                               chr(int(round(
-                           10*math.log(1+10**((min(max(ord(char), 59), 104)-64)
-                            /10.0),10)
-                   )+33)) for char in qual
-                ])
+        def converted_char(char):
+            return chr(int(round(
+                    10*math.log(1+10**((min(max(ord(char), 59), 104)-64)
+                        /10.0),10)
+                )+33))
     elif phred_format == 'Sanger':
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 33), 93)) for char in qual)
+        def converted_char(char):
+            return chr(min(max(ord(char), 33), 93))
     else:
         assert phred_format == 'Phred64'
         # It's Phred64
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 64), 104) - 31)
-                                for char in qual)
+        def converted_char(char):
+            return chr(min(max(ord(char), 64), 104) - 31)
+    # Conversion is per character, so it's precomputed for every byte
+    translation_table = ''.join(converted_char(chr(i)) for i in xrange(256))
+    def final_converter(qual):
+        return qual.translate(translation_table)
     return final_converter
\ No newline at end of file
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+index_prep.py
+Part of Rail-RNA
+
+Prepares a Bowtie index for Rail-RNA by writing the sidecars that make
+steps faster: a .rail2bit copy of the reference (see rail2bit.py), from
+which steps load the reference with a single mmap, and a .motifs index of
+splice-site dinucleotides (see motif_index.py) used by junction_search.py.
+Run it once per index with
+
+python index_prep.py <index basename>
+
+Both sidecars are written next to the index and are optional; without
+them, steps parse the index and scan for motifs as before. A .motifs file
+for a human genome is about 2 GB and takes much longer to build without
+NumPy. Sidecars that are current are left alone unless --force is given.
+"""
+import os
+import sys
+import argparse
+
+def prepare_index(idx_prefix, motifs=True, force=False):
+    """
+    Write the sidecars of an index that are missing or stale.
+
+    @param idx_prefix: basename of Bowtie or Bowtie 2 index
+    @param motifs: True iff the .motifs index should be written
+    @param force: True iff sidecars should be written even if current
+    @return: list of paths of sidecars written
+    """
+    from rail2bit import sidecar_current
+    from motif_index import motif_index_current, write_motif_index
+    if os.path.exists(idx_prefix + '.3.ebwt'):
+        from bowtie_index import BowtieIndexReference as IndexReference
+    else:
+        from bowtie2_index import Bowtie2IndexReference as IndexReference
+    written = []
+    sidecar = idx_prefix + '.rail2bit'
+    if force or not sidecar_current(sidecar, idx_prefix):
+        reference = IndexReference(idx_prefix, sidecar=False)
+        reference.write_sidecar(sidecar, idx_prefix, reference.extensions)
+        written.append(sidecar)
+    motif_sidecar = idx_prefix + '.motifs'
+    if motifs and (force or not motif_index_current(motif_sidecar,
+                                                    idx_prefix)):
+        # Load from the sidecar just written, which is fastest
+        write_motif_index(IndexReference(idx_prefix), motif_sidecar,
+                            idx_prefix)
+        written.append(motif_sidecar)
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('idx_prefix', metavar='<index basename>', type=str,
+                        help='basename of Bowtie or Bowtie 2 index')
+    parser.add_argument('--no-motifs', action='store_const', const=True,
+                        default=False,
+                        help='skips writing the .motifs index')
+    parser.add_argument('-f', '--force', action='store_const', const=True,
+                        default=False,
+                        help='rewrites sidecars even if they\'re current')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    try:
+        written = prepare_index(args.idx_prefix, motifs=not args.no_motifs,
+                                force=args.force)
+    except (IOError, OSError, RuntimeError) as e:
+        print >>sys.stderr, ('Error preparing index %s: %s'
+                                % (args.idx_prefix, e))
+        sys.exit(1)
+    for sidecar in written:
+        print >>sys.stderr, 'Wrote %s.' % sidecar
+    if not written:
+        print >>sys.stderr, ('Sidecars of %s are current; nothing to do.'
+                                % args.idx_prefix)
@@ -6,6 +6,8 @@ Contains some helpful tools for parsing the file manifest, which lists the
 locations of files containing raw reads and their corresponding sample names.
 """
 
+import os
+
 def add_args(parser):
     parser.add_argument(\
         '--manifest', metavar='PATH', type=str, required=False,
@@ -27,4 +29,23 @@ class LabelsAndIndices(object):
                 index_string = str(i)
                 self.label_to_index[tokens[-1]] = index_string
                 self.index_to_label[index_string] = tokens[-1]
-                i += 1
\ No newline at end of file
+                i += 1
+
+# Maps manifest files and their modification times to parsed manifests
+_manifests = {}
+
+def cached_labels_and_indices(manifest_file):
+    """ Gets LabelsAndIndices object for manifest file, parsing it only once
+        per process unless it changes.
+
+        manifest_file: path to manifest file
+
+        Return value: LabelsAndIndices object
+    """
+    key = (os.path.abspath(manifest_file), os.path.getmtime(manifest_file))
+    if key not in _manifests:
+        for cached_key in _manifests.keys():
+            if cached_key[0] == key[0]:
+                del _manifests[cached_key]
+        _manifests[key] = LabelsAndIndices(manifest_file)
+    return _manifests[key]
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+motif_index.py
+Part of Rail-RNA
+
+Reads and writes .motifs files, which record where the dinucleotides that
+flank introns (GT, GC, AT, AG, AC, and CT) start in a reference. There's a
+bitset per reference and dinucleotide with a 1 at every position where the
+dinucleotide starts, so the motifs in a window are found by reading a few
+bytes rather than by decoding the window and scanning it.
+
+Build the index once per Bowtie or Bowtie 2 index with
+
+python motif_index.py <index basename>
+
+It's written to <index basename>.motifs, where junction_search.py looks for
+it. It's ignored if the index files it was built from have since changed.
+Building it is much faster with NumPy installed.
+
+Format: the magic string "RAILMOTF" and a JSON header as in rail2bit.py,
+followed by, for each reference in the header, a bitset per dinucleotide in
+the header's order. A reference's bitsets each have (length + 7) / 8 bytes,
+and the first position covered by a byte is its most significant bit.
+"""
+import os
+import sys
+import re
+import mmap
+import struct
+from rail2bit import write_header, read_header, index_sources, \
+    sources_unchanged
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_magic = 'RAILMOTF'
+_version = 1
+# Dinucleotides that start or end introns on either strand
+_dinucleotides = ['AC', 'AG', 'AT', 'CT', 'GC', 'GT']
+# Number of bases decoded at once when building an index; multiple of 8
+_chunk_size = 1 << 22
+# Maps each byte of a bitset to the positions of its 1s
+_set_bits = [[bit for bit in xrange(8) if byte & (0x80 >> bit)]
+                for byte in xrange(256)]
+
+def dinucleotide_bitsets(seq, size, dinucleotides=_dinucleotides):
+    """
+    Find where dinucleotides start in a sequence.
+
+    @param seq: sequence; may extend a base past size so dinucleotides
+        starting at the last position are found
+    @param size: number of positions to consider
+    @param dinucleotides: list of dinucleotides to find
+    @return: list of bitsets (strings) of (size + 7) / 8 bytes, one per
+        dinucleotide in the order of dinucleotides
+    """
+    bitsets = []
+    if np is not None:
+        bases = np.frombuffer(seq, dtype=np.uint8)
+        for dinucleotide in dinucleotides:
+            starts = np.zeros(size, dtype=np.bool_)
+            matches = ((bases[:-1] == ord(dinucleotide[0]))
+                        & (bases[1:] == ord(dinucleotide[1])))[:size]
+            starts[:len(matches)] = matches
+            bitsets.append(np.packbits(starts).tostring())
+        return bitsets
+    for dinucleotide in dinucleotides:
+        bitset = bytearray((size + 7) >> 3)
+        for match in re.finditer('(?=%s)' % dinucleotide, seq):
+            position = match.start()
+            if position < size:
+                bitset[position >> 3] |= 0x80 >> (position & 7)
+        bitsets.append(str(bitset))
+    return bitsets
+
+def write_motif_index(reference, sidecar, idx_prefix,
+                        dinucleotides=_dinucleotides):
+    """
+    Write motif index of a reference.
+
+    @param reference: BowtieIndexReference or Bowtie2IndexReference
+    @param sidecar: path to .motifs file
+    @param idx_prefix: prefix of the index the reference was loaded from
+    @param dinucleotides: list of dinucleotides to index
+    """
+    ref_names = [ref_name for ref_name in reference.refnames
+                    if ref_name in reference.length]
+    header = {
+            'version' : _version,
+            'sources' : index_sources(idx_prefix, reference.extensions),
+            'dinucleotides' : dinucleotides,
+            'references' : [[ref_name, reference.length[ref_name]]
+                                for ref_name in ref_names]
+        }
+    # Write elsewhere first so a half-written index is never read
+    temp_sidecar = sidecar + '.%d.tmp' % os.getpid()
+    try:
+        with open(temp_sidecar, 'wb') as sidecar_stream:
+            write_header(sidecar_stream, _magic, header)
+            for ref_name in ref_names:
+                length = reference.length[ref_name]
+                bitset_size = (length + 7) >> 3
+                bitsets_offset = sidecar_stream.tell()
+                for chunk_start in xrange(0, length, _chunk_size):
+                    size = min(_chunk_size, length - chunk_start)
+                    # Take an extra base for dinucleotides ending in next chunk
+                    seq = reference.get_stretch(ref_name, chunk_start,
+                                                min(size + 1,
+                                                    length - chunk_start))
+                    for i, bitset in enumerate(
+                            dinucleotide_bitsets(seq, size, dinucleotides)
+                        ):
+                        sidecar_stream.seek(bitsets_offset + i * bitset_size
+                                                + (chunk_start >> 3))
+                        sidecar_stream.write(bitset)
+                sidecar_stream.seek(bitsets_offset
+                                        + len(dinucleotides) * bitset_size)
+        os.rename(temp_sidecar, sidecar)
+    finally:
+        if os.path.exists(temp_sidecar):
+            os.remove(temp_sidecar)
+
+def motif_index_current(sidecar, idx_prefix):
+    """
+    Check whether a .motifs file exists and matches its index without
+    loading it.
+
+    @param sidecar: path to .motifs file
+    @param idx_prefix: prefix of the index the motif index should match
+    @return: True iff MotifIndex.load() would load sidecar
+    """
+    try:
+        with open(sidecar, 'rb') as sidecar_stream:
+            header_and_offset = read_header(sidecar_stream, _magic)
+    except (IOError, OSError, ValueError, struct.error):
+        return False
+    if header_and_offset is None:
+        return False
+    header = header_and_offset[0]
+    try:
+        return (header['version'] == _version
+                and sources_unchanged(idx_prefix, header['sources'], sidecar))
+    except (OSError, KeyError):
+        return False
+
+class MotifIndex(object):
+    """
+    Finds dinucleotides of splice-site motifs in reference windows using
+    a memory-mapped .motifs file.
+    """
+
+    def __init__(self):
+        # Maps dinucleotides to the index of their bitsets per reference
+        self.dinucleotides = {}
+        # Maps reference names to (offset of first bitset, bitset size)
+        self.bitsets = {}
+        self.length = {}
+        self.mm = None
+
+    def load(self, sidecar, idx_prefix):
+        """
+        Load motif index if it's current.
+
+        @param sidecar: path to .motifs file
+        @param idx_prefix: prefix of the index the motif index should match
+        @return: True iff motif index was loaded
+        """
+        try:
+            with open(sidecar, 'rb') as sidecar_stream:
+                header_and_offset = read_header(sidecar_stream, _magic)
+                if header_and_offset is None:
+                    return False
+                header, offset = header_and_offset
+                if (header['version'] != _version
+                        or not sources_unchanged(idx_prefix,
+                                                 header['sources'], sidecar)):
+                    return False
+                self.mm = mmap.mmap(sidecar_stream.fileno(), 0,
+                                    flags=mmap.MAP_SHARED,
+                                    prot=mmap.PROT_READ)
+        except (IOError, OSError, ValueError, KeyError, struct.error):
+            return False
+        self.dinucleotides = dict((dinucleotide, i) for i, dinucleotide
+                                    in enumerate(header['dinucleotides']))
+        for ref_name, length in header['references']:
+            bitset_size = (length + 7) >> 3
+            self.length[ref_name] = length
+            self.bitsets[ref_name] = (offset, bitset_size)
+            offset += len(self.dinucleotides) * bitset_size
+        return True
+
+    def positions(self, ref_name, dinucleotide, start, end):
+        """
+        Find where a dinucleotide starts in a stretch of reference.
+
+        @param ref_name: name of ref seq
+        @param dinucleotide: dinucleotide to find
+        @param start: start of stretch, 0-based
+        @param end: end of stretch, 0-based and exclusive
+        @return: sorted list of 0-based positions in [start, end) where
+            dinucleotide starts
+        """
+        start, end = max(start, 0), min(end, self.length[ref_name])
+        if start >= end:
+            return []
+        offset, bitset_size = self.bitsets[ref_name]
+        offset += self.dinucleotides[dinucleotide] * bitset_size
+        first_byte = start >> 3
+        positions = []
+        for byte_index, byte in enumerate(
+                    bytearray(self.mm[offset + first_byte:
+                                        offset + ((end - 1) >> 3) + 1]),
+                    first_byte
+                ):
+            for bit in _set_bits[byte]:
+                position = (byte_index << 3) + bit
+                if start <= position < end:
+                    positions.append(position)
+        return positions
+
+    def motifs_in_window(self, ref_name, ref_off, count, dinucleotides):
+        """
+        Find dinucleotides lying entirely in a window of reference.
+
+        Equivalent to scanning get_stretch(ref_name, ref_off, count) two
+        characters at a time for members of dinucleotides.
+
+        @param ref_name: name of ref seq
+        @param ref_off: offset of window into reference, 0-based
+        @param count: # of characters in window
+        @param dinucleotides: iterable of dinucleotides to find
+        @return: tuple (offsets into window, dinucleotides at those offsets),
+            with offsets in ascending order
+        """
+        start = max(ref_off, 0)
+        end = min(ref_off + count - 1, self.length[ref_name])
+        if start >= end:
+            return [], []
+        offset, bitset_size = self.bitsets[ref_name]
+        first_byte, last_byte = start >> 3, ((end - 1) >> 3) + 1
+        found = []
+        for dinucleotide in dinucleotides:
+            bitset_offset = (offset
+                                + self.dinucleotides[dinucleotide] * bitset_size)
+            window_offset = (first_byte << 3) - ref_off
+            for byte in bytearray(self.mm[bitset_offset + first_byte:
+                                            bitset_offset + last_byte]):
+                for bit in _set_bits[byte]:
+                    found.append((window_offset + bit, dinucleotide))
+                window_offset += 8
+        low, high = start - ref_off, end - ref_off
+        found = sorted([hit for hit in found if low <= hit[0] < high])
+        return [offset for offset, _ in found], [
+                    dinucleotide for _, dinucleotide in found
+                ]
+
+# Maps paths to motif indexes and modification times to loaded indexes
+_motif_indexes = {}
+
+def cached_motif_index(idx_prefix):
+    """
+    Return MotifIndex for the index with the given prefix, loading it only
+    the first time it's requested by this process.
+
+    @param idx_prefix: prefix of index
+    @return: MotifIndex, or None if there's no current motif index
+    """
+    sidecar = idx_prefix + '.motifs'
+    try:
+        key = (os.path.abspath(sidecar), os.path.getmtime(sidecar))
+    except OSError:
+        return None
+    if key not in _motif_indexes:
+        for cached_key in _motif_indexes.keys():
+            if cached_key[0] == key[0]:
+                del _motif_indexes[cached_key]
+        motif_index = MotifIndex()
+        _motif_indexes[key] = (motif_index
+                                if motif_index.load(sidecar, idx_prefix)
+                                else None)
+    return _motif_indexes[key]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('idx_prefix', metavar='<index basename>', type=str,
+                        help='basename of Bowtie or Bowtie 2 index')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    if os.path.exists(args.idx_prefix + '.3.ebwt'):
+        from bowtie_index import BowtieIndexReference as IndexReference
+    else:
+        from bowtie2_index import Bowtie2IndexReference as IndexReference
+    reference = IndexReference(args.idx_prefix)
+    write_motif_index(reference, args.idx_prefix + '.motifs',
+                        args.idx_prefix)
+    print >>sys.stderr, 'Wrote %s.motifs.' % args.idx_prefix
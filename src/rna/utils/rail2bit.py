@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+rail2bit.py
+Part of Rail-RNA
+
+Reads and writes .rail2bit files, compact sidecars of Bowtie and Bowtie 2
+indexes. A sidecar stores a reference's names, lengths, and unambiguous
+stretches as arrays along with its 2-bit packed sequence, so a reference is
+loaded with a single mmap rather than by walking the index record by record.
+
+Build a sidecar once per index with
+
+python rail2bit.py <index basename>
+
+It's written to <index basename>.rail2bit, where BowtieIndexReference and
+Bowtie2IndexReference look for it. A sidecar is ignored if the index files
+it was built from have since changed.
+
+Format: the magic string "RAIL2BIT"; the size of a JSON header as an 8-byte
+little-endian unsigned integer; the JSON header, padded with spaces to a
+multiple of 8 bytes; arrays of the reference positions at which unambiguous
+stretches start, their lengths, and their offsets in the packed sequence;
+and the packed sequence, 4 bases per byte as in .4.ebwt and .4.bt2 files.
+"""
+import os
+import sys
+import mmap
+import json
+import struct
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+_magic = 'RAIL2BIT'
+_version = 1
+# Type code of stretch arrays; 64-bit on 64-bit platforms
+_typecode = 'L'
+# Maps each byte of a packed sequence to the four bases it packs, in order
+_byte_to_bases = [''.join('ACGT'[(byte >> shift) & 3]
+                            for shift in xrange(0, 8, 2))
+                  for byte in xrange(256)]
+# Number of bases in each block of unambiguous sequence decoded at once
+_block_size = 4096
+# Default number of decoded blocks a reference keeps
+_cached_blocks = 1024
+
+def write_header(sidecar_stream, magic, header):
+    """
+    Write magic string and JSON header of a sidecar, padding the header so
+    whatever follows it is 8-byte aligned.
+
+    @param sidecar_stream: where to write
+    @param magic: 8-character magic string identifying the kind of sidecar
+    @param header: JSON-serializable object
+    """
+    header = json.dumps(header)
+    header += ' ' * (-(len(magic) + 8 + len(header)) % 8)
+    sidecar_stream.write(magic)
+    sidecar_stream.write(struct.pack('<Q', len(header)))
+    sidecar_stream.write(header)
+
+def read_header(sidecar_stream, magic):
+    """
+    Read header written by write_header().
+
+    @param sidecar_stream: where to read
+    @param magic: magic string the sidecar should start with
+    @return: tuple (header, offset of the byte after the header) or None if
+        the magic string doesn't match
+    """
+    if sidecar_stream.read(len(magic)) != magic:
+        return None
+    header_size = struct.unpack('<Q', sidecar_stream.read(8))[0]
+    return (json.loads(sidecar_stream.read(header_size)),
+                len(magic) + 8 + header_size)
+
+def index_sources(idx_prefix, extensions):
+    """
+    Record sizes of the index files a sidecar is built from.
+
+    @param idx_prefix: prefix of index
+    @param extensions: extensions of index files
+    @return: list of [extension, size in bytes]
+    """
+    return [[extension, os.path.getsize(idx_prefix + extension)]
+                for extension in extensions]
+
+def sources_unchanged(idx_prefix, sources, sidecar):
+    """
+    Check that index files haven't changed since a sidecar was built.
+
+    @param idx_prefix: prefix of index
+    @param sources: list of [extension, size in bytes] from index_sources()
+    @param sidecar: path to sidecar
+    @return: True iff each index file has the recorded size and is no newer
+        than the sidecar
+    """
+    sidecar_mtime = os.path.getmtime(sidecar)
+    for extension, size in sources:
+        if (os.path.getsize(idx_prefix + extension) != size
+                or os.path.getmtime(idx_prefix + extension) > sidecar_mtime):
+            return False
+    return True
+
+def sidecar_current(sidecar, idx_prefix):
+    """
+    Check whether a .rail2bit sidecar exists and matches its index without
+    loading it.
+
+    @param sidecar: path to .rail2bit file
+    @param idx_prefix: prefix of the index the sidecar should match
+    @return: True iff PackedReference.load_sidecar() would load sidecar
+    """
+    try:
+        with open(sidecar, 'rb') as sidecar_stream:
+            header_and_offset = read_header(sidecar_stream, _magic)
+    except (IOError, OSError, ValueError, struct.error):
+        return False
+    if header_and_offset is None:
+        return False
+    header = header_and_offset[0]
+    try:
+        return (header['version'] == _version
+                and header['typecode'] == _typecode
+                and header['itemsize'] == array(_typecode).itemsize
+                and sources_unchanged(idx_prefix, header['sources'], sidecar))
+    except (OSError, KeyError):
+        return False
+
+class PackedReference(object):
+    """
+    Reference made up of unambiguous stretches of 2-bit packed sequence
+    separated by runs of Ns. Subclasses fill in the stretches, either from
+    an index with add_stretch() or from a sidecar with load_sidecar(), and
+    get_stretch() retrieves characters from either with a binary search for
+    the first stretch and a slice of decoded sequence per stretch.
+    """
+
+    def __init__(self, cached_blocks=_cached_blocks):
+        # Parallel arrays with an item per unambiguous stretch
+        self.stretch_starts = array(_typecode)
+        self.stretch_lengths = array(_typecode)
+        self.stretch_offsets = array(_typecode)
+        # Maps reference names to slices of stretch arrays
+        self.stretch_ranges = {}
+        # Maps reference names to lengths
+        self.length = {}
+        self.refnames = []
+        # Packed sequence and where it starts in fh4mm
+        self.fh4mm, self.seq_offset = None, 0
+        self.from_sidecar = False
+        # Recently decoded blocks, least recently used first
+        self.blocks = OrderedDict()
+        self.cached_blocks = cached_blocks
+
+    def add_stretch(self, ref_name, start, length, offset):
+        """
+        Append an unambiguous stretch to a reference. Stretches must be
+        added in order, reference by reference.
+
+        @param ref_name: name of ref seq
+        @param start: offset of stretch into reference, 0-based
+        @param length: # of characters in stretch
+        @param offset: offset of stretch into packed sequence
+        """
+        stretch_index = len(self.stretch_starts)
+        first, _ = self.stretch_ranges.get(ref_name,
+                                            (stretch_index, stretch_index))
+        self.stretch_ranges[ref_name] = (first, stretch_index + 1)
+        self.stretch_starts.append(start)
+        self.stretch_lengths.append(length)
+        self.stretch_offsets.append(offset)
+
+    def load_sidecar(self, sidecar, idx_prefix):
+        """
+        Load reference from a sidecar if it's current.
+
+        @param sidecar: path to .rail2bit file
+        @param idx_prefix: prefix of the index the sidecar should match
+        @return: True iff reference was loaded from sidecar
+        """
+        try:
+            with open(sidecar, 'rb') as sidecar_stream:
+                header_and_offset = read_header(sidecar_stream, _magic)
+                if header_and_offset is None:
+                    return False
+                header, offset = header_and_offset
+                if (header['version'] != _version
+                        or header['typecode'] != _typecode
+                        or header['itemsize'] != array(_typecode).itemsize
+                        or not sources_unchanged(idx_prefix,
+                                                 header['sources'], sidecar)):
+                    return False
+                fh4mm = mmap.mmap(sidecar_stream.fileno(), 0,
+                                    flags=mmap.MAP_SHARED,
+                                    prot=mmap.PROT_READ)
+        except (IOError, OSError, ValueError, KeyError, struct.error):
+            return False
+        array_size = header['stretch_count'] * array(_typecode).itemsize
+        for stretch_array in [self.stretch_starts, self.stretch_lengths,
+                              self.stretch_offsets]:
+            stretch_array.fromstring(fh4mm[offset:offset + array_size])
+            offset += array_size
+        self.refnames = header['refnames']
+        for ref_name, length, first, last in header['references']:
+            self.length[ref_name] = length
+            self.stretch_ranges[ref_name] = (first, last)
+        self.fh4mm, self.seq_offset = fh4mm, offset
+        self.from_sidecar = True
+        return True
+
+    def write_sidecar(self, sidecar, idx_prefix, extensions):
+        """
+        Write reference to a sidecar.
+
+        @param sidecar: path to .rail2bit file
+        @param idx_prefix: prefix of the index the reference was loaded from
+        @param extensions: extensions of index files whose changing should
+            invalidate the sidecar
+        """
+        header = {
+                'version' : _version,
+                'typecode' : _typecode,
+                'itemsize' : array(_typecode).itemsize,
+                'sources' : index_sources(idx_prefix, extensions),
+                'refnames' : self.refnames,
+                'references' : [[ref_name, self.length[ref_name]]
+                                    + list(self.stretch_ranges[ref_name])
+                                    for ref_name in self.refnames
+                                    if ref_name in self.stretch_ranges],
+                'stretch_count' : len(self.stretch_starts)
+            }
+        packed_size = ((self.stretch_offsets[-1] + self.stretch_lengths[-1]
+                            + 3) // 4) if self.stretch_offsets else 0
+        # Write elsewhere first so a half-written sidecar is never read
+        temp_sidecar = sidecar + '.%d.tmp' % os.getpid()
+        try:
+            with open(temp_sidecar, 'wb') as sidecar_stream:
+                write_header(sidecar_stream, _magic, header)
+                for stretch_array in [self.stretch_starts,
+                                      self.stretch_lengths,
+                                      self.stretch_offsets]:
+                    stretch_array.tofile(sidecar_stream)
+                for byte_off in xrange(0, packed_size, 1 << 24):
+                    sidecar_stream.write(self.fh4mm[
+                            self.seq_offset + byte_off:self.seq_offset
+                            + min(byte_off + (1 << 24), packed_size)
+                        ])
+            os.rename(temp_sidecar, sidecar)
+        finally:
+            if os.path.exists(temp_sidecar):
+                os.remove(temp_sidecar)
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """
+        Return a stretch of characters from the reference, retrieved
+        from the Bowtie index.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param ref_off: offset into reference, 0-based
+        @param count: # of characters
+        @return: string extracted from reference
+        """
+        assert ref_id in self.stretch_ranges
+        # Account for negative reference offsets by padding with Ns
+        N_count = min(abs(min(ref_off, 0)), count)
+        stretch = ['N' * N_count]
+        count -= N_count
+        if not count: return ''.join(stretch)
+        ref_off = max(ref_off, 0)
+        first, last = self.stretch_ranges[ref_id]
+        i = max(bisect_right(self.stretch_starts, ref_off, first, last) - 1,
+                first)
+        while count > 0 and i < last:
+            start = self.stretch_starts[i]
+            if ref_off < start:
+                # Ns before the unambiguous stretch
+                N_count = min(start - ref_off, count)
+                stretch.append('N' * N_count)
+                count -= N_count
+                ref_off += N_count
+            end = start + self.stretch_lengths[i]
+            if count > 0 and ref_off < end:
+                base_count = min(end - ref_off, count)
+                stretch.append(self.get_unambiguous(
+                        self.stretch_offsets[i] + ref_off - start, base_count
+                    ))
+                count -= base_count
+                ref_off += base_count
+            i += 1
+        # If the requested stretch went past the last unambiguous
+        # character in the chromosome, pad with Ns
+        stretch.append('N' * count)
+        return ''.join(stretch)
+
+    def get_unambiguous(self, buf_off, count):
+        """
+        Return a stretch of the concatenated unambiguous sequence. It's
+        decoded a block at a time through a lookup table, and the most
+        recently used blocks are kept, since nearby reads keep asking for the
+        same loci.
+
+        @param buf_off: offset into concatenated unambiguous sequence
+        @param count: # of characters
+        @return: string extracted from unambiguous sequence
+        """
+        pieces = []
+        while count > 0:
+            block, block_off = divmod(buf_off, _block_size)
+            try:
+                decoded = self.blocks.pop(block)
+            except KeyError:
+                byte_off = self.seq_offset + block * (_block_size >> 2)
+                decoded = ''.join([_byte_to_bases[byte] for byte in bytearray(
+                        self.fh4mm[byte_off:byte_off + (_block_size >> 2)]
+                    )])
+                if len(self.blocks) >= self.cached_blocks:
+                    self.blocks.popitem(last=False)
+            self.blocks[block] = decoded
+            piece = decoded[block_off:block_off + count]
+            assert piece
+            pieces.append(piece)
+            buf_off += len(piece)
+            count -= len(piece)
+        return ''.join(pieces)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('idx_prefix', metavar='<index basename>', type=str,
+                        help='basename of Bowtie or Bowtie 2 index')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    if os.path.exists(args.idx_prefix + '.3.ebwt'):
+        from bowtie_index import BowtieIndexReference as IndexReference
+    else:
+        from bowtie2_index import Bowtie2IndexReference as IndexReference
+    reference = IndexReference(args.idx_prefix, sidecar=False)
+    reference.write_sidecar(args.idx_prefix + '.rail2bit', args.idx_prefix,
+                            reference.extensions)
+    print >>sys.stderr, 'Wrote %s.rail2bit.' % args.idx_prefix
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+"""
+split_points.py
+Part of Rail-RNA
+
+Records and uses access points into FASTQs, so a preprocessing task that
+starts partway through a file can seek close to its first record rather
+than reading and discarding every record before it.
+
+An access point is a record index and a place in the file where that
+record starts. For an uncompressed file, the place is a byte offset. For a
+gzipped file, it's the offset of the gzip member containing the record and
+the number of uncompressed bytes from the start of that member to the
+record. Members of BGZF and other multi-member gzips are small, so
+decompressing from a member's start is cheap; access points more than
+_max_inflation uncompressed bytes into a member aren't recorded, so a
+single-member gzip only gets access points near its start.
+
+Access points are taken at multiples of a spacing in records that doubles
+whenever there would be more than _max_access_points of them. The spacing
+depends only on the number of records, so the mates of a paired-end sample
+are given access points at the same record indexes.
+"""
+import zlib
+import gzip
+import contextlib
+from bisect import bisect_right
+
+# Number of bytes read from a file at once
+_block_size = 1048576
+# Initial spacing of access points, in records
+_initial_spacing = 1024
+# Maximum number of access points recorded per file
+_max_access_points = 1024
+# Maximum number of bytes to decompress from a member's start to a record
+_max_inflation = 16777216
+
+class AccessPointReader(object):
+    """ Reads a FASTQ, plain or gzipped, recording access points.
+
+        Supports read() and readline(), so it can be passed where a stream
+        is expected. Access points are recorded as data is decompressed,
+        so they're complete once the file has been read to the end.
+    """
+
+    def __init__(self, filename, lines_per_record=4,
+                    initial_spacing=_initial_spacing,
+                    max_access_points=_max_access_points,
+                    block_size=_block_size):
+        """
+        filename: path to file
+        lines_per_record: number of lines per record
+        initial_spacing: initial spacing of access points in records
+        max_access_points: maximum number of access points to record
+        block_size: number of bytes to read from file at once
+        """
+        self.raw = open(filename, 'rb')
+        self.gzipped = (self.raw.read(2) == '\x1f\x8b')
+        self.raw.seek(0)
+        self.lines_per_record = lines_per_record
+        self.spacing = initial_spacing
+        self.max_access_points = max_access_points
+        self.block_size = block_size
+        # List of tuples (record index, offset, inner offset)
+        self.access_points = []
+        # Index of record at which to take next access point
+        self.next_record = initial_spacing
+        # Number of newlines decompressed so far
+        self.newlines = 0
+        self.pieces = (self._gzip_pieces() if self.gzipped
+                        else self._plain_pieces())
+        self.buffer = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.raw.close()
+
+    def _plain_pieces(self):
+        """ Yields tuples (data, offset, inner offset) from a plain file. """
+        while True:
+            offset = self.raw.tell()
+            data = self.raw.read(self.block_size)
+            if not data:
+                return
+            yield data, offset, 0
+
+    def _gzip_pieces(self):
+        """ Yields tuples (data, member offset, inner offset) from a gzip.
+
+            Each member is decompressed with its own decompressobj so the
+            offset at which it starts is known.
+        """
+        pending, compressed_offset = '', 0
+        member_offset, inner_offset = 0, 0
+        decompressor = zlib.decompressobj(31)
+        while True:
+            if not pending:
+                pending = self.raw.read(self.block_size)
+                if not pending:
+                    data = decompressor.flush()
+                    if data:
+                        yield data, member_offset, inner_offset
+                    return
+            try:
+                data = decompressor.decompress(pending)
+            except zlib.error:
+                if inner_offset or pending.strip('\x00'):
+                    raise
+                # Be forgiving of padding after the last member
+                return
+            if data:
+                yield data, member_offset, inner_offset
+                inner_offset += len(data)
+            if decompressor.unused_data:
+                # Member ended; next one starts at the first unused byte
+                compressed_offset += (len(pending)
+                                        - len(decompressor.unused_data))
+                pending = decompressor.unused_data
+                member_offset, inner_offset = compressed_offset, 0
+                decompressor = zlib.decompressobj(31)
+            else:
+                compressed_offset += len(pending)
+                pending = ''
+
+    def _scan(self, data, offset, inner_offset):
+        """ Records access points at records that start in data.
+
+            data: decompressed data
+            offset: offset of data in plain file or offset of its member
+            inner_offset: offset of data from start of its member
+
+            No return value.
+        """
+        newlines = data.count('\n')
+        while self.next_record * self.lines_per_record \
+                <= self.newlines + newlines:
+            # The record starts after this many newlines in data
+            newline_count = (self.next_record * self.lines_per_record
+                                - self.newlines)
+            position = len(data) - len(data.split('\n', newline_count)[-1])
+            if not self.gzipped:
+                self.access_points.append(
+                        (self.next_record, offset + position, 0)
+                    )
+            elif inner_offset + position <= _max_inflation:
+                self.access_points.append(
+                        (self.next_record, offset, inner_offset + position)
+                    )
+            self.next_record += self.spacing
+            if self.next_record // self.spacing > self.max_access_points:
+                self.spacing *= 2
+                self.access_points = [
+                        access_point for access_point in self.access_points
+                        if not access_point[0] % self.spacing
+                    ]
+                self.next_record = (-(-self.next_record // self.spacing)
+                                        * self.spacing)
+        self.newlines += newlines
+
+    def _fill(self, size):
+        """ Decompresses until buffer has size bytes or file is exhausted.
+
+            size: number of bytes to hold in buffer; negative for all
+        """
+        pieces = [self.buffer]
+        buffered = len(self.buffer)
+        while size < 0 or buffered < size:
+            try:
+                data, offset, inner_offset = self.pieces.next()
+            except StopIteration:
+                break
+            self._scan(data, offset, inner_offset)
+            pieces.append(data)
+            buffered += len(data)
+        self.buffer = ''.join(pieces)
+
+    def scan(self):
+        """ Records access points through end of file without buffering.
+        """
+        for data, offset, inner_offset in self.pieces:
+            self._scan(data, offset, inner_offset)
+
+    def read(self, size=-1):
+        """ Reads up to size bytes; reads rest of file if size < 0. """
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        """ Reads a line, including its trailing newline if present. """
+        while True:
+            newline = self.buffer.find('\n')
+            if newline != -1:
+                line, self.buffer = (self.buffer[:newline + 1],
+                                        self.buffer[newline + 1:])
+                return line
+            buffered = len(self.buffer)
+            self._fill(buffered + self.block_size)
+            if len(self.buffer) == buffered:
+                line, self.buffer = self.buffer, ''
+                return line
+
+def access_points_string(access_points):
+    """ Serializes access points for a manifest line.
+
+        access_points: list of access point lists, one per mate, each
+            recorded by an AccessPointReader
+
+        Return value: comma-separated access points present for every
+            mate, each of the form record:offset:inner offset, with an
+            offset and inner offset per mate
+    """
+    by_record = [dict((access_point[0], access_point[1:])
+                        for access_point in mate_access_points)
+                    for mate_access_points in access_points]
+    records = set(by_record[0])
+    for mate_access_points in by_record[1:]:
+        records.intersection_update(mate_access_points)
+    return ','.join(
+            ':'.join([str(record)] + [
+                    '%d:%d' % mate_access_points[record]
+                    for mate_access_points in by_record
+                ]) for record in sorted(records)
+        )
+
+def nearest_access_point(access_points, record):
+    """ Finds last access point at or before a record.
+
+        access_points: output of access_points_string()
+        record: 0-based index of record
+
+        Return value: serialized access point or '' if there is none
+    """
+    if not access_points:
+        return ''
+    access_points = access_points.split(',')
+    records = [int(access_point.partition(':')[0])
+                for access_point in access_points]
+    index = bisect_right(records, record)
+    if not index:
+        return ''
+    return access_points[index - 1]
+
+def parsed_access_point(access_point):
+    """ Parses an access point from nearest_access_point().
+
+        access_point: serialized access point; may be ''
+
+        Return value: tuple (record index, list of tuples
+            (offset, inner offset), one per mate) or None if access_point
+            is empty
+    """
+    if not access_point:
+        return None
+    fields = [int(field) for field in access_point.split(':')]
+    return fields[0], zip(fields[1::2], fields[2::2])
+
+@contextlib.contextmanager
+def xopen_at(filename, offset=0, inner_offset=0):
+    """ Opens a plain or gzipped file at an access point for reading.
+
+        filename: path to file
+        offset: offset of record in a plain file or of its member in a gzip
+        inner_offset: number of uncompressed bytes from start of member
+            to record
+
+        Yield value: file object
+    """
+    with open(filename, 'rb') as raw:
+        gzipped = (raw.read(2) == '\x1f\x8b')
+        raw.seek(offset)
+        if not gzipped:
+            yield raw
+            return
+        # Be forgiving of gzips that end unexpectedly, as xopen() is
+        old_read_eof = gzip.GzipFile._read_eof
+        gzip.GzipFile._read_eof = lambda *args, **kwargs: None
+        try:
+            fh = gzip.GzipFile(fileobj=raw, mode='rb')
+            while inner_offset:
+                skipped = len(fh.read(min(inner_offset, _block_size)))
+                if not skipped:
+                    break
+                inner_offset -= skipped
+            yield fh
+            fh.close()
+        finally:
+            gzip.GzipFile._read_eof = old_read_eof
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import unittest
+    import tempfile
+    import shutil
+
+    if '--test' in sys.argv:
+
+        def fastq_records(count):
+            """ Returns list of count FASTQ records of varying lengths. """
+            return ['@read%d\n%s\n+\n%s\n' % (i, 'ACGT' * (i % 9 + 1),
+                                              'I' * 4 * (i % 9 + 1))
+                        for i in xrange(count)]
+
+        def gzip_members(records, records_per_member):
+            """ Returns records compressed with a gzip member per chunk. """
+            members = []
+            for i in xrange(0, len(records), records_per_member):
+                temp_file = tempfile.TemporaryFile()
+                with gzip.GzipFile(fileobj=temp_file, mode='wb') as fh:
+                    fh.write(''.join(records[i:i+records_per_member]))
+                temp_file.seek(0)
+                members.append(temp_file.read())
+                temp_file.close()
+            return ''.join(members)
+
+        class TestAccessPointReader(unittest.TestCase):
+
+            def setUp(self):
+                self.temp_dir = tempfile.mkdtemp()
+                self.records = fastq_records(1000)
+                self.plain = os.path.join(self.temp_dir, 'plain.fastq')
+                with open(self.plain, 'w') as plain_stream:
+                    plain_stream.write(''.join(self.records))
+                self.multi = os.path.join(self.temp_dir, 'multi.fastq.gz')
+                with open(self.multi, 'wb') as multi_stream:
+                    multi_stream.write(gzip_members(self.records, 37))
+                self.single = os.path.join(self.temp_dir, 'single.fastq.gz')
+                with open(self.single, 'wb') as single_stream:
+                    single_stream.write(gzip_members(self.records, 1000))
+
+            def tearDown(self):
+                shutil.rmtree(self.temp_dir)
+
+            def assert_lands_on_records(self, filename, access_points):
+                """ Checks that each access point opens at its record. """
+                for record, offset, inner_offset in access_points:
+                    with xopen_at(filename, offset, inner_offset) as fh:
+                        self.assertEqual(
+                                ''.join(fh.readline() for _ in xrange(8)),
+                                ''.join(self.records[record:record+2])
+                            )
+
+            def test_scan_offsets(self):
+                with AccessPointReader(self.plain, lines_per_record=1,
+                                        initial_spacing=2) as reader:
+                    reader._scan('a\nb\nc', 100, 0)
+                    self.assertEqual(reader.access_points, [(2, 104, 0)])
+                    # Record 4 starts at the end of this data
+                    reader._scan('\nd\n', 105, 0)
+                    self.assertEqual(reader.access_points,
+                                     [(2, 104, 0), (4, 108, 0)])
+                    self.assertEqual((reader.newlines, reader.next_record),
+                                     (4, 6))
+                with AccessPointReader(self.multi, lines_per_record=1,
+                                        initial_spacing=2) as reader:
+                    # Gzips record member offset and offset inside member
+                    reader._scan('a\nb\nc\n', 50, 10)
+                    self.assertEqual(reader.access_points, [(2, 50, 14)])
+
+            def test_spacing_doubles(self):
+                with AccessPointReader(self.plain, lines_per_record=1,
+                                        initial_spacing=1,
+                                        max_access_points=2) as reader:
+                    reader._scan('x\n' * 10, 0, 0)
+                    self.assertEqual(reader.spacing, 8)
+                    self.assertEqual(reader.access_points, [(8, 16, 0)])
+                    self.assertEqual(reader.next_record, 16)
+                with AccessPointReader(self.plain, initial_spacing=4,
+                                        max_access_points=8,
+                                        block_size=100) as reader:
+                    reader.scan()
+                    records = [access_point[0]
+                                for access_point in reader.access_points]
+                    # 1000 records need a spacing of 128 for 7 points
+                    self.assertEqual(reader.spacing, 128)
+                    self.assertEqual(records, range(128, 1000, 128))
+
+            def test_plain(self):
+                with AccessPointReader(self.plain, initial_spacing=16,
+                                        max_access_points=16,
+                                        block_size=333) as reader:
+                    # Reading through the reader returns the file intact
+                    lines = []
+                    while True:
+                        line = reader.readline()
+                        if not line:
+                            break
+                        lines.append(line)
+                    self.assertEqual(''.join(lines), ''.join(self.records))
+                    access_points = reader.access_points
+                self.assertEqual(len(access_points), 15)
+                for record, offset, inner_offset in access_points:
+                    self.assertEqual(offset,
+                                     len(''.join(self.records[:record])))
+                    self.assertEqual(inner_offset, 0)
+                self.assert_lands_on_records(self.plain, access_points)
+
+            def test_multi_member_gzip(self):
+                with AccessPointReader(self.multi, initial_spacing=16,
+                                        max_access_points=16,
+                                        block_size=100) as reader:
+                    self.assertEqual(reader.read(), ''.join(self.records))
+                    access_points = reader.access_points
+                self.assertEqual(len(access_points), 15)
+                offsets = set(access_point[1]
+                                for access_point in access_points)
+                # Access points are in many members, each started fresh
+                self.assertTrue(len(offsets) > 10)
+                for record, _, inner_offset in access_points:
+                    self.assertEqual(
+                            inner_offset,
+                            len(''.join(self.records[record // 37 * 37
+                                                     :record]))
+                        )
+                self.assert_lands_on_records(self.multi, access_points)
+
+            def test_single_member_gzip(self):
+                global _max_inflation
+                max_inflation = _max_inflation
+                _max_inflation = 20000
+                try:
+                    with AccessPointReader(self.single, initial_spacing=16,
+                                            max_access_points=16,
+                                            block_size=100) as reader:
+                        reader.scan()
+                        access_points = reader.access_points
+                finally:
+                    _max_inflation = max_inflation
+                # Only access points near the start of the member are kept
+                self.assertTrue(0 < len(access_points) < 15)
+                for record, offset, inner_offset in access_points:
+                    self.assertEqual(offset, 0)
+                    self.assertEqual(inner_offset,
+                                     len(''.join(self.records[:record])))
+                    self.assertTrue(inner_offset <= 20000)
+                self.assert_lands_on_records(self.single, access_points)
+
+            def test_xopen_at_start(self):
+                for filename in [self.plain, self.multi, self.single]:
+                    with xopen_at(filename) as fh:
+                        self.assertEqual(fh.read(), ''.join(self.records))
+
+        class TestAccessPointStrings(unittest.TestCase):
+
+            def test_access_points_string(self):
+                self.assertEqual(
+                        access_points_string([[(4, 100, 0), (8, 200, 3)]]),
+                        '4:100:0,8:200:3'
+                    )
+                # Only records with access points in every mate are kept
+                self.assertEqual(
+                        access_points_string([
+                                [(4, 100, 0), (8, 200, 3), (12, 300, 0)],
+                                [(8, 210, 5), (12, 310, 7)]
+                            ]),
+                        '8:200:3:210:5,12:300:0:310:7'
+                    )
+                self.assertEqual(access_points_string([[]]), '')
+
+            def test_nearest_access_point(self):
+                access_points = '8:200:3:210:5,12:300:0:310:7'
+                self.assertEqual(nearest_access_point(access_points, 7), '')
+                self.assertEqual(nearest_access_point(access_points, 8),
+                                 '8:200:3:210:5')
+                self.assertEqual(nearest_access_point(access_points, 11),
+                                 '8:200:3:210:5')
+                self.assertEqual(nearest_access_point(access_points, 500),
+                                 '12:300:0:310:7')
+                self.assertEqual(nearest_access_point('', 500), '')
+
+            def test_parsed_access_point(self):
+                self.assertEqual(parsed_access_point('8:200:3:210:5'),
+                                 (8, [(200, 3), (210, 5)]))
+                self.assertEqual(parsed_access_point('8:200:3'),
+                                 (8, [(200, 3)]))
+                self.assertEqual(parsed_access_point(''), None)
+
+        unittest.main(argv=[sys.argv[0]])